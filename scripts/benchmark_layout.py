@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import xml.etree.ElementTree as et
+
+import numpy as np
+
+try:
+    import abstract_map_lib.abstract_map as am
+except ImportError:
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'src'))
+    import abstract_map_lib.abstract_map as am
+import abstract_map_lib.hierarchy as hierarchy_lib
+import abstract_map_lib.profiling as profiling
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+DEFAULT_SIZES = [10, 50, 100, 250, 500, 1000, 2000]
+DEFAULT_DENSITIES = [0.5, 1.0, 2.0]
+DEFAULT_MAX_STEPS = 2000
+DEFAULT_TIMEOUT = 600
+
+ZOO_HIERARCHY = 'experiments/zoo_hierarchy.xml'
+ZOO_MAPPING = 'experiments/zoo_mapping.xml'
+
+# Fraction of the leaf places that get a label in the synthetic environments
+LABEL_FRACTION = 0.1
+
+# Branching factor of the synthetic hierarchies (levels get added until the
+# requested number of toponyms is reached)
+BRANCHING = 6
+
+# Separation (metres) of tags along the synthetic "corridor"
+TAG_SPACING = 2.0
+
+# SSI templates matching the grammar understood by abstract_map.py
+_ARROWS = ['$LEFT$', '$RIGHT$', '$UP$', '$DOWN$']
+_RELATIONS = [
+    'is past', 'is beyond', 'is after', 'is before', 'is towards', 'is near',
+    'is beside', 'is left of', 'is right of'
+]
+
+
+class Environment(object):
+    """Synthetic (or loaded) environment, as a hierarchy & list of tags"""
+
+    def __init__(self, name, hierarchy, tags):
+        """Constructs an environment from hierarchy tuples & tag tuples"""
+        self.name = name
+        self.hierarchy = hierarchy  # List of (child, parent)
+        self.tags = tags  # List of (tag_id, ssi, (x, y, th))
+
+    def toponyms(self):
+        """Returns the set of toponyms mentioned by the hierarchy"""
+        return set(t for h in self.hierarchy for t in h)
+
+
+def loadZooEnvironment(seed=0):
+    """Loads the bundled zoo experiment, with synthetic tag poses"""
+    rng = random.Random(seed)
+    hierarchy = hierarchy_lib.Hierarchy.fromFile(
+        os.path.join(PACKAGE_ROOT, ZOO_HIERARCHY)).edges()
+    tags = []
+    for m in et.parse(os.path.join(PACKAGE_ROOT, ZOO_MAPPING)).getroot():
+        if m.get('type') not in ['LABEL', 'INFO'] or not m.get('text'):
+            continue
+        tags.append((int(m.get('tag_id')), m.get('text'),
+                     _corridorPose(len(tags), rng)))
+    return Environment('zoo', hierarchy, tags)
+
+
+def syntheticEnvironment(size, density, seed=0):
+    """Generates an environment with a requested number of toponyms
+
+    The density is the mean number of times each toponym is referred to by
+    the symbolic spatial information on a sign (labels are not included).
+    """
+    rng = random.Random(seed)
+
+    # Grow a hierarchy one level at a time, until we have enough toponyms
+    levels = [['Site']]
+    hierarchy = []
+    siblings = {}
+    while len(hierarchy) + 1 < size:
+        level = []
+        for p in levels[-1]:
+            for i in range(min(BRANCHING, size - 1 - len(hierarchy))):
+                c = '%s %d' % (p, i)
+                level.append(c)
+                hierarchy.append((c, p))
+                siblings.setdefault(p, []).append(c)
+        levels.append(level)
+
+    # Generate the signs, each referring to a group of siblings
+    tags = []
+    groups = [g for g in siblings.values() if len(g) > 1]
+    mentions = 0
+    while groups and mentions < density * size:
+        g = rng.choice(groups)
+        lines = []
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.5:
+                fs = rng.sample(g, rng.randint(1, min(3, len(g))))
+                lines.append('%s %s' % (rng.choice(_ARROWS), ', '.join(fs)))
+                mentions += len(fs)
+            else:
+                f, r = rng.sample(g, 2)
+                lines.append('The %s %s the %s' %
+                             (f, rng.choice(_RELATIONS), r))
+                mentions += 2
+        tags.append(
+            (len(tags), '\\n'.join(lines), _corridorPose(len(tags), rng)))
+
+    # Finish with labels for a random sample of the leaf places
+    leaves = levels[-1]
+    for l in rng.sample(leaves, int(math.ceil(LABEL_FRACTION * len(leaves)))):
+        tags.append((len(tags), l, _corridorPose(len(tags), rng)))
+    rng.shuffle(tags)
+
+    return Environment('synthetic_%d_%g' % (size, density), hierarchy, tags)
+
+
+def _corridorPose(i, rng):
+    """Returns a pose for the i'th tag in a meandering corridor"""
+    return (i * TAG_SPACING, rng.uniform(-1, 1) * TAG_SPACING,
+            rng.uniform(-math.pi, math.pi))
+
+
+def _stats(xs):
+    """Summary statistics for a list of durations"""
+    if not xs:
+        return None
+    xs = np.array(xs)
+    return {
+        'count': len(xs),
+        'total': float(np.sum(xs)),
+        'mean': float(np.mean(xs)),
+        'median': float(np.median(xs)),
+        'p95': float(np.percentile(xs, 95)),
+        'max': float(np.max(xs))
+    }
+
+
+def runBenchmark(env, max_steps=DEFAULT_MAX_STEPS):
+    """Runs a single benchmark case, returning a dict of measurements"""
+    profiler = profiling.Profiler()
+    abstract_map = am.AbstractMap(None, 0, 0, 0, log=False, profiler=profiler)
+    layout = abstract_map._spatial_layout
+
+    # Time every mass placement by wrapping the layout's placement method
+    place_times = []
+    place_fn = layout._placeMass
+
+    def timedPlaceMass(mass, *args):
+        t = time.time()
+        place_fn(mass, *args)
+        place_times.append(time.time() - t)
+
+    layout._placeMass = timedPlaceMass
+
+    # Ingest the hierarchy the same way the ROS node does
+    t = time.time()
+    for c, p in env.hierarchy:
+        abstract_map.addSymbolicSpatialInformation('%s is in %s' % (c, p),
+                                                   None,
+                                                   immediate=True)
+    t_hierarchy = time.time() - t
+    n_hierarchy = len(place_times)
+
+    t = time.time()
+    layout.initialiseState()
+    t_initialise = time.time() - t
+    n_initialise = len(place_times)
+
+    # Ingest every line of every tag
+    t = time.time()
+    for tag_id, ssi, pose in env.tags:
+        for i, s in enumerate(ssi.split('\\n')):
+            abstract_map.addSymbolicSpatialInformation(s,
+                                                       pose, (tag_id, i),
+                                                       immediate=True)
+    t_tags = time.time() - t
+
+    # Step the layout until it settles (or we run out of steps)
+    step_times = []
+    t = time.time()
+    settled = False
+    while len(step_times) < max_steps and not settled:
+        ts = time.time()
+        layout.step()
+        step_times.append(time.time() - ts)
+        settled = layout.isSettled()
+    t_settle = time.time() - t
+    profile = profiler.summary()
+
+    return {
+        'environment': env.name,
+        'toponyms': len(env.toponyms()),
+        'tags': len(env.tags),
+        'masses': len(layout._masses),
+        'constraints': len(layout._constraints),
+        'hierarchy_ingest_time': t_hierarchy,
+        'initialise_state_time': t_initialise,
+        'tag_ingest_time': t_tags,
+        'place_mass_hierarchy': _stats(place_times[:n_hierarchy]),
+        'place_mass_initialise':
+            _stats(place_times[n_hierarchy:n_initialise]),
+        'place_mass_tags': _stats(place_times[n_initialise:]),
+        'step_time': _stats(step_times),
+        'steps_to_settle': len(step_times) if settled else None,
+        'settled': settled,
+        'wall_clock_to_settle': t_settle if settled else None,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'profile': {
+            'timers': profile['timers'],
+            'counters': profile['counters']
+        }
+    }
+
+
+def _runCase(args):
+    """Process pool target (builds the environment in a fresh process)"""
+    kind, size, density, seed, max_steps = args
+    env = (loadZooEnvironment(seed) if kind == 'zoo' else
+           syntheticEnvironment(size, density, seed))
+    return runBenchmark(env, max_steps=max_steps)
+
+
+def _libraryVersion():
+    """Returns the package version from the package manifest"""
+    try:
+        manifest = et.parse(os.path.join(PACKAGE_ROOT, 'package.xml'))
+        return manifest.getroot().find('version').text
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def main(args):
+    cases = [('zoo', None, None, args.seed, args.max_steps)] + [
+        ('synthetic', s, d, args.seed, args.max_steps)
+        for s in args.sizes
+        for d in args.densities
+    ]
+
+    results = []
+    for c in cases:
+        # Every case gets a fresh process so peak memory is per case, and a
+        # runaway case can be abandoned without losing the whole run
+        pool = mp.Pool(1, maxtasksperchild=1)
+        try:
+            r = pool.apply_async(_runCase, (c,)).get(args.timeout)
+            pool.close()
+        except mp.TimeoutError:
+            r = {
+                'environment':
+                    'zoo' if c[0] == 'zoo' else 'synthetic_%d_%g' % c[1:3],
+                'timed_out': True
+            }
+            pool.terminate()
+        pool.join()
+        r.update({'size': c[1], 'density': c[2], 'seed': c[3]})
+        results.append(r)
+        if r.get('timed_out'):
+            print("%s: timed out" % (r['environment']))
+        else:
+            print("%s: %s after %d steps" %
+                  (r['environment'], 'settled' if r['settled'] else
+                   'not settled', r['step_time']['count']))
+
+    output = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': _libraryVersion(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'max_steps': args.max_steps,
+        'timeout': args.timeout,
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print("Results written to: %s" % (args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the spatial layout engine on synthetic '
+        'environments of scaling size (plus the bundled zoo experiment)')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='number of toponyms in synthetic environments')
+    parser.add_argument('--densities',
+                        type=float,
+                        nargs='+',
+                        default=DEFAULT_DENSITIES,
+                        help='mean sign references per toponym')
+    parser.add_argument('--max-steps',
+                        type=int,
+                        default=DEFAULT_MAX_STEPS,
+                        help='maximum steps to wait for a layout to settle')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=DEFAULT_TIMEOUT,
+                        help='seconds before a single case is abandoned')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output',
+                        default='benchmark_%s.json' %
+                        time.strftime('%Y%m%d_%H%M%S'),
+                        help='JSON file the results are written to')
+    main(parser.parse_args())
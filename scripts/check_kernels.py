@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+try:
+    import abstract_map_lib.abstract_map as am
+except ImportError:
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'src'))
+    import abstract_map_lib.abstract_map as am
+import abstract_map_lib.kernels as kernels
+import abstract_map_lib.spatial_layout as sl
+
+import benchmark_layout
+
+DEFAULT_STEPS = 100
+DEFAULT_TOLERANCE = 1e-9
+
+
+def buildLayout(env):
+    """Builds the spatial layout of an environment (as the benchmark does)"""
+    abstract_map = am.AbstractMap(None, 0, 0, 0, log=False)
+    for c, p in env.hierarchy:
+        abstract_map.addSymbolicSpatialInformation('%s is in %s' % (c, p),
+                                                   None,
+                                                   immediate=True)
+    abstract_map._spatial_layout.initialiseState()
+    for tag_id, ssi, pose in env.tags:
+        for i, s in enumerate(ssi.split('\\n')):
+            abstract_map.addSymbolicSpatialInformation(s,
+                                                       pose, (tag_id, i),
+                                                       immediate=True)
+    return abstract_map._spatial_layout
+
+
+def _backends():
+    """Returns (name, accelerations, integrate, stepSafely) kernel backends
+
+    The Python functions behind the compiled kernels are always checked, so
+    the kernels are checked even where Numba isn't installed.
+    """
+    fns = [kernels.accelerations, kernels.integrate, kernels.stepSafely]
+    backends = [('python',) + tuple(getattr(f, 'py_func', f) for f in fns)]
+    if kernels.AVAILABLE:
+        backends.append(('compiled',) + tuple(fns))
+    return backends
+
+
+def checkStep(layout, backends):
+    """Returns the largest error of each backend, & if masses collided
+
+    Forces, an integration step, & collisions are each checked against the
+    NumPy implementation, starting from the same state of the layout. The
+    layout's state is left as it was.
+    """
+    n = len(layout._masses)
+    state = np.copy(layout._state[:n])
+    bounced = layout._bounced_last_step
+    forces = layout._kernelForces()
+    layout.useKernels(False)
+
+    # Reference forces, integration step, & safe state push
+    layout._refreshForces()
+    acc = np.copy(layout._state[:n, 2])
+    y = np.copy(state[:, 0:2])
+    y_next = sl._integrateComponent(layout._constraintTable(), np.copy(y),
+                                    layout._coem)
+    layout._pushStateSafely(y.reshape(-1), y_next.reshape(-1))
+    y_safe = np.copy(layout._state[:n, 0:2])
+    collided = layout._bounced_last_step
+    layout._state[:n] = state
+    layout._bounced_last_step = bounced
+
+    errors = {}
+    for name, accelerations, integrate, stepSafely in backends:
+        a = np.zeros((n, 2))
+        accelerations(state[:, 0], state[:, 1], forces, a)
+        ps = np.copy(y[:, 0])
+        vs = np.copy(y_next[:, 1])
+        stepSafely(ps, vs, y_next[:, 0] - y[:, 0], sl.SAFE_DISTANCE)
+        errors[name] = max(
+            np.max(np.abs(a - acc)),
+            np.max(np.abs(integrate(np.copy(y), sl.INTEGRATION_DT, forces) -
+                          y_next)),
+            np.max(np.abs(ps - y_safe[:, 0])),
+            np.max(np.abs(vs - y_safe[:, 1])))
+    return errors, collided
+
+
+def main(args):
+    env = (benchmark_layout.loadZooEnvironment(args.seed)
+           if args.size is None else benchmark_layout.syntheticEnvironment(
+               args.size, args.density, args.seed))
+    layout = buildLayout(env)
+    backends = _backends()
+
+    # Step the layout with the NumPy implementation, checking every state
+    worst = {b[0]: 0. for b in backends}
+    collisions = 0
+    for _ in range(args.steps):
+        errors, collided = checkStep(layout, backends)
+        for name, e in errors.items():
+            worst[name] = max(worst[name], e)
+        collisions += collided
+        layout.useKernels(False)
+        layout.step()
+
+    failed = False
+    for name, e in sorted(worst.items()):
+        print("%s kernels: largest error of %g over %d steps (%s)" %
+              (name, e, args.steps, 'ok' if e <= args.tolerance else 'FAIL'))
+        failed |= e > args.tolerance
+    print("(masses collided in %d of the steps)" % (collisions))
+    if not kernels.AVAILABLE:
+        print("Numba is not installed, so compiled kernels weren't checked")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Checks the spatial layout kernels match the NumPy '
+        'implementation, on the zoo experiment (or a synthetic environment)')
+    parser.add_argument('--size',
+                        type=int,
+                        default=None,
+                        help='number of toponyms in a synthetic environment')
+    parser.add_argument('--density',
+                        type=float,
+                        default=1.0,
+                        help='mean sign references per toponym')
+    parser.add_argument('--steps',
+                        type=int,
+                        default=DEFAULT_STEPS,
+                        help='number of layout steps checked')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=DEFAULT_TOLERANCE,
+                        help='largest error allowed')
+    parser.add_argument('--seed', type=int, default=0)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+
+try:
+    import abstract_map_lib.abstract_map as am
+except ImportError:
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'src'))
+    import abstract_map_lib.abstract_map as am
+import abstract_map_lib.spatial_layout as sl
+
+import benchmark_layout
+
+DEFAULT_STEPS = 100
+DEFAULT_TOLERANCE = 1e-9
+
+
+def referenceScales(layout, places):
+    """Returns the scales from measuring every observed pair from scratch
+
+    This is how scales were measured before observations were kept by pair:
+    every distance constraint between observed masses, measured one at a
+    time where the masses are (or where its label puts a newly observed
+    place).
+    """
+    observed = set(layout._observed_symbols)
+    observed.update(m._symbol for m in layout._masses if m.fixed)
+    pos = {m._symbol: m.pos for m in layout._masses}
+    for m, p in places.items():
+        if m._symbol not in observed:
+            pos[m._symbol] = p
+        observed.add(m._symbol)
+
+    observations = []
+    for c in layout._constraints:
+        if (type(c) != sl.ConstraintDistance or
+                c._mass_a._symbol not in observed or
+                c._mass_b._symbol not in observed):
+            continue
+        d = pos[c._mass_a._symbol] - pos[c._mass_b._symbol]
+        observations.append(((c._mass_a._level, c._mass_b._level),
+                             (d[0]**2 + d[1]**2)**0.5, c._stiffness))
+    scale_manager = sl.ScaleManager()
+    scale_manager.setObservations(
+        [o for o in observations if sl.MASS_LEVEL_LABEL not in o[0]])
+    return scale_manager._scales
+
+
+def checkedLayout(layout, errors):
+    """Checks the scales measured by a layout against the reference
+
+    The largest error of the scales measured by each label batch is added to
+    errors.
+    """
+    observe = layout._observeMasses
+
+    def checkedObserve(places):
+        expected = referenceScales(layout, places)
+        observe(places)
+        scales = layout._scale_manager._scales
+        errors.append(
+            max(
+                abs(scales.get(k, 1) - expected.get(k, 1))
+                for k in set(scales) | set(expected)))
+
+    layout._observeMasses = checkedObserve
+    return layout
+
+
+def main(args):
+    env = (benchmark_layout.loadZooEnvironment(args.seed)
+           if args.size is None else benchmark_layout.syntheticEnvironment(
+               args.size, args.density, args.seed))
+
+    # Build the layout, stepping it between tags as a robot would
+    errors = []
+    abstract_map = am.AbstractMap(None, 0, 0, 0, log=False)
+    for c, p in env.hierarchy:
+        abstract_map.addSymbolicSpatialInformation('%s is in %s' % (c, p),
+                                                   None,
+                                                   immediate=True)
+    layout = checkedLayout(abstract_map._spatial_layout, errors)
+    layout.initialiseState()
+    for tag_id, ssi, pose in env.tags:
+        for i, s in enumerate(ssi.split('\\n')):
+            abstract_map.addSymbolicSpatialInformation(s,
+                                                       pose, (tag_id, i),
+                                                       immediate=True)
+        for _ in range(args.steps):
+            layout.step()
+
+    worst = max(errors) if errors else 0.
+    print("scales: largest error of %g over %d label batches (%s)" %
+          (worst, len(errors), 'ok' if worst <= args.tolerance else 'FAIL'))
+    scales = layout._scale_manager._scales
+    for k in sorted(scales):
+        print("\t%s: %f" % (k, scales[k]))
+    return 1 if worst > args.tolerance else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Checks the scales a layout measures match measuring '
+        'every observation from scratch, on the zoo experiment (or a '
+        'synthetic environment)')
+    parser.add_argument('--size',
+                        type=int,
+                        default=None,
+                        help='number of toponyms in a synthetic environment')
+    parser.add_argument('--density',
+                        type=float,
+                        default=1.0,
+                        help='mean sign references per toponym')
+    parser.add_argument('--steps',
+                        type=int,
+                        default=DEFAULT_STEPS,
+                        help='layout steps between tags')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=DEFAULT_TOLERANCE,
+                        help='largest error allowed')
+    parser.add_argument('--seed', type=int, default=0)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import os
+import sys
+
+try:
+    import abstract_map_lib.visual as visual
+except ImportError:
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'src'))
+    import abstract_map_lib.visual as visual
+
+DEFAULT_TOPIC = 'abstract_map'
+DEFAULT_FPS = 10
+
+
+def framesFromBag(fn, topic, fps):
+    """Returns the pickled abstract map to show in each frame of a bag replay
+
+    Each frame shows the latest message received by the time of the frame
+    (messages in between frames are never decoded).
+    """
+    import rosbag
+    frames = []
+    t_next = None
+    latest = None
+    with rosbag.Bag(fn) as bag:
+        for _, msg, t in bag.read_messages(topics=[topic, '/' + topic]):
+            t = t.to_sec()
+            if t_next is None:
+                t_next = t
+            while latest is not None and t > t_next:
+                frames.append(latest)
+                t_next += 1.0 / fps
+            latest = msg.data
+    if latest is not None:
+        frames.append(latest)
+    return frames
+
+
+def framesFromPickles(fns):
+    """Returns the pickled contents of each file, one frame per file"""
+    frames = []
+    for fn in sorted(fns):
+        with open(fn, 'rb') as f:
+            frames.append(f.read())
+    return frames
+
+
+def main(args):
+    if len(args.input) == 1 and args.input[0].endswith('.bag'):
+        frames = framesFromBag(args.input[0], args.topic, args.fps)
+    else:
+        frames = framesFromPickles(
+            [fn for i in args.input for fn in glob.glob(i)])
+    print("Rendering %d frames to: %s" % (len(frames), args.output))
+    filenames = visual.renderFrames(
+        frames,
+        args.output,
+        processes=args.processes,
+        size=tuple(args.size),
+        x_range=None if args.range is None else args.range[0:2],
+        y_range=None if args.range is None else args.range[2:4],
+        dark=args.dark)
+    print("Rendered %d frames (e.g. make a video with: ffmpeg -framerate %g "
+          "-i %s out.mp4)" % (len(filenames), args.fps,
+                              os.path.join(args.output,
+                                           visual.FRAME_FILENAME)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Renders a replay of an abstract map session to image '
+        'files, in parallel (from a bag, or a list of pickled abstract maps)')
+    parser.add_argument('input',
+                        nargs='+',
+                        help='bag file, or pickle files (in frame order '
+                        'when sorted)')
+    parser.add_argument('--topic',
+                        default=DEFAULT_TOPIC,
+                        help='topic the abstract map was published on')
+    parser.add_argument('--fps',
+                        type=float,
+                        default=DEFAULT_FPS,
+                        help='frames per second of replayed bag time')
+    parser.add_argument('--output',
+                        default='frames',
+                        help='directory the frames are written to')
+    parser.add_argument('--processes',
+                        type=int,
+                        default=None,
+                        help='number of rendering processes (default: cores)')
+    parser.add_argument('--size',
+                        type=int,
+                        nargs=2,
+                        default=list(visual.OFFSCREEN_SIZE),
+                        help='width & height of each frame in pixels')
+    parser.add_argument('--range',
+                        type=float,
+                        nargs=4,
+                        default=None,
+                        help='fixed view range (x_min x_max y_min y_max)')
+    parser.add_argument('--dark', action='store_true')
+    main(parser.parse_args())
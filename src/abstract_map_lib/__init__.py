@@ -1 +1,4 @@
-__all__ = ["abstract_map", "spatial_layout", "tools", "visual"]
+__all__ = [
+    "abstract_map", "checkpoint", "ensemble", "hierarchy", "kernels",
+    "occupancy", "profiling", "ros_tools", "spatial_layout", "tools", "visual"
+]
@@ -1,16 +1,38 @@
 from __future__ import absolute_import
 import numpy as np
 import math
+import os
 import re
+import sys
+import tempfile
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import abstract_map_lib.ensemble as ensemble
 import abstract_map_lib.spatial_layout as sl
 
+# Version of cached hierarchy layouts (bumped whenever placement, or the
+# pickled state of a layout, changes)
+HIERARCHY_CACHE_FORMAT = 2
+
+# Layout attributes that are left out of a cached hierarchy layout
+_HIERARCHY_CACHE_EXCLUDED = ['_coem', '_energy_log']
+
 
 class AbstractMap(object):
     """The abstract map, used to apply abstract ideas about space"""
     TAG_SYNONYMS = ['here']
 
-    def __init__(self, goal, start_x, start_y, start_th, log=False):
+    def __init__(self,
+                 goal,
+                 start_x,
+                 start_y,
+                 start_th,
+                 log=False,
+                 profiler=None):
         """Constructs a new empty abstract map, with a given symbolic goal"""
         self._goal = goal
         self._start_x = start_x
@@ -18,7 +40,7 @@ class AbstractMap(object):
         self._start_th = start_th
 
         # Initialise a spatial layout with the information provided
-        self._spatial_layout = sl.SpatialLayout(log=log)
+        self._spatial_layout = sl.SpatialLayout(log=log, profiler=profiler)
         # TODO add start mass, and constraint to origin
 
     def _constraintsFromSsiMsg(self, ssi, pose, ssi_id=None):
@@ -72,19 +94,62 @@ class AbstractMap(object):
                 elif c_is_tag:
                     c._mass_c = mass_fixed
 
+        # Intern the names of all masses (the layout works with symbol IDs)
+        for c in cs:
+            for m in c.masses():
+                self._spatial_layout.internMass(m)
+
         # Return the final list of constraints
         return cs
 
     def _hierarchyHintsFromSsiMsg(self, ssi, ssi_id=None):
-        """Gets any hierarchy hints as (child, parent) tuples"""
+        """Gets any hierarchy hints as (child, parent) symbol ID tuples"""
         figs, rel, refs, con = _ssiToComponents(ssi)
         if not figs and ssi_id is not None:
             # A label observation
-            return [('#%d' % (ssi_id[0]), f) for f in figs]
+            hs = [('#%d' % (ssi_id[0]), f) for f in figs]
         elif rel == 'in':
-            return [(f, r) for f in figs for r in refs]
+            hs = [(f, r) for f in figs for r in refs]
         else:
-            return []
+            hs = []
+        layout = self._spatial_layout
+        return [(layout.internName(h[0]), layout.internName(h[1])) for h in hs]
+
+    def addHierarchy(self, hierarchy, cache_dir=None):
+        """Adds a hierarchy, & initialises the state of the layout
+
+        If a cache directory is provided, the initialised layout is read from
+        (or written to) a cache file keyed by the hierarchy's content & the
+        cache format. The cache is only used when the layout is empty.
+        Returns True if the layout was loaded from the cache.
+        """
+        layout = self._spatial_layout
+        fn = (None if cache_dir is None or layout._masses else os.path.join(
+            os.path.expandvars(cache_dir), _hierarchyCacheFilename(hierarchy)))
+        if fn is not None and os.path.isfile(fn):
+            state = _readHierarchyCache(fn)
+            if state is not None:
+                layout.__setstate__(state)
+                layout.markSystemChanged()
+                return True
+
+        # Add the hierarchy as symbolic spatial information (as a single
+        # batch, without placement, because we are about to initialise the
+        # state of the entire network anyway)
+        with layout.batch(place=False):
+            for c, p in hierarchy.edges():
+                self.addSymbolicSpatialInformation("%s is in %s" % (c, p),
+                                                   None,
+                                                   immediate=True)
+
+        # Because we added an entire hierarchy, we should finish by
+        # initialising the state of the entire network (this allows us to
+        # layout the network WITH correct mass levels, whereas the adding done
+        # above is not able to guarantee this...)
+        layout.initialiseState()
+        if fn is not None:
+            _writeHierarchyCache(fn, layout)
+        return False
 
     def addSymbolicSpatialInformation(self,
                                       ssi,
@@ -119,9 +184,39 @@ class AbstractMap(object):
             # for c in cs:
             #     print("\tAdded: %s" % (c))
 
+    def getToponymEnsemble(self,
+                           toponym,
+                           size=ensemble.ENSEMBLE_SIZE,
+                           seed=ensemble.ENSEMBLE_SEED):
+        """Returns an (unsettled) layout ensemble for estimating a toponym
+
+        Returns None if the toponym isn't in the layout. The ensemble copies
+        what it needs, so it can be settled outside of the layout's thread.
+        """
+        if self._spatial_layout.getMass(toponym) is None:
+            return None
+        return ensemble.LayoutEnsemble(self._spatial_layout,
+                                       size=size,
+                                       seed=seed)
+
+    def getToponymEstimate(self,
+                           toponym,
+                           size=ensemble.ENSEMBLE_SIZE,
+                           max_time=ensemble.ENSEMBLE_MAX_TIME):
+        """Returns a PositionEstimate of a toponym from a layout ensemble
+
+        The estimate is flagged as unsettled if the ensemble didn't settle
+        within max_time seconds. Returns None if the toponym isn't found.
+        """
+        e = self.getToponymEnsemble(toponym, size=size)
+        if e is None:
+            return None
+        e.settle(max_time=max_time)
+        return e.estimate(toponym)
+
     def getToponymLocation(self, toponym):
         m = self._spatial_layout.getMass(toponym)
-        return (None if m is None else m.pos)
+        return (None if m is None else np.array(m.pos))
 
     def updateSymbolicSpatialInformation(self, ssi, pose, ssi_id):
         """Updates existing symbolic spatial information in the abstract map"""
@@ -132,6 +227,58 @@ class AbstractMap(object):
                 self._spatial_layout.updateConstraints, cs)
 
 
+def _hierarchyCacheFilename(hierarchy):
+    """Returns the cache filename for a hierarchy (in this cache format)"""
+    return 'hierarchy_v%d_py%d_%s.pickle' % (
+        HIERARCHY_CACHE_FORMAT, sys.version_info[0], hierarchy.digest())
+
+
+def _readHierarchyCache(fn):
+    """Reads the layout state in a cache file (None if it is unusable)
+
+    The state is adopted by a new layout first, so a broken cache file can't
+    leave a live layout half updated.
+    """
+    try:
+        with open(fn, 'rb') as f:
+            layout = sl.SpatialLayout(log=False)
+            layout.__setstate__(pickle.load(f))
+    except (IOError, OSError, EOFError, AttributeError, ImportError,
+            IndexError, KeyError, TypeError, ValueError,
+            pickle.UnpicklingError):
+        return None
+    state = layout.__getstate__()
+    for k in _HIERARCHY_CACHE_EXCLUDED:
+        state.pop(k, None)
+    return state
+
+
+def _writeHierarchyCache(fn, layout):
+    """Atomically writes the state of an initialised layout to a cache file"""
+    state = layout.__getstate__()
+    for k in _HIERARCHY_CACHE_EXCLUDED:
+        state.pop(k, None)
+    d = os.path.dirname(fn)
+    fn_tmp = None
+    try:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        fd, fn_tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(fn_tmp, fn)
+        fn_tmp = None
+    except (IOError, OSError):
+        pass
+    finally:
+        # A failed write never leaves its temporary file behind
+        if fn_tmp is not None:
+            try:
+                os.remove(fn_tmp)
+            except OSError:
+                pass
+
+
 class _ComponentRegex(object):
     """Helper class tofacilitate single compile regex"""
     ARROW = re.compile(r'^\s*\$(\w+)\$')
@@ -0,0 +1,294 @@
+from __future__ import absolute_import
+import collections
+import json
+import numpy as np
+import os
+import re
+import shutil
+import time
+
+import abstract_map_lib.spatial_layout as sl
+
+# Version of the on-disk format (bumped whenever the columns change)
+CHECKPOINT_FORMAT = 3
+
+# Number of complete checkpoints kept in a checkpoint directory
+CHECKPOINT_KEEP = 2
+
+_LATEST = 'LATEST'
+_MANIFEST = 'manifest.json'
+_CHECKPOINT_RE = re.compile(r'^checkpoint_(\d+)$')
+
+_MASS_KINDS = [sl.MassFixed, sl.Mass]
+_CONSTRAINT_KINDS = [
+    sl.ConstraintDistance, sl.ConstraintAngleGlobal, sl.ConstraintAngleLocal
+]
+
+Checkpoint = collections.namedtuple('Checkpoint',
+                                    ['layout_state', 'ssi_items', 'time'])
+
+
+def _checkpointDirs(directory):
+    """Returns (sequence, path) of complete checkpoints, newest first"""
+    if not os.path.isdir(directory):
+        return []
+    matches = [(_CHECKPOINT_RE.match(d), d) for d in os.listdir(directory)]
+    return sorted([(int(m.group(1)), os.path.join(directory, d))
+                   for m, d in matches
+                   if m is not None],
+                  reverse=True)
+
+
+def _fsyncDir(directory):
+    """Flushes a directory's entries to disk (where the OS supports it)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _readCheckpoint(path, mmap):
+    """Reads a single checkpoint directory"""
+    with open(os.path.join(path, _MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    if manifest['format'] != CHECKPOINT_FORMAT:
+        raise ValueError("Checkpoint format %s is not supported" %
+                         (manifest['format']))
+
+    def column(name):
+        return np.load(os.path.join(path, name + '.npy'),
+                       mmap_mode='r' if mmap else None)
+
+    # Rebuild the masses (parents can only be linked once all exist)
+    symbols = sl.SymbolTable(manifest['symbols'])
+    kinds = column('mass_kind')
+    pos = column('mass_pos')
+    vel = column('mass_vel')
+    levels = column('mass_level')
+    parents = column('mass_parent')
+    weights = column('mass_weight')
+    masses = []
+    for i, symbol in enumerate(column('mass_symbol')):
+        name = symbols.name(symbol)
+        if _MASS_KINDS[kinds[i]] is sl.Mass:
+            m = sl.Mass(name, np.array(pos[i]), np.array(vel[i]))
+        else:
+            m = sl.MassFixed(name, np.array(pos[i]))
+            m.vel = np.array(vel[i])
+        m._level = int(levels[i])
+        m._mass = float(weights[i])
+        masses.append(m)
+    for m, p in zip(masses, parents):
+        m._parent = None if p < 0 else masses[p]
+
+    # Rebuild the constraints
+    kinds = column('constraint_kind')
+    indices = column('constraint_masses')
+    lengths = column('constraint_length')
+    stiffnesses = column('constraint_stiffness')
+    sources = column('constraint_source')
+    constraints = []
+    for i, ssi_id in enumerate(manifest['constraint_ssi_ids']):
+        kind = _CONSTRAINT_KINDS[kinds[i]]
+        ms = [masses[j] for j in indices[i] if j >= 0]
+        c = kind(*(ms + [float(lengths[i]), float(stiffnesses[i])]))
+        c._ssi_id = tuple(ssi_id) if isinstance(ssi_id, list) else ssi_id
+        c._source = int(sources[i])
+        constraints.append(c)
+
+    # Rebuild the scale manager
+    scale_manager = sl.ScaleManager()
+    scale_manager._exploration_factor = manifest['exploration_factor']
+    scale_manager._exploration_step = manifest['exploration_step']
+    scale_manager._observations = {}
+    for key, l_a, l_b, d, w in manifest['scale_observations']:
+        scale_manager._observations.setdefault(
+            tuple(key) if isinstance(key, list) else key, []).append(
+                ((l_a, l_b), d, w))
+    scale_manager._sums = {(s[0], s[1]): np.array(s[2:])
+                           for s in manifest['scale_sums']}
+    scale_manager._updateScales(list(scale_manager._sums.keys()))
+
+    # Rebuild the hierarchy hints (rows are key, child, & parent symbols)
+    queued = {}
+    for k, c, p in column('queued_hierarchies'):
+        queued.setdefault(int(k), []).append((int(c), int(p)))
+
+    # Start from the state of a new layout, so anything not checkpointed
+    # gets its default value
+    state = sl.SpatialLayout(log=False).__getstate__()
+    state.pop('_energy_log', None)
+    state.pop('_coem', None)
+    state.update({
+        '_masses': [masses[i] for i in manifest['layout_masses']],
+        '_constraints': constraints,
+        '_scale_manager': scale_manager,
+        '_symbols': symbols,
+        '_observed_symbols': set(manifest['observed_symbols']),
+        '_queued_heirarchies': queued,
+        '_paused': manifest['paused'],
+        '_last_settled': manifest['last_settled'],
+        '_state_derivative': (np.array(column('state_derivative'))
+                              if manifest['has_state_derivative'] else None)
+    })
+
+    # Pull out the symbolic spatial information items
+    offsets = column('ssi_offsets')
+    poses = column('ssi_poses')
+    ssi_items = [(tag_id, ssi, np.array(poses[offsets[i]:offsets[i + 1]]))
+                 for i, (tag_id, ssi) in enumerate(manifest['ssi'])]
+    return Checkpoint(state, ssi_items, manifest['time'])
+
+
+def _writeColumns(path, layout, ssi_items, sequence):
+    """Writes the columns & manifest of a checkpoint into a directory"""
+    # Masses referenced by constraints are included even if they haven't
+    # made it into the layout yet
+    masses = list(layout._masses)
+    index = {m: i for i, m in enumerate(masses)}
+    for c in layout._constraints:
+        for m in c.masses():
+            if m not in index:
+                index[m] = len(masses)
+                masses.append(m)
+
+    # Parents outside of the table are dropped (they'd be re-added by the
+    # next SSI that mentions them anyway)
+    columns = {
+        'mass_symbol':
+            np.array([layout.internMass(m) for m in masses], np.int32),
+        'mass_kind':
+            np.array([_MASS_KINDS.index(type(m)) for m in masses], np.int8),
+        'mass_pos':
+            np.array([m.pos for m in masses], float).reshape(-1, 2),
+        'mass_vel':
+            np.array([m.vel for m in masses], float).reshape(-1, 2),
+        'mass_level':
+            np.array([m._level for m in masses], np.int32),
+        'mass_parent':
+            np.array([index.get(m._parent, -1) for m in masses], np.int32),
+        'mass_weight':
+            np.array([m._mass for m in masses], float),
+        'constraint_kind':
+            np.array([
+                _CONSTRAINT_KINDS.index(type(c)) for c in layout._constraints
+            ], np.int8),
+        'constraint_masses':
+            np.array([[index[m] for m in c.masses()] + [-1] *
+                      (3 - len(c.masses())) for c in layout._constraints],
+                     np.int32).reshape(-1, 3),
+        'constraint_length':
+            np.array([
+                c._natural_length_unscaled
+                if type(c) == sl.ConstraintDistance else c._natural_length
+                for c in layout._constraints
+            ], float),
+        'constraint_stiffness':
+            np.array([c._stiffness for c in layout._constraints], float),
+        'constraint_source':
+            np.array([c._source for c in layout._constraints], np.int8),
+        'queued_hierarchies':
+            np.array([(k, h[0], h[1])
+                      for k, hs in layout._queued_heirarchies.items()
+                      for h in hs], np.int32).reshape(-1, 3),
+        'ssi_offsets':
+            np.cumsum([0] + [len(i[2]) for i in ssi_items]),
+        'ssi_poses':
+            np.array([p for i in ssi_items for p in i[2]],
+                     float).reshape(-1, 4)
+    }
+    if layout._state_derivative is not None:
+        columns['state_derivative'] = np.asarray(layout._state_derivative)
+    for name, data in columns.items():
+        with open(os.path.join(path, name + '.npy'), 'wb') as f:
+            np.save(f, data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Everything that isn't a numeric column goes in the manifest
+    sm = layout._scale_manager
+    manifest = {
+        'format': CHECKPOINT_FORMAT,
+        'sequence': sequence,
+        'time': time.time(),
+        'symbols': layout._symbols.names(),
+        'layout_masses': list(range(len(layout._masses))),
+        'constraint_ssi_ids': [c._ssi_id for c in layout._constraints],
+        'paused': layout._paused,
+        'last_settled': layout._last_settled,
+        'has_state_derivative': layout._state_derivative is not None,
+        'exploration_factor': sm._exploration_factor,
+        'exploration_step': sm._exploration_step,
+        'scale_observations': [[k, o[0][0], o[0][1], o[1], o[2]]
+                               for k, obs in sm._observations.items()
+                               for o in obs],
+        'scale_sums': [[k[0], k[1]] + v.tolist() for k, v in sm._sums.items()],
+        'observed_symbols': sorted(layout._observed_symbols),
+        'ssi': [[i[0], i[1]] for i in ssi_items]
+    }
+    with open(os.path.join(path, _MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def readCheckpoint(directory, mmap=True):
+    """Reads the newest complete checkpoint in a directory (None if none)
+
+    The numeric columns are memory-mapped (unless mmap is False), so only
+    the data actually used to rebuild the layout is read from disk. The
+    layout state can be adopted by a layout with SpatialLayout.__setstate__.
+    """
+    candidates = _checkpointDirs(directory)
+    try:
+        with open(os.path.join(directory, _LATEST), 'r') as f:
+            latest = os.path.join(directory, f.read().strip())
+        candidates.sort(key=lambda c: c[1] != latest)
+    except (IOError, OSError):
+        pass
+    for _, path in candidates:
+        try:
+            return _readCheckpoint(path, mmap)
+        except (IOError, OSError, ValueError, KeyError, IndexError):
+            continue
+    return None
+
+
+def writeCheckpoint(directory, layout, ssi_items=(), keep=CHECKPOINT_KEEP):
+    """Writes a checkpoint of a layout (& SSI items) to a directory
+
+    SSI items are (tag_id, ssi, poses) tuples, where poses is an (n x 4)
+    array of observed [x, y, cos(th), sin(th)]. Checkpoints are written to
+    a temporary directory & renamed into place, so a crash mid-write always
+    leaves the previous checkpoint intact. Returns the checkpoint's path.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    existing = _checkpointDirs(directory)
+    sequence = existing[0][0] + 1 if existing else 0
+    name = 'checkpoint_%d' % (sequence)
+    path = os.path.join(directory, name)
+    path_tmp = path + '.tmp'
+    if os.path.isdir(path_tmp):
+        shutil.rmtree(path_tmp)
+    os.makedirs(path_tmp)
+    _writeColumns(path_tmp, layout, ssi_items, sequence)
+    os.rename(path_tmp, path)
+
+    # Point at the new checkpoint, then drop the oldest
+    latest_tmp = os.path.join(directory, _LATEST + '.tmp')
+    with open(latest_tmp, 'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(latest_tmp, os.path.join(directory, _LATEST))
+    _fsyncDir(directory)
+    for _, p in existing[max(0, keep - 1):]:
+        shutil.rmtree(p, ignore_errors=True)
+    return path
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+import collections
+import numpy as np
+import time
+
+import abstract_map_lib.spatial_layout as sl
+
+# Default number of layouts integrated together by an ensemble
+ENSEMBLE_SIZE = 64
+
+# Default standard deviation (metres) of the noise added to the starting
+# position of every moving mass
+ENSEMBLE_SPREAD = 1.0
+
+# Default standard deviation of the relative noise applied to the natural
+# length of every distance constraint (how uncertain the SSI is)
+ENSEMBLE_LENGTH_NOISE = 0.1
+
+# Default maximum number of steps (& seconds) to wait for an ensemble to
+# settle
+ENSEMBLE_MAX_STEPS = 2000
+ENSEMBLE_MAX_TIME = 5.0
+
+# Default seed of the perturbations (so an unchanged layout always gives the
+# same estimates)
+ENSEMBLE_SEED = 0
+
+PositionEstimate = collections.namedtuple('PositionEstimate',
+                                          ['mean', 'covariance', 'settled'])
+
+
+class LayoutEnsemble(object):
+    """Perturbed copies of a spatial layout, integrated together as a batch
+
+    The copies share the layout's masses & constraints, with their positions
+    & velocities held in (k x n x 2) arrays, so a step of the whole ensemble
+    costs a handful of vectorised operations. Copies stop being integrated
+    once they have settled. Unlike the layout itself, masses aren't kept a
+    safe distance apart (an ensemble only estimates where masses end up).
+    """
+
+    def __init__(self,
+                 layout,
+                 size=ENSEMBLE_SIZE,
+                 spread=ENSEMBLE_SPREAD,
+                 length_noise=ENSEMBLE_LENGTH_NOISE,
+                 seed=ENSEMBLE_SEED):
+        """Constructs an ensemble of perturbed copies of a layout"""
+        rng = np.random.RandomState(seed)
+        n = len(layout._masses)
+        self._masses = list(layout._masses)
+        self._table = layout._constraintTable()
+        self._coem = None if layout._coem is None else np.array(layout._coem)
+
+        # Moving masses start from a perturbed position, & every copy gets
+        # its own distance constraint lengths
+        moving = self._table.moving
+        self.pos = np.repeat(layout._state[np.newaxis, :n, 0], size, 0)
+        self.pos[:, moving] += spread * rng.standard_normal(
+            (size, np.count_nonzero(moving), 2))
+        self.vel = np.repeat(layout._state[np.newaxis, :n, 1], size, 0)
+        self.dist_length = self._table.dist_length * np.maximum(
+            1 + length_noise * rng.standard_normal(
+                (size, len(self._table.dist_length))), 0)
+
+        self.settled = np.zeros(size, dtype=bool)
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.pos)
+
+    def _stateDerivative(self, y, members):
+        """Computes the derivative of (k x n x 2 x 2) pos & vel states"""
+        d = np.empty_like(y)
+        d[:, :, 0] = y[:, :, 1]
+        d[:, :, 1] = self._table.accelerations(y[:, :, 0], y[:, :, 1],
+                                               self._coem,
+                                               self.dist_length[members])
+        return d
+
+    def estimate(self, name):
+        """Returns the PositionEstimate of a mass (None if it isn't found)
+
+        Estimates are flagged as settled only if every copy has settled.
+        """
+        i = next((i for i, m in enumerate(self._masses) if m.name == name),
+                 None)
+        if i is None:
+            return None
+        ps = self.pos[:, i]
+        return PositionEstimate(np.mean(ps, 0), np.cov(ps, rowvar=False),
+                                self.isSettled())
+
+    def estimates(self):
+        """Returns a PositionEstimate for every mass, keyed by name"""
+        means = np.mean(self.pos, 0)
+        ds = self.pos - means
+        covs = np.einsum('kni,knj->nij', ds, ds) / max(len(self) - 1, 1)
+        settled = self.isSettled()
+        es = {}
+        for i, m in enumerate(self._masses):
+            es.setdefault(m.name, PositionEstimate(means[i], covs[i],
+                                                   settled))
+        return es
+
+    def isSettled(self):
+        """Returns if every copy in the ensemble has settled"""
+        return bool(np.all(self.settled))
+
+    def settle(self, max_steps=ENSEMBLE_MAX_STEPS, max_time=None):
+        """Steps the ensemble until it settles, returning if it did
+
+        Stepping stops early after max_steps steps, or max_time seconds (if
+        given).
+        """
+        t_end = None if max_time is None else time.time() + max_time
+        while (not self.isSettled() and self.steps < max_steps and
+               (t_end is None or time.time() < t_end)):
+            self.step()
+        return self.isSettled()
+
+    def step(self):
+        """Performs a single integration step of every unsettled copy"""
+        members = np.flatnonzero(~self.settled)
+        if not len(members):
+            return
+
+        # Same integration scheme as the layout (RK4 with a fixed step)
+        dt = sl.INTEGRATION_DT
+        y = np.stack((self.pos[members], self.vel[members]), 2)
+        k1 = self._stateDerivative(y, members)
+        k2 = self._stateDerivative(y + 0.5 * dt * k1, members)
+        k3 = self._stateDerivative(y + 0.5 * dt * k2, members)
+        k4 = self._stateDerivative(y + dt * k3, members)
+        y += (1. / 6.) * (k1 + 2 * k2 + 2 * k3 + k4) * dt
+        self.pos[members] = y[:, :, 0]
+        self.vel[members] = y[:, :, 1]
+
+        # Check which copies settled (with the same limits as the layout)
+        d = np.sum(np.square(self._stateDerivative(y, members)), -1)
+        self.settled[members] = (
+            np.all(d[:, :, 0] < sl._SETTLED_VEL_LIMIT2, 1) &
+            np.all(d[:, :, 1] < sl._SETTLED_ACC_LIMIT2, 1))
+        self.steps += 1
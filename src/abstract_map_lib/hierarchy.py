@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+import collections
+import hashlib
+import xml.etree.ElementTree as et
+
+
+class HierarchyNode(object):
+    """A place in a hierarchy, with links to its parent & children"""
+
+    def __init__(self, name, parent=None):
+        """Constructs a node (attaching it to the parent if provided)"""
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.height = 0
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return "HierarchyNode(%r, parent=%r)" % (
+            self.name, None if self.parent is None else self.parent.name)
+
+
+class Hierarchy(object):
+    """Tree of places, indexed by name
+
+    Nodes are kept in document (pre-)order, so every parent appears before
+    its children. Depth (levels below the root) & height (levels above the
+    bottom of the hierarchy) are computed once, as the hierarchy is built.
+    """
+
+    def __init__(self):
+        """Constructs an empty hierarchy"""
+        self._nodes = collections.OrderedDict()
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def __getitem__(self, name):
+        return self._nodes[name]
+
+    def __iter__(self):
+        return iter(self._nodes.values())
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _add(self, name, parent_name=None):
+        """Adds a place (heights must be recomputed once finished adding)"""
+        if name in self._nodes:
+            raise ValueError("Place '%s' appears more than once in hierarchy" %
+                             (name))
+        n = HierarchyNode(
+            name, None if parent_name is None else self._nodes[parent_name])
+        self._nodes[name] = n
+        return n
+
+    def _computeHeights(self):
+        """Computes the height of every node (children before parents)"""
+        for n in reversed(self._nodes.values()):
+            n.height = (0 if not n.children else
+                        1 + max(c.height for c in n.children))
+
+    def digest(self):
+        """Returns a hash of the hierarchy's content (places & structure)"""
+        return hashlib.sha1('\n'.join(
+            '%s\t%s' % e for e in self.edges()).encode('utf-8')).hexdigest()
+
+    def edges(self):
+        """Returns a list of (child, parent) names, in document order"""
+        return [(n.name, n.parent.name)
+                for n in self._nodes.values()
+                if n.parent is not None]
+
+    @staticmethod
+    def fromFile(fn):
+        """Loads a hierarchy from an xml file of nested place elements"""
+        h = Hierarchy()
+        stack = []
+        for event, elem in et.iterparse(fn, events=('start', 'end')):
+            if elem.tag != 'place':
+                continue
+            if event == 'start':
+                stack.append(
+                    h._add(elem.get('name'),
+                           stack[-1].name if stack else None))
+            else:
+                stack.pop()
+                elem.clear()
+        h._computeHeights()
+        return h
+
+    @staticmethod
+    def fromTuples(tuples):
+        """Builds a hierarchy from a list of (name, parent, children) tuples"""
+        # Tuples aren't guaranteed to be in document order, so make sure
+        # parents are always added before their children
+        parents = {t[0]: t[1] for t in tuples}
+        h = Hierarchy()
+        for t in tuples:
+            chain = []
+            name = t[0]
+            while name is not None and name not in h:
+                chain.append(name)
+                name = parents.get(name, None)
+            for name in reversed(chain):
+                h._add(name, parents.get(name, None))
+        h._computeHeights()
+        return h
+
+    def level(self, name):
+        """Returns the level of a place (levels above bottom of hierarchy)"""
+        return self._nodes[name].height
+
+    def roots(self):
+        """Returns the list of nodes without a parent"""
+        return [n for n in self._nodes.values() if n.parent is None]
+
+    def toTuples(self):
+        """Returns the list of (name, parent, children) tuples"""
+        return [(n.name, None if n.parent is None else n.parent.name,
+                 [c.name for c in n.children]) for n in self._nodes.values()]
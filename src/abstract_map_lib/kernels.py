@@ -0,0 +1,218 @@
+from __future__ import absolute_import
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Compiled kernels are only available if Numba is installed (the layout falls
+# back to its NumPy implementation otherwise)
+AVAILABLE = numba is not None
+
+
+def _jit(fn):
+    """Compiles a kernel with Numba (if available), using NumPy error rules"""
+    return fn if numba is None else numba.njit(
+        cache=True, nogil=True, error_model='numpy')(fn)
+
+
+@_jit
+def _angleWrap(angle):
+    """Returns the angle, in the range of [-PI,+PI)"""
+    ret = (angle + math.pi) % (2 * math.pi)
+    if ret < 0:
+        ret += 2 * math.pi
+    return ret - math.pi
+
+
+@_jit
+def _uv(x, y):
+    """Returns the unit vector of (x, y), or [1, 0] if it is zero"""
+    norm = math.hypot(x, y)
+    return (x / norm, y / norm) if norm > 0 else (1., 0.)
+
+
+@_jit
+def accelerations(pos, vel, forces, acc):
+    """Writes the accelerations of masses, from (n x 2) pos & vel, into acc
+
+    Forces is the tuple built by SpatialLayout._kernelForces(), & the
+    accelerations match those of _ConstraintTable.accelerations().
+    """
+    (friction_coefficient, expansion_coefficient, coem, mass, moving,
+     friction, expanding, dist_a, dist_b, dist_length, dist_stiffness,
+     global_a, global_b, global_length, global_stiffness, local_a, local_b,
+     local_c, local_length, local_stiffness) = forces
+
+    # Friction & expansion act on each mass alone
+    for i in range(pos.shape[0]):
+        acc[i, 0] = 0.
+        acc[i, 1] = 0.
+        if friction[i]:
+            acc[i, 0] = -friction_coefficient * vel[i, 0]
+            acc[i, 1] = -friction_coefficient * vel[i, 1]
+        if expanding[i] and coem.shape[0] == 2:
+            ux, uy = _uv(pos[i, 0] - coem[0], pos[i, 1] - coem[1])
+            acc[i, 0] += expansion_coefficient * ux
+            acc[i, 1] += expansion_coefficient * uy
+
+    # Distance constraints pull along, & global angle constraints push across,
+    # the line between their masses
+    for k in range(dist_a.shape[0]):
+        a, b = dist_a[k], dist_b[k]
+        abx, aby = pos[a, 0] - pos[b, 0], pos[a, 1] - pos[b, 1]
+        ux, uy = _uv(abx, aby)
+        f = -dist_stiffness[k] * (math.hypot(abx, aby) - dist_length[k])
+        if moving[a]:
+            acc[a, 0] += f * ux / mass[a]
+            acc[a, 1] += f * uy / mass[a]
+        if moving[b]:
+            acc[b, 0] -= f * ux / mass[b]
+            acc[b, 1] -= f * uy / mass[b]
+    for k in range(global_a.shape[0]):
+        a, b = global_a[k], global_b[k]
+        abx, aby = pos[a, 0] - pos[b, 0], pos[a, 1] - pos[b, 1]
+        ux, uy = _uv(abx, aby)
+        f = -global_stiffness[k] * _angleWrap(
+            math.atan2(aby, abx) - global_length[k])
+        if moving[a]:
+            acc[a, 0] -= f * uy / mass[a]
+            acc[a, 1] += f * ux / mass[a]
+        if moving[b]:
+            acc[b, 0] += f * uy / mass[b]
+            acc[b, 1] -= f * ux / mass[b]
+
+    # Local angle constraints push a & c around b (with b taking the reaction)
+    for k in range(local_a.shape[0]):
+        a, b, c = local_a[k], local_b[k], local_c[k]
+        abx, aby = pos[a, 0] - pos[b, 0], pos[a, 1] - pos[b, 1]
+        cbx, cby = pos[c, 0] - pos[b, 0], pos[c, 1] - pos[b, 1]
+        d = -local_stiffness[k] * _angleWrap(
+            math.atan2(aby, abx) - math.atan2(cby, cbx) - local_length[k])
+        ux, uy = _uv(abx, aby)
+        ax, ay = -d * uy / mass[a], d * ux / mass[a]
+        ux, uy = _uv(cbx, cby)
+        cx, cy = d * uy / mass[c], -d * ux / mass[c]
+        if moving[a]:
+            acc[a, 0] += ax
+            acc[a, 1] += ay
+        if moving[b]:
+            acc[b, 0] -= ax + cx
+            acc[b, 1] -= ay + cy
+        if moving[c]:
+            acc[c, 0] += cx
+            acc[c, 1] += cy
+
+
+@_jit
+def _derivative(y, forces, d):
+    """Writes the derivative of (n x 2 x 2) pos & vel states into d"""
+    d[:, 0] = y[:, 1]
+    accelerations(y[:, 0], y[:, 1], forces, d[:, 1])
+
+
+@_jit
+def integrate(y, dt, forces):
+    """Returns (n x 2 x 2) states after an RK4 step (the layout's scheme)"""
+    k1 = np.empty_like(y)
+    k2 = np.empty_like(y)
+    k3 = np.empty_like(y)
+    k4 = np.empty_like(y)
+    _derivative(y, forces, k1)
+    _derivative(y + dt * 0.5 * k1, forces, k2)
+    _derivative(y + dt * 0.5 * k2, forces, k3)
+    _derivative(y + dt * k3, forces, k4)
+    return y + (1. / 6.) * (k1 + 2 * k2 + 2 * k3 + k4) * dt
+
+
+@_jit
+def _firstCircleIntersect(ax, ay, bx, by, cx, cy, r):
+    """Finds the first point that line from a to b intesecting a circle"""
+    # Same working as spatial_layout._firstCircleIntersect()
+    dx, dy = bx - ax, by - ay
+    use_vertical = abs(dx) < abs(dy)
+    if use_vertical:
+        m = dx / dy
+        c = -m * ay + ax
+        near, far = cx, cy
+    else:
+        m = dy / dx
+        c = -m * ax + ay
+        near, far = cy, cx
+    quad_a = -1 - m**2
+    quad_b = -2 * m * c + 2 * m * near + 2 * far
+    quad_c = -c**2 + r**2 - cx**2 - cy**2 + 2 * c * near
+    discriminant = quad_b**2 - 4 * quad_a * quad_c
+    if discriminant < 0:
+        raise ValueError("Intersection discriminant < 0")
+    root_1 = (-quad_b + discriminant**0.5) / (2 * quad_a)
+    root_2 = (-quad_b - discriminant**0.5) / (2 * quad_a)
+    if use_vertical:
+        x1, y1, x2, y2 = m * root_1 + c, root_1, m * root_2 + c, root_2
+    else:
+        x1, y1, x2, y2 = root_1, m * root_1 + c, root_2, m * root_2 + c
+    if ((x1 - ax)**2 + (y1 - ay)**2)**0.5 < ((x2 - ax)**2 +
+                                             (y2 - ay)**2)**0.5:
+        return x1, y1
+    return x2, y2
+
+
+@_jit
+def _reflectedDirection(vx, vy, px, py, ox, oy, outside):
+    """Gets the direction of reflection from a given point"""
+    vel_ang = math.atan2(vy, vx)
+    tan_ang = _angleWrap(math.atan2(py - oy, px - ox) + math.pi / 2)
+    direction = -1 if outside else 1
+    return _angleWrap(tan_ang + direction * abs(_angleWrap(vel_ang - tan_ang)))
+
+
+@_jit
+def stepSafely(pos, vel, steps, safe_distance):
+    """Steps (n x 2) positions, while keeping masses a safe distance apart
+
+    Masses are stepped in order, bouncing off any mass they would clash with
+    (exactly as SpatialLayout._stepSafely() does), & pos & vel are updated in
+    place. Returns the number of bounces.
+    """
+    n = pos.shape[0]
+    bounces = 0
+    for i in range(n):
+        sx, sy = steps[i, 0], steps[i, 1]
+        if sx == 0 and sy == 0:
+            continue
+        while True:
+            # Find the first clash (see SpatialLayout._stepSafely())
+            dx, dy = pos[i, 0] + sx, pos[i, 1] + sy
+            j = -1
+            for k in range(n):
+                d = ((dx - pos[k, 0])**2 + (dy - pos[k, 1])**2)**0.5
+                if k != i and d < safe_distance * 0.99:
+                    j = k
+                    break
+            if j < 0:
+                break
+
+            # Bounce off the clashing mass, & reduce the step
+            ix, iy = _firstCircleIntersect(pos[i, 0], pos[i, 1], dx, dy,
+                                           pos[j, 0], pos[j, 1],
+                                           safe_distance)
+            th_i = _reflectedDirection(vel[i, 0], vel[i, 1], ix, iy, pos[j, 0],
+                                       pos[j, 1], True)
+            th_j = _reflectedDirection(vel[j, 0], vel[j, 1], ix, iy, pos[j, 0],
+                                       pos[j, 1], False)
+            r = ((sx**2 + sy**2)**0.5 - ((ix - pos[i, 0])**2 +
+                                         (iy - pos[i, 1])**2)**0.5)
+            bx, by = ix + r * math.cos(th_i), iy + r * math.sin(th_i)
+            v = (vel[i, 0]**2 + vel[i, 1]**2)**0.5
+            vel[i, 0], vel[i, 1] = v * math.cos(th_i), v * math.sin(th_i)
+            v = (vel[j, 0]**2 + vel[j, 1]**2)**0.5
+            vel[j, 0], vel[j, 1] = v * math.cos(th_j), v * math.sin(th_j)
+            pos[i, 0], pos[i, 1] = ix, iy
+            sx, sy = bx - ix, by - iy
+            bounces += 1
+
+        pos[i, 0] += sx
+        pos[i, 1] += sy
+    return bounces
@@ -0,0 +1,260 @@
+from __future__ import absolute_import
+import collections
+import math
+import numpy as np
+import struct
+import threading
+
+# Occupancy values in [0, FREE_THRESHOLD] are considered explored free space
+FREE_THRESHOLD = 50
+
+# Size (in cells) of the square tiles used for incremental updates
+EXPLORED_TILE_SIZE = 64
+
+# Number of levels in an occupancy pyramid (each halving the resolution), &
+# size (in cells of a level) of the square tiles changes are tracked by
+PYRAMID_LEVELS = 6
+PYRAMID_TILE_SIZE = 256
+
+OccupancyGridInfo = collections.namedtuple(
+    'OccupancyGridInfo',
+    ['resolution', 'width', 'height', 'origin_x', 'origin_y', 'origin_th'])
+
+OccupancyGridUpdate = collections.namedtuple('OccupancyGridUpdate',
+                                             ['x', 'y', 'width', 'height'])
+
+
+def _skipHeader(buff):
+    """Returns the offset of the first byte after a serialised Header"""
+    frame_id_length = struct.unpack_from('<I', buff, 12)[0]
+    return 16 + frame_id_length
+
+
+def occupancyGridFromBuffer(buff):
+    """Parses a serialised nav_msgs/OccupancyGrid, without copying the data
+
+    Returns a tuple of OccupancyGridInfo, and a read-only (height x width)
+    int8 array that is a view of the buffer.
+    """
+    o = _skipHeader(buff) + 8  # Header & map_load_time
+    resolution, width, height = struct.unpack_from('<f2I', buff, o)
+    o += 12
+    x, y, _, qx, qy, qz, qw = struct.unpack_from('<7d', buff, o)
+    o += 56
+    n = struct.unpack_from('<I', buff, o)[0]
+    o += 4
+    th = math.atan2(2 * (qw * qz + qx * qy), 1 - 2 * (qy**2 + qz**2))
+    return (OccupancyGridInfo(resolution, width, height, x, y, th),
+            np.frombuffer(buff, dtype=np.int8, count=n,
+                          offset=o).reshape(height, width))
+
+
+def occupancyGridUpdateFromBuffer(buff):
+    """Parses a serialised map_msgs/OccupancyGridUpdate, without copying
+
+    Returns a tuple of OccupancyGridUpdate, and a read-only (height x width)
+    int8 array that is a view of the buffer.
+    """
+    o = _skipHeader(buff)
+    x, y, width, height, n = struct.unpack_from('<2i3I', buff, o)
+    o += 20
+    return (OccupancyGridUpdate(x, y, width, height),
+            np.frombuffer(buff, dtype=np.int8, count=n,
+                          offset=o).reshape(height, width))
+
+
+class ExploredMass(object):
+    """Centre of explored (free space) mass of an occupancy grid
+
+    The free space moments are stored per tile, so only tiles that changed
+    between maps (or that are covered by a map update) are recomputed. Maps &
+    map updates can be given from different threads.
+    """
+
+    def __init__(self, tile_size=EXPLORED_TILE_SIZE):
+        """Constructs a tracker with no map"""
+        self._tile = tile_size
+        self._lock = threading.Lock()
+
+        self._grid = None
+        self._info = None
+        self._moments = None  # (tiles_y, tiles_x, [m00, m10, m01])
+
+        self.centre = None
+
+    def _recomputeAll(self):
+        """Recomputes the moments of every tile (vectorised)"""
+        free = ((self._grid >= 0) &
+                (self._grid <= FREE_THRESHOLD)).astype(np.float64)
+        h, w = free.shape
+        rows = np.arange(0, h, self._tile)
+        cols = np.arange(0, w, self._tile)
+
+        def tileSums(a):
+            return np.add.reduceat(np.add.reduceat(a, rows, axis=0),
+                                   cols,
+                                   axis=1)
+
+        self._moments = np.dstack(
+            (tileSums(free), tileSums(free * np.arange(w)[np.newaxis, :]),
+             tileSums(free * np.arange(h)[:, np.newaxis])))
+
+    def _recomputeTiles(self, tiles):
+        """Recomputes the moments of a list of (row, column) tiles"""
+        t = self._tile
+        for ty, tx in tiles:
+            block = self._grid[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+            ys, xs = np.nonzero((block >= 0) & (block <= FREE_THRESHOLD))
+            self._moments[ty, tx] = (len(xs), np.sum(xs) + tx * t * len(xs),
+                                     np.sum(ys) + ty * t * len(ys))
+
+    def _updateCentre(self):
+        """Recomputes the centre of explored mass from the tile moments"""
+        m00, m10, m01 = np.sum(self._moments, (0, 1))
+        self.centre = (None if m00 == 0 else np.array([
+            self._info.origin_x, self._info.origin_y
+        ]) + self._info.resolution * np.array([m10, m01]) / m00)
+
+    def updateMap(self, info, data):
+        """Updates the tracker with a complete map"""
+        with self._lock:
+            if self._grid is None or data.shape != self._grid.shape:
+                self._grid = np.array(data, dtype=np.int8)
+                self._recomputeAll()
+            else:
+                ys, xs = np.nonzero(data != self._grid)
+                np.copyto(self._grid, data)
+                tiles = set(zip(ys // self._tile, xs // self._tile))
+                self._recomputeTiles(tiles)
+            self._info = info
+            self._updateCentre()
+
+    def updateRegion(self, update, data):
+        """Updates the tracker with a partial map update
+
+        Returns False (ignoring the update) if it doesn't fit in the current
+        map, e.g. because it was meant for a map that has since been resized.
+        """
+        with self._lock:
+            if self._grid is None or not _fitsGrid(update, data, self._grid):
+                return False
+            self._grid[update.y:update.y + update.height,
+                       update.x:update.x + update.width] = data
+            t = self._tile
+            self._recomputeTiles([
+                (ty, tx) for ty in range(update.y // t,
+                                         (update.y + update.height - 1) // t +
+                                         1)
+                for tx in range(update.x // t, (update.x + update.width - 1) //
+                                t + 1)
+            ])
+            self._updateCentre()
+            return True
+
+
+class OccupancyPyramid(object):
+    """Multi-resolution copies of an occupancy grid, for drawing at any zoom
+
+    Each cell of level k covers (2^k x 2^k) cells of the grid, holding the
+    maximum of the cells it covers (so obstacles never disappear). Level 0 is
+    the grid itself, which stays a view of the parsed message until a partial
+    update has to be written into it. Tiles of each level that change are
+    recorded, so a drawer only has to redraw those tiles.
+    """
+
+    def __init__(self, levels=PYRAMID_LEVELS, tile_size=PYRAMID_TILE_SIZE):
+        """Constructs a pyramid with no map"""
+        self._num_levels = levels
+        self._tile = tile_size
+
+        self.info = None
+        self.levels = []
+        self.dirty = set()  # (level, tile row, tile column) changed
+        self.version = 0  # Bumped whenever the levels are rebuilt entirely
+
+    def _markDirty(self, k, y0, y1, x0, x1):
+        """Marks the tiles covering a region of a level as changed"""
+        t = self._tile
+        self.dirty.update((k, ty, tx)
+                          for ty in range(y0 // t, (y1 - 1) // t + 1)
+                          for tx in range(x0 // t, (x1 - 1) // t + 1))
+
+    def _propagate(self, y0, y1, x0, x1):
+        """Rebuilds the levels above a changed region of level 0"""
+        self._markDirty(0, y0, y1, x0, x1)
+        for k in range(1, len(self.levels)):
+            y0, y1, x0, x1 = y0 // 2, (y1 + 1) // 2, x0 // 2, (x1 + 1) // 2
+            self.levels[k][y0:y1, x0:x1] = _maxPool2(
+                self.levels[k - 1][2 * y0:2 * y1, 2 * x0:2 * x1])
+            self._markDirty(k, y0, y1, x0, x1)
+
+    def levelForScale(self, pixels_per_metre):
+        """Returns the coarsest level with at least a cell per pixel"""
+        if not self.levels:
+            return 0
+        cells_per_pixel = 1.0 / (pixels_per_metre * self.info.resolution)
+        return int(
+            min(max(np.floor(np.log2(max(cells_per_pixel, 1))), 0),
+                len(self.levels) - 1))
+
+    def takeDirty(self):
+        """Returns the set of changed tiles, & starts tracking afresh"""
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def tileSize(self):
+        """Returns the size (in cells of a level) of a tile"""
+        return self._tile
+
+    def updateMap(self, info, data):
+        """Updates the pyramid with a complete map (keeps a view of data)"""
+        if (not self.levels or data.shape != self.levels[0].shape or
+                info != self.info):
+            self.levels = [data]
+            while (len(self.levels) < self._num_levels and
+                   max(self.levels[-1].shape) > 1):
+                self.levels.append(_maxPool2(self.levels[-1]))
+            self.version += 1
+            self.dirty = set()
+        else:
+            ys, xs = np.nonzero(data != self.levels[0])
+            self.levels[0] = data
+            t = self._tile
+            for ty, tx in set(zip(ys // t, xs // t)):
+                self._propagate(ty * t, min((ty + 1) * t, data.shape[0]),
+                                tx * t, min((tx + 1) * t, data.shape[1]))
+        self.info = info
+
+    def updateRegion(self, update, data):
+        """Updates the pyramid with a partial map update
+
+        Returns False (ignoring the update) if it doesn't fit in level 0.
+        """
+        if not self.levels or not _fitsGrid(update, data, self.levels[0]):
+            return False
+        if not self.levels[0].flags.writeable:
+            self.levels[0] = np.array(self.levels[0])
+        self.levels[0][update.y:update.y + update.height,
+                       update.x:update.x + update.width] = data
+        self._propagate(update.y, update.y + update.height, update.x,
+                        update.x + update.width)
+        return True
+
+
+def _fitsGrid(update, data, grid):
+    """Returns if a map update (& its data) fits within a grid"""
+    return (update.x >= 0 and update.y >= 0 and
+            data.shape == (update.height, update.width) and
+            update.y + update.height <= grid.shape[0] and
+            update.x + update.width <= grid.shape[1])
+
+
+def _maxPool2(a):
+    """Halves the resolution of a grid, keeping the max of each 2 x 2 block"""
+    h, w = a.shape
+    if h % 2 or w % 2:
+        padded = np.full((h + h % 2, w + w % 2), -1, dtype=a.dtype)
+        padded[:h, :w] = a
+        a = padded
+    return a.reshape(a.shape[0] // 2, 2, a.shape[1] // 2, 2).max(axis=(1, 3))
@@ -0,0 +1,268 @@
+from __future__ import absolute_import
+import collections
+import json
+import math
+import time
+
+# Default histogram configuration (8 bins per decade, from 1us to 10s)
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_MAX = 10.0
+HISTOGRAM_BINS = 56
+
+# Default number of summaries kept by an in-memory sink
+MEMORY_SINK_LENGTH = 100
+
+
+class Histogram(object):
+    """Fixed memory histogram, with logarithmically spaced bins"""
+
+    def __init__(self, lo=HISTOGRAM_MIN, hi=HISTOGRAM_MAX,
+                 bins=HISTOGRAM_BINS):
+        """Constructs an empty histogram covering the range [lo, hi)"""
+        self._lo = lo
+        self._log_lo = math.log(lo)
+        self._scale = bins / (math.log(hi) - self._log_lo)
+        self._bins = bins
+
+        # First and last bins catch underflow and overflow respectively
+        self.counts = [0] * (bins + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def _edge(self, i):
+        """Returns the upper edge of bin i"""
+        return math.exp(self._log_lo + i / self._scale)
+
+    def add(self, value):
+        """Adds a value to the histogram"""
+        i = (0 if value < self._lo else min(
+            self._bins + 1,
+            int((math.log(value) - self._log_lo) * self._scale) + 1))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Returns an estimate (bin upper edge) of the p'th percentile"""
+        if not self.count:
+            return None
+        target = p / 100.0 * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target:
+                return min(self.max, max(self.min, self._edge(i)))
+        return self.max
+
+    def summary(self):
+        """Returns a dict summarising the values in the histogram"""
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+
+class JsonLinesSink(object):
+    """Sink writing each summary as a line of JSON to a file"""
+
+    def __init__(self, filename):
+        """Opens the requested file for appending"""
+        self._file = open(filename, 'a')
+
+    def close(self):
+        """Closes the underlying file"""
+        self._file.close()
+
+    def write(self, summary):
+        """Writes a summary as a single line"""
+        self._file.write(json.dumps(summary, sort_keys=True) + '\n')
+        self._file.flush()
+
+
+class LogSink(object):
+    """Sink passing a readable summary to a logging function"""
+
+    def __init__(self, log_fn=None):
+        """Attaches to a logging function (rospy.loginfo if not provided)"""
+        if log_fn is None:
+            import rospy
+            log_fn = rospy.loginfo
+        self._log_fn = log_fn
+
+    def close(self):
+        pass
+
+    def write(self, summary):
+        """Logs a summary, one line per timer"""
+        lines = ["Spatial layout profile (%.1fs):" % (summary['period'])]
+        lines.extend([
+            "\t%s: %d calls, mean %.3fms, p95 %.3fms, max %.3fms" %
+            (k, v['count'], 1e3 * v['mean'], 1e3 * v['p95'], 1e3 * v['max'])
+            for k, v in sorted(summary['timers'].items())
+            if v['count']
+        ])
+        lines.extend([
+            "\t%s: %d" % (k, v)
+            for k, v in sorted(summary['counters'].items())
+        ])
+        self._log_fn('\n'.join(lines))
+
+
+class MemorySink(object):
+    """Sink keeping the most recent summaries in memory"""
+
+    def __init__(self, length=MEMORY_SINK_LENGTH):
+        """Constructs a sink which keeps a bounded number of summaries"""
+        self.summaries = collections.deque(maxlen=length)
+
+    def close(self):
+        pass
+
+    def write(self, summary):
+        """Stores a summary"""
+        self.summaries.append(summary)
+
+
+class Profiler(object):
+    """Named timers, histograms, & counters for profiling a spatial layout"""
+    enabled = True
+
+    def __init__(self, sink=None, period=None):
+        """Constructs a profiler, flushing to sink every period seconds"""
+        self._sink = MemorySink() if sink is None else sink
+        self._period = period
+
+        self._timers = {}
+        self._counters = {}
+        self._last_flush = time.time()
+
+    def close(self):
+        """Flushes any remaining data, and closes the sink"""
+        self.flush()
+        self._sink.close()
+
+    def count(self, name, n=1):
+        """Increments a named counter"""
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def flush(self):
+        """Writes a summary to the sink, and starts a new period"""
+        self._sink.write(self.summary())
+        self.reset()
+
+    def record(self, name, duration):
+        """Records a duration against a named timer"""
+        h = self._timers.get(name, None)
+        if h is None:
+            h = self._timers[name] = Histogram()
+        h.add(duration)
+
+    def reset(self):
+        """Resets all timers and counters"""
+        self._timers = {}
+        self._counters = {}
+        self._last_flush = time.time()
+
+    def summary(self):
+        """Returns a dict summarising the current period"""
+        return {
+            'time': time.time(),
+            'period': time.time() - self._last_flush,
+            'timers': {k: v.summary() for k, v in self._timers.items()},
+            'counters': dict(self._counters)
+        }
+
+    def tick(self):
+        """Flushes if the configured period has elapsed"""
+        if (self._period is not None and
+                time.time() - self._last_flush >= self._period):
+            self.flush()
+
+    def timer(self, name):
+        """Returns a context manager timing against a named timer"""
+        return _Timer(self, name)
+
+
+class _NullProfiler(object):
+    """Profiler that does nothing (used when profiling is disabled)"""
+    enabled = False
+
+    def close(self):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def flush(self):
+        pass
+
+    def record(self, name, duration):
+        pass
+
+    def reset(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def tick(self):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+
+class _NullTimer(object):
+    """Context manager that does nothing"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class _Timer(object):
+    """Context manager recording its duration against a profiler's timer"""
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._profiler.record(self._name, time.time() - self._start)
+
+
+_NULL_TIMER = _NullTimer()
+
+NULL_PROFILER = _NullProfiler()
+
+
+def profilerFromConfig(config, period=None):
+    """Builds a profiler from a config string ('', 'log', 'memory', or file)"""
+    if not config:
+        return NULL_PROFILER
+    elif config == 'log':
+        return Profiler(LogSink(), period=period)
+    elif config == 'memory':
+        return Profiler(MemorySink(), period=period)
+    else:
+        return Profiler(JsonLinesSink(config), period=period)
@@ -0,0 +1,34 @@
+import tf_conversions
+
+import geometry_msgs.msg as geometry_msgs
+
+
+def poseMsgToXYTh(msg):
+    """Returns a tuple with 2D x, y, th from a ROS pose msg"""
+    return (msg.position.x, msg.position.y,
+            quaternionMsgToYaw(msg.orientation))
+
+
+def quaternionMsgToTuple(msg):
+    """Helper function for converting a quaternion msg to a tuple"""
+    return (msg.x, msg.y, msg.z, msg.w)
+
+
+def quaternionMsgToYaw(msg):
+    """Helper function for getting the yaw angle from a quaternion msg"""
+    r, p, y = tf_conversions.transformations.euler_from_quaternion(
+        quaternionMsgToTuple(msg))
+    return y
+
+
+def xythToPoseMsg(x, y, th):
+    return geometry_msgs.Pose(position=geometry_msgs.Point(x, y, 0),
+                              orientation=yawToQuaternionMsg(th))
+
+
+def yawToQuaternionMsg(yaw):
+    return geometry_msgs.Quaternion(*yawToTuple(yaw))
+
+
+def yawToTuple(yaw):
+    return tf_conversions.transformations.quaternion_from_euler(0, 0, yaw)
@@ -1,17 +1,15 @@
 from __future__ import absolute_import
 import abc
 import collections
-import itertools
+import contextlib
 import numpy as np
-import os.path
 import random
-import scipy.integrate as ig
-import scipy.linalg as la
-import scipy.spatial as sp
 import sys
 import time
 import warnings
 
+import abstract_map_lib.kernels as kernels
+import abstract_map_lib.profiling as profiling
 import abstract_map_lib.tools as tools
 
 warnings.filterwarnings('ignore', '.*GUI is implemented')
@@ -36,6 +34,9 @@ INTEGRATION_DT = 0.1
 SAFE_DISTANCE = 0.2
 EXPLORATION_STEP = 0.25
 
+# Distance masses can move before a cached convex hull must be rebuilt
+HULL_TOLERANCE = 0.1
+
 STIFF_XL = 2.5
 STIFF_L = 1
 STIFF_M = 0.5
@@ -47,9 +48,24 @@ DIR_ZERO = 0
 MASS_LEVEL_LABEL = 0
 MASS_LEVEL_SIGN = -1
 
+# Maximum number of samples held by an energy log
+ENERGY_LOG_CAPACITY = 10000
+
+# Minimum number of moving masses in an independent part of a layout for it
+# to be integrated by a process pool (if the layout has one)
+PARALLEL_COMPONENT_SIZE = 200
+
+# Record of a placement suggestion: the symbol & layout index of the mass the
+# suggestion is relative to, then a suggested distance & angle from that mass
+# with their weights (a part that isn't suggested is NaN, with 0 weight)
+PLACEMENT_DTYPE = np.dtype([('symbol', np.int64), ('index', np.intp),
+                            ('r', float), ('r_weight', float), ('th', float),
+                            ('th_weight', float)])
+
 
 class _Energised(ABC):
     """Abstraction for an inhereting class to denote it contains energy"""
+    __slots__ = ()
 
     @abc.abstractmethod
     def totalEnergy(self):
@@ -57,24 +73,431 @@ class _Energised(ABC):
 
 
 class EnergyLog(object):
-    """Log of the energy within a layout system"""
+    """Bounded log of the energy within a layout system
 
-    def __init__(self):
+    Samples are held in a fixed capacity ring buffer. When the buffer is full
+    either the oldest half of the log is decimated (keeping every second
+    sample), or if decimation is disabled the oldest sample is dropped.
+    """
+
+    def __init__(self, capacity=ENERGY_LOG_CAPACITY, decimate=True):
         """Initialise the empty logs"""
+        self._capacity = capacity
+        self._decimate = decimate
         self.reset()
 
+    def __getstate__(self):
+        """Gets the pickle friendly state of the object (only used samples)"""
+        obj_dict = self.__dict__.copy()
+        obj_dict['_data'] = self._ordered()
+        obj_dict['_start'] = 0
+        return obj_dict
+
+    def __len__(self):
+        return self._length
+
+    def __setstate__(self, state):
+        """Restores state, accepting logs pickled from the old list format"""
+        if '_data' not in state:
+            data = np.column_stack((state['t'], state['kinetic'],
+                                    state['potential']))
+            state = {
+                '_capacity': max(ENERGY_LOG_CAPACITY, len(data)),
+                '_decimate': True,
+                '_data': data.reshape(-1, 3),
+                '_start': 0
+            }
+        self.__dict__.update(state)
+        self._length = len(self._data)
+        data = np.empty((self._capacity, 3))
+        data[:self._length] = self._data
+        self._data = data
+
+    @property
+    def kinetic(self):
+        """Array of logged kinetic energies (oldest first)"""
+        return self._ordered()[:, 1]
+
+    @property
+    def potential(self):
+        """Array of logged potential energies (oldest first)"""
+        return self._ordered()[:, 2]
+
+    @property
+    def t(self):
+        """Array of logged times (oldest first)"""
+        return self._ordered()[:, 0]
+
+    def _ordered(self):
+        """Returns the used samples of the buffer, oldest first"""
+        return np.take(self._data,
+                       np.arange(self._start, self._start + self._length),
+                       axis=0,
+                       mode='wrap')
+
     def logEnergy(self, layout):
         """Logs the current energy in the spatial layout object"""
-        self.t.append(layout._ode.t)
-        self.kinetic.append(sum([m.totalEnergy() for m in layout._masses]))
-        self.potential.append(
-            sum([c.totalEnergy() for c in layout._constraints]))
+        kinetic, potential = layout.energy()
+        self.logSample(layout._ode.t, kinetic, potential)
+
+    def latest(self):
+        """Returns the newest (t, kinetic, potential) sample (None if empty)"""
+        if not self._length:
+            return None
+        return tuple(self._data[(self._start + self._length - 1) %
+                                self._capacity])
+
+    def logSample(self, t, kinetic, potential):
+        """Logs a single sample, making room in the buffer if necessary"""
+        if self._length == self._capacity:
+            if self._decimate:
+                ordered = self._ordered()
+                half = self._capacity // 2
+                old = ordered[:half:2]
+                self._data[:len(old)] = old
+                self._data[len(old):len(old) + self._capacity -
+                           half] = ordered[half:]
+                self._start = 0
+                self._length = len(old) + self._capacity - half
+            else:
+                self._start = (self._start + 1) % self._capacity
+                self._length -= 1
+        self._data[(self._start + self._length) % self._capacity] = (
+            t, kinetic, potential)
+        self._length += 1
 
     def reset(self):
         """Resets the log"""
-        self.t = []
-        self.kinetic = []
-        self.potential = []
+        self._data = np.empty((self._capacity, 3))
+        self._start = 0
+        self._length = 0
+
+
+class _HullCache(object):
+    """Convex hull & centroid of mass positions, updated incrementally"""
+
+    def __init__(self, positions, state_version=None):
+        """Builds the hull from the (n x 2) array of mass positions"""
+        self.state_version = state_version
+        self.positions = np.array(positions, dtype=float)
+        self.total = np.sum(self.positions, 0)
+        self.vertices = _convexHull(self.positions)
+
+    @property
+    def centroid(self):
+        """Returns the centroid (mean position) of all masses"""
+        return self.total / len(self.positions)
+
+    def add(self, pos):
+        """Adds a new mass position (only hull vertices are reconsidered)"""
+        candidates = np.append(self.vertices, len(self.positions))
+        self.positions = np.vstack((self.positions, pos))
+        self.total = self.total + pos
+        self.vertices = candidates[_convexHull(self.positions[candidates])]
+
+    def isValid(self, positions):
+        """Checks no mass has moved further than tolerance since the build"""
+        if len(positions) != len(self.positions):
+            return False
+        d = positions - self.positions
+        return np.max(np.sum(np.square(d), 1)) <= HULL_TOLERANCE**2
+
+    def refresh(self, positions, state_version):
+        """Refreshes centroid & vertex positions without changing the hull"""
+        self.state_version = state_version
+        self.positions = np.array(positions, dtype=float)
+        self.total = np.sum(self.positions, 0)
+
+
+class SymbolTable(object):
+    """Interns toponym names as dense integer IDs (in order of first use)"""
+
+    def __init__(self, names=()):
+        """Constructs a table, interning any provided names"""
+        self._names = []
+        self._ids = {}
+        for n in names:
+            self.intern(n)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __getstate__(self):
+        """Gets the pickle friendly state of the object (just the names)"""
+        return {'names': self._names}
+
+    def __len__(self):
+        return len(self._names)
+
+    def __setstate__(self, state):
+        """Restores the table from its list of names"""
+        self.__init__(state['names'])
+
+    def get(self, name, default=None):
+        """Returns the ID of a name, or default if it isn't interned"""
+        return self._ids.get(name, default)
+
+    def intern(self, name):
+        """Returns the ID of a name, adding it to the table if it is new"""
+        symbol = self._ids.get(name, None)
+        if symbol is None:
+            symbol = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return symbol
+
+    def name(self, symbol):
+        """Returns the (canonical) name for an ID"""
+        return self._names[symbol]
+
+    def names(self):
+        """Returns the list of names, indexed by ID"""
+        return list(self._names)
+
+
+class _Batch(object):
+    """New masses, & deferred work, collected during a bulk insertion"""
+
+    def __init__(self, place=True):
+        """Constructs an empty batch (place controls placing new masses)"""
+        self.place = place
+        self.masses = []  # New masses, in the order they arrived
+        self.symbols = {}  # New masses by symbol ID
+        self.hierarchy = []  # Hierarchy hints received during the batch
+        self.observed = {}  # Positions labels observed places at
+        self.state_changed = False
+
+        self._pending = set()
+
+    def addMass(self, m):
+        """Adds a new mass to the batch (only if it is new)"""
+        if m not in self._pending:
+            self._pending.add(m)
+            self.masses.append(m)
+            self.symbols.setdefault(m._symbol, m)
+
+
+class _ConstraintTable(object):
+    """Array representation of a layout's constraints, indexed by mass"""
+
+    def __init__(self, masses, constraints, scale_version=None):
+        """Builds the table from a list of masses & constraints"""
+        self.scale_version = scale_version
+        index = {m: i for i, m in enumerate(masses)}
+        self.mass = np.array([m._mass for m in masses], dtype=float)
+        self.moving = np.array([not m.fixed for m in masses], dtype=bool)
+        self.friction = np.array([isinstance(m, Mass) for m in masses],
+                                 dtype=bool)
+        self.expanding = np.array([
+            isinstance(m, Mass) and m._level == MASS_LEVEL_LABEL + 1
+            for m in masses
+        ],
+                                  dtype=bool)
+
+        # Only constraints with all of their masses in the layout are included
+        ds, gs, ls = [], [], []
+        for c in constraints:
+            ms = c.masses()
+            if not all(m in index for m in ms):
+                continue
+            t = type(c)
+            if t == ConstraintDistance:
+                ds.append([index[ms[0]], index[ms[1]]] +
+                          [c._natural_length, c._stiffness])
+            elif t == ConstraintAngleGlobal:
+                gs.append([index[ms[0]], index[ms[1]]] +
+                          [c._natural_length, c._stiffness])
+            elif t == ConstraintAngleLocal:
+                ls.append([index[m] for m in ms] +
+                          [c._natural_length, c._stiffness])
+        ds = np.array(ds, dtype=float).reshape(-1, 4)
+        gs = np.array(gs, dtype=float).reshape(-1, 4)
+        ls = np.array(ls, dtype=float).reshape(-1, 5)
+
+        self.dist_a, self.dist_b = ds[:, 0:2].astype(int).T
+        self.dist_length, self.dist_stiffness = ds[:, 2], ds[:, 3]
+        self.global_a, self.global_b = gs[:, 0:2].astype(int).T
+        self.global_length, self.global_stiffness = gs[:, 2], gs[:, 3]
+        self.local_a, self.local_b, self.local_c = ls[:, 0:3].astype(int).T
+        self.local_length, self.local_stiffness = ls[:, 3], ls[:, 4]
+        self._indexForces()
+
+    def _indexForces(self):
+        """Indexes the masses that each constraint force is applied to"""
+        # The scale is applied to each force, so masses that can't move get
+        # nothing
+        self._components = None
+        self._force_index = np.concatenate(
+            (self.dist_a, self.dist_b, self.global_a, self.global_b,
+             self.local_a, self.local_b, self.local_c))
+        self._force_scale = self.moving[self._force_index] / np.concatenate(
+            (self.mass[self.dist_a], self.mass[self.dist_b],
+             self.mass[self.global_a], self.mass[self.global_b],
+             np.ones(3 * len(self.local_a))))
+
+    def accelerations(self, pos, vel, coem=None, dist_length=None):
+        """Returns accelerations of masses, from (... x n x 2) pos & vel
+
+        The forces match those the masses & constraints apply themselves, but
+        any number of leading (batch) dimensions are handled at once. Lengths
+        of distance constraints can be replaced by (... x d) dist_length.
+        """
+        acc = np.zeros_like(pos)
+        acc[..., self.friction, :] = (-FRICTION_COEFFICIENT *
+                                      vel[..., self.friction, :])
+        if coem is not None:
+            acc[..., self.expanding, :] += EXPANSION_COEFFICIENT * _uvArray(
+                pos[..., self.expanding, :] - coem)
+
+        ab = pos[..., self.dist_a, :] - pos[..., self.dist_b, :]
+        d = np.hypot(ab[..., 0], ab[..., 1]) - (
+            self.dist_length if dist_length is None else dist_length)
+        f_dist = (-self.dist_stiffness * d)[..., np.newaxis] * _uvArray(ab)
+
+        ab = pos[..., self.global_a, :] - pos[..., self.global_b, :]
+        d = _angleWrapArray(
+            np.arctan2(ab[..., 1], ab[..., 0]) - self.global_length)
+        f_global = ((-self.global_stiffness * d)[..., np.newaxis] *
+                    _orthogArray(_uvArray(ab)))
+
+        ab = pos[..., self.local_a, :] - pos[..., self.local_b, :]
+        cb = pos[..., self.local_c, :] - pos[..., self.local_b, :]
+        d = (-self.local_stiffness * _angleWrapArray(
+            np.arctan2(ab[..., 1], ab[..., 0]) -
+            np.arctan2(cb[..., 1], cb[..., 0]) -
+            self.local_length))[..., np.newaxis]
+        acc_a = (d * _orthogArray(_uvArray(ab)) /
+                 self.mass[self.local_a][:, np.newaxis])
+        acc_c = (-d * _orthogArray(_uvArray(cb)) /
+                 self.mass[self.local_c][:, np.newaxis])
+
+        return acc + _scatterAdd(
+            self._force_index,
+            np.concatenate((f_dist, -f_dist, f_global, -f_global, acc_a,
+                            -acc_a - acc_c, acc_c),
+                           axis=-2) * self._force_scale[:, np.newaxis],
+            pos.shape[-2])
+
+    def components(self):
+        """Returns the rows of each independent part of the layout
+
+        Parts are the connected groups of moving masses, as fixed masses
+        don't pass forces between their constraints. The rows of a part also
+        include the fixed masses it is constrained to, & parts are listed
+        largest first.
+        """
+        if self._components is not None:
+            return self._components
+        pairs = np.concatenate(
+            (np.stack((self.dist_a, self.dist_b), 1),
+             np.stack((self.global_a, self.global_b), 1),
+             np.stack((self.local_a, self.local_b), 1),
+             np.stack((self.local_b, self.local_c), 1),
+             np.stack((self.local_a, self.local_c), 1))).astype(int)
+        moving = self.moving[pairs]
+
+        # Label each moving mass with the smallest row it is connected to
+        labels = np.arange(len(self.mass))
+        linked = pairs[moving[:, 0] & moving[:, 1]]
+        while True:
+            new = np.copy(labels)
+            np.minimum.at(new, linked[:, 0], labels[linked[:, 1]])
+            np.minimum.at(new, linked[:, 1], labels[linked[:, 0]])
+            new = new[new]
+            if np.array_equal(new, labels):
+                break
+            labels = new
+
+        # Each part is its moving masses, plus its fixed neighbours
+        rows = {l: [np.flatnonzero(self.moving & (labels == l))]
+                for l in np.unique(labels[self.moving])}
+        edges = pairs[moving[:, 0] != moving[:, 1]]
+        edges = np.where(self.moving[edges[:, 0]][:, np.newaxis], edges,
+                         edges[:, ::-1])
+        for l, f in set(zip(labels[edges[:, 0]], edges[:, 1])):
+            rows[l].append([f])
+        self._components = sorted(
+            [np.unique(np.concatenate(r)) for r in rows.values()],
+            key=lambda r: -len(r))
+        return self._components
+
+    def displacements(self, pos):
+        """Returns displacements for distance, global, & local constraints"""
+        ab = pos[self.dist_a] - pos[self.dist_b]
+        d_dist = np.hypot(ab[:, 0], ab[:, 1]) - self.dist_length
+
+        ab = pos[self.global_a] - pos[self.global_b]
+        d_global = _angleWrapArray(
+            np.arctan2(ab[:, 1], ab[:, 0]) - self.global_length)
+
+        ab = pos[self.local_a] - pos[self.local_b]
+        cb = pos[self.local_c] - pos[self.local_b]
+        d_local = _angleWrapArray(
+            np.arctan2(ab[:, 1], ab[:, 0]) - np.arctan2(cb[:, 1], cb[:, 0]) -
+            self.local_length)
+        return d_dist, d_global, d_local
+
+    def kineticEnergy(self, vel):
+        """Returns the total kinetic energy held by the moving masses"""
+        return 0.5 * np.sum(self.mass[self.moving] *
+                            np.sum(np.square(vel[self.moving]), 1))
+
+    def potentialEnergy(self, pos):
+        """Returns the total potential energy held by the constraints"""
+        d_dist, d_global, d_local = self.displacements(pos)
+        return 0.5 * (np.dot(self.dist_stiffness, np.square(d_dist)) +
+                      np.dot(self.global_stiffness, np.square(d_global)) +
+                      np.dot(self.local_stiffness, np.square(d_local)))
+
+    def subset(self, rows):
+        """Returns a table of the constraints between a subset of masses
+
+        Masses are numbered by their position in rows, & only constraints
+        with all of their masses in rows are kept.
+        """
+        t = _ConstraintTable.__new__(_ConstraintTable)
+        t.scale_version = self.scale_version
+        t.mass, t.moving, t.friction, t.expanding = (self.mass[rows],
+                                                     self.moving[rows],
+                                                     self.friction[rows],
+                                                     self.expanding[rows])
+        remap = np.full(len(self.mass), -1, dtype=int)
+        remap[rows] = np.arange(len(rows))
+
+        ends = remap[np.stack((self.dist_a, self.dist_b))]
+        keep = np.all(ends >= 0, 0)
+        t.dist_a, t.dist_b = ends[:, keep]
+        t.dist_length = self.dist_length[keep]
+        t.dist_stiffness = self.dist_stiffness[keep]
+
+        ends = remap[np.stack((self.global_a, self.global_b))]
+        keep = np.all(ends >= 0, 0)
+        t.global_a, t.global_b = ends[:, keep]
+        t.global_length = self.global_length[keep]
+        t.global_stiffness = self.global_stiffness[keep]
+
+        ends = remap[np.stack((self.local_a, self.local_b, self.local_c))]
+        keep = np.all(ends >= 0, 0)
+        t.local_a, t.local_b, t.local_c = ends[:, keep]
+        t.local_length = self.local_length[keep]
+        t.local_stiffness = self.local_stiffness[keep]
+
+        t._indexForces()
+        return t
+
+    def segments(self, pos):
+        """Returns (2k x 2) end points of the k line segments of constraints
+
+        Each constraint is a segment between its masses, except local angle
+        constraints, which are two segments (a to b, & b to c).
+        """
+        a = np.concatenate(
+            (self.dist_a, self.global_a, self.local_a, self.local_b))
+        b = np.concatenate(
+            (self.dist_b, self.global_b, self.local_b, self.local_c))
+        ps = np.empty((2 * len(a), 2))
+        ps[0::2] = pos[a]
+        ps[1::2] = pos[b]
+        return ps
 
 
 class Constraint(_Energised, ABC):
@@ -84,11 +507,26 @@ class Constraint(_Energised, ABC):
     SOURCE_LABEL = 2
     SOURCE_HIERARCHICAL = 3
 
+    __slots__ = ['_ssi_id', '_source']
+
     def __init__(self, ssi_id=None, source=SOURCE_NONE):
         """Constructor which gives a ssi_id to link the constraint to"""
         self._ssi_id = ssi_id
         self._source = source
 
+    def __getstate__(self):
+        """Gets the pickle friendly state of the object (as a dict)"""
+        return {
+            k: getattr(self, k)
+            for k in _slotNames(type(self))
+            if hasattr(self, k)
+        }
+
+    def __setstate__(self, state):
+        """Restores state (from either a slots or old dict based constraint)"""
+        for k, v in state.items():
+            setattr(self, k, v)
+
     @abc.abstractmethod
     def __str__(self):
         """Force every subclass to implement a verbose string representation"""
@@ -116,7 +554,11 @@ class Constraint(_Energised, ABC):
 
     @abc.abstractmethod
     def placementSuggestion(self, mass):
-        """Returns a placement tuple suggesting where to place the mass"""
+        """Returns a placement tuple suggesting where to place the mass
+
+        The tuple is (reference mass, r, r weight, th, th weight), with NaN
+        for an r or th that isn't suggested (None if mass isn't constrained).
+        """
         pass
 
     def totalEnergy(self):
@@ -126,6 +568,7 @@ class Constraint(_Energised, ABC):
 
 class ConstraintAngleGlobal(Constraint):
     """A constraint on the angle between two point-masses, in the global frame"""
+    __slots__ = ['_mass_a', '_mass_b', '_natural_length', '_stiffness']
 
     def __init__(self, mass_a, mass_b, natural_length, stiffness, ssi_id=-1):
         """Constructs the specified constraint between masses"""
@@ -166,23 +609,20 @@ class ConstraintAngleGlobal(Constraint):
     def placementSuggestion(self, mass):
         """Returns a placement tuple suggesting where to place the mass"""
         if mass == self._mass_a:
-            return {
-                'mass': self._mass_b,
-                'th': (self._natural_length, self._stiffness)
-            }
+            return (self._mass_b, np.nan, 0, self._natural_length,
+                    self._stiffness)
         elif mass == self._mass_b:
-            return {
-                'mass':
-                    self._mass_a,
-                'th':
-                    (_angleWrap(self._natural_length + np.pi), self._stiffness)
-            }
+            return (self._mass_a, np.nan, 0,
+                    _angleWrap(self._natural_length + np.pi), self._stiffness)
         else:
-            return {}
+            return None
 
 
 class ConstraintAngleLocal(Constraint):
     """A constraint on the angle formed by three point-masses"""
+    __slots__ = [
+        '_mass_a', '_mass_b', '_mass_c', '_natural_length', '_stiffness'
+    ]
 
     def __init__(self,
                  mass_a,
@@ -236,57 +676,35 @@ class ConstraintAngleLocal(Constraint):
     def placementSuggestion(self, mass):
         """Returns a placement tuple suggesting where to place the mass"""
         if mass == self._mass_a:
-            return {
-                'mass':
-                    self._mass_b,
-                'th': (_angleWrap(
-                    _angle(self._mass_c, self._mass_b) + self._natural_length),
-                       self._stiffness)
-            }
+            return (self._mass_b, np.nan, 0,
+                    _angleWrap(
+                        _angle(self._mass_c, self._mass_b) +
+                        self._natural_length), self._stiffness)
         elif mass == self._mass_b:
-            # There is no easy way to do this (the path of possible placements
-            # of B follows a complex arc, which is discontinous because it is
-            # present on both sides - i.e. constraint can be on left or right
-            # side of |AC|). The whole optimisation process is needed for
-            # overcoming problems like these. So for now, take the easy option
-            # and simply place a suggestion (relative to C) for B to be at the
-            # midpoint of |AC|
-            r = (1 - np.absolute(self._natural_length) /
-                 (2 * np.pi)) * _distance(self._mass_a, self._mass_c)
-            a = -np.pi
-            b = np.pi
-            dummy = Mass('dummy')
-            SEARCH_DEPTH = 20
-            for i in range(0, SEARCH_DEPTH):
-                mid = (a + b) / 2
-                dummy.pos = self._mass_a.pos + r * np.array(
-                    [np.cos(mid), np.sin(mid)])
-                error = _angle(self._mass_a, dummy,
-                               self._mass_c) - self._natural_length
-                if error > 0:
-                    b = mid
-                else:
-                    a = mid
-
-            return {
-                'mass': self._mass_a,
-                'r': (r, 0.5 * self._stiffness),
-                'th': (mid, 0.5 * self._stiffness)
-            }
+            # The possible placements of B form an arc on either side of |AC|,
+            # so there is no single best placement (the optimisation has to
+            # sort that out). Suggest a distance from A that shrinks as the
+            # angle opens (the midpoint of |AC| for a straight angle), & the
+            # direction from A that gives exactly the natural angle at B
+            r, th = _localAnglePlacement(self._mass_a.pos, self._mass_c.pos,
+                                         self._natural_length)
+            return (self._mass_a, r, 0.5 * self._stiffness, th,
+                    0.5 * self._stiffness)
         elif mass == self._mass_c:
-            return {
-                'mass':
-                    self._mass_b,
-                'th': (_angleWrap(
-                    _angle(self._mass_a, self._mass_b) - self._natural_length),
-                       self._stiffness)
-            }
+            return (self._mass_b, np.nan, 0,
+                    _angleWrap(
+                        _angle(self._mass_a, self._mass_b) -
+                        self._natural_length), self._stiffness)
         else:
-            return {}
+            return None
 
 
 class ConstraintDistance(Constraint):
     """A constraint on the distance between two point-masses"""
+    __slots__ = [
+        '_mass_a', '_mass_b', '_natural_length_unscaled',
+        '_natural_length_scale_fn', '_stiffness'
+    ]
 
     def __init__(self, mass_a, mass_b, natural_length, stiffness, ssi_id=-1):
         """Constructs the specified constraint between masses"""
@@ -300,8 +718,7 @@ class ConstraintDistance(Constraint):
 
     def __getstate__(self):
         """Gets the pickle friendly state of the object"""
-        obj_dict = self.__dict__.copy()
-        # del obj_dict['_natural_length_scale_fn']
+        obj_dict = super(ConstraintDistance, self).__getstate__()
         obj_dict['_natural_length_scale_fn'] = None
         return obj_dict
 
@@ -341,17 +758,13 @@ class ConstraintDistance(Constraint):
     def placementSuggestion(self, mass):
         """Returns a placement tuple suggesting where to place the mass"""
         if mass == self._mass_a:
-            return {
-                'mass': self._mass_b,
-                'r': (self._natural_length, self._stiffness)
-            }
+            return (self._mass_b, self._natural_length, self._stiffness,
+                    np.nan, 0)
         elif mass == self._mass_b:
-            return {
-                'mass': self._mass_a,
-                'r': (self._natural_length, self._stiffness)
-            }
+            return (self._mass_a, self._natural_length, self._stiffness,
+                    np.nan, 0)
         else:
-            return {}
+            return None
 
     def setScaleGrabber(self, fn):
         """Sets a function for grabbing the scale unit from the layout"""
@@ -359,7 +772,15 @@ class ConstraintDistance(Constraint):
 
 
 class MassFixed(_Energised):
-    """A point-mass, that is fixed to its initial location"""
+    """A point-mass, that is fixed to its initial location
+
+    Position, velocity, & acceleration are rows of a single (3 x 2) state
+    array. Once a mass is added to a layout, the array is a view of its row in
+    the layout's shared state array (with _index the row it occupies).
+    """
+    __slots__ = [
+        'name', '_mass', '_level', '_parent', '_state', '_index', '_symbol'
+    ]
 
     def __init__(self, name, pos, is_label=True):
         """Constructs a new fixed point mass, at a requested position"""
@@ -369,9 +790,67 @@ class MassFixed(_Energised):
         self._mass = 1
         self._level = MASS_LEVEL_LABEL if is_label else MASS_LEVEL_SIGN
         self._parent = None
+        self._state = np.zeros((3, 2))
+        self._index = -1
+        self._symbol = -1  # ID of the name in a layout's symbol table
         self.pos = pos
-        self.vel = np.zeros((2))
-        self.acc = np.zeros((2))
+
+    def __getstate__(self):
+        """Gets the pickle friendly state of the object
+
+        The keys match those of the old dict based masses, so pickles remain
+        readable in both directions.
+        """
+        return {
+            'name': self.name,
+            '_symbol': self._symbol,
+            '_mass': self._mass,
+            '_level': self._level,
+            '_parent': self._parent,
+            'pos': np.array(self.pos),
+            'vel': np.array(self.vel),
+            'acc': np.array(self.acc)
+        }
+
+    def __setstate__(self, state):
+        """Restores state (from either a slots or old dict based mass)"""
+        self.name = state['name']
+        self._mass = state['_mass']
+        self._level = state['_level']
+        self._parent = state['_parent']
+        self._state = np.zeros((3, 2))
+        self._index = -1
+        self._symbol = state.get('_symbol', -1)
+        self.pos = state['pos']
+        self.vel = state['vel']
+        self.acc = state['acc']
+
+    @property
+    def acc(self):
+        """Acceleration of the mass (a view of its state)"""
+        return self._state[2]
+
+    @acc.setter
+    def acc(self, value):
+        self._state[2] = value
+
+    @property
+    def pos(self):
+        """Position of the mass (a view of its state)"""
+        return self._state[0]
+
+    @pos.setter
+    def pos(self, value):
+        self._state[0] = value
+
+    @property
+    def vel(self):
+        """Velocity of the mass (a view of its state)"""
+        return self._state[1]
+
+    @vel.setter
+    def vel(self, value):
+        self._state[1] = value
 
     @property
     def fixed(self):
@@ -393,14 +872,17 @@ class MassFixed(_Energised):
 
 class Mass(MassFixed):
     """A point-mass, representing a toponym's location in a spatial layout"""
+    __slots__ = ()
 
     def __init__(self, name, pos=None, vel=None, acc=None):
         """Constructs a new point mass, with a given name"""
-        MassFixed.__init__(self, name, np.zeros((2)) if pos is None else pos)
+        MassFixed.__init__(self, name, 0 if pos is None else pos)
 
         self._level = MASS_LEVEL_LABEL + 1  # Hierarchy level starting @ lowest
-        self.vel = np.zeros((2)) if vel is None else vel
-        self.acc = np.zeros((2)) if acc is None else acc
+        if vel is not None:
+            self.vel = vel
+        if acc is not None:
+            self.acc = acc
 
     def applyExpansion(self, coem):
         """Applies the expansion force to the mass"""
@@ -479,26 +961,60 @@ class ScaleManager(object):
     def __init__(self):
         """Initialises the manager with the default scales"""
         self._scales = None
-        self._observations = None
+        self._observations = {}  # Lists of (levels, distance, stiffness)
+        self._sums = {}  # Weighted distance, weight, & count, by level tuple
 
         self._exploration_factor = None
         self._exploration_step = EXPLORATION_STEP
+        self._version = 0
 
         self.resetExploration()
         self._generateScales()
 
+    def __setstate__(self, state):
+        """Restores state (converting observations of older managers)"""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_version', 0)
+
+        # Older managers kept a (2 x n) array of distances & stiffnesses for
+        # each level tuple, rather than lists of observations by key
+        observations = self._observations or {}
+        if any(isinstance(v, np.ndarray) for v in observations.values()):
+            observations = {
+                None: [(k, d, w)
+                       for k, v in observations.items()
+                       for d, w in np.reshape(v, (2, -1)).T]
+            }
+        self._observations = observations
+        self._generateScales()
+
+    def _accumulate(self, observations, sign=1):
+        """Adds (or removes) observations from the running weighted sums"""
+        for level_tuple, d, w in observations:
+            s = self._sums.setdefault(level_tuple, np.zeros(3))
+            s += sign * np.array([d * w, w, 1])
+            if s[2] <= 0:
+                del self._sums[level_tuple]
+
     def _generateScales(self):
         """Generates the scales list from the current observation list"""
-        # Start with default (and finish if there are no observations)
+        self._sums = {}
+        for v in self._observations.values():
+            self._accumulate(v)
         self._scales = dict(ScaleManager._DEFAULT_SCALES)
-        if self._observations is None or not self._observations:
-            return
-
-        # Compute the mean for each entry in the dict
-        for k, v in self._observations.items():
-            self._scales[k] = np.sum(np.prod(v, 0)) / np.sum(v[1])
-
-        # print("\tNew scale set:\n%s" % (self._scales))
+        self._updateScales(list(self._sums.keys()))
+
+    def _updateScales(self, level_tuples):
+        """Updates the scale of each level tuple from the running sums"""
+        # Level tuples without any observations go back to their defaults
+        self._version += 1
+        for k in level_tuples:
+            if k in self._sums:
+                self._scales[k] = self._sums[k][0] / self._sums[k][1]
+            elif k in ScaleManager._DEFAULT_SCALES:
+                self._scales[k] = ScaleManager._DEFAULT_SCALES[k]
+            else:
+                self._scales.pop(k, None)
 
     @staticmethod
     def _level_tuple(level_a, level_b):
@@ -506,9 +1022,11 @@ class ScaleManager(object):
 
     def bumpExploration(self):
         self._exploration_factor += self._exploration_step
+        self._version += 1
 
     def resetExploration(self):
         self._exploration_factor = 1
+        self._version += 1
 
     def scaleUnit(self, mass_a, mass_b):
         """Returns scale unit between two masses, incorporating exploration"""
@@ -518,90 +1036,310 @@ class ScaleManager(object):
 
     def setObservations(self, observations):
         """Sets the list of scale observations used by the manager"""
-        # Turn list of observations into a dict (skipping out any scales which
-        # are in the constant list)
         self._observations = {}
-        for o in observations:
-            level_tuple = ScaleManager._level_tuple(*o[0])
-            if level_tuple in ScaleManager._CONSTANT_SCALES:
-                continue
-            dist_stiff = np.array(o[1:3])
-            self._observations[level_tuple] = np.column_stack(
-                (self._observations[level_tuple], dist_stiff
-                )) if level_tuple in self._observations else dist_stiff
-
-        # Generate the scales
-        self._generateScales()
-
-
-_debug_step_time = 0
-_debug_step_t = 0
+        self.updateObservations({None: observations})
+
+    def updateObservations(self, observations):
+        """Replaces the observations under each key of a dict of observations
+
+        Each value is a list of ((level a, level b), distance, stiffness)
+        observations (an empty list removes the key). Only the scales of the
+        level tuples that are touched get updated.
+        """
+        touched = set()
+        for key, obs in observations.items():
+            # Remove the old observations, & add the new ones (skipping out
+            # any scales which are in the constant list)
+            old = self._observations.pop(key, [])
+            self._accumulate(old, -1)
+            new = [(ScaleManager._level_tuple(*o[0]), o[1], o[2])
+                   for o in obs]
+            new = [o for o in new if o[0] not in ScaleManager._CONSTANT_SCALES]
+            if new:
+                self._observations[key] = new
+            self._accumulate(new)
+            touched.update(o[0] for o in old + new)
+
+        # Update the affected scales
+        self._updateScales(touched)
 
 
 class SpatialLayout(object):
     """A set of springs and masses denoting abstract ideas about space"""
 
-    def __init__(self, log=True):
+    def __init__(self, log=True, profiler=None):
         """Constructs a new empty spatial layout"""
         self._constraints = []
         self._masses = []
+        self._symbols = SymbolTable()
+        self._mass_symbols = []  # First mass in the layout with each symbol
+        self._state = np.zeros((0, 3, 2))  # Mass pos, vel, & acc (by row)
         self._scale_manager = ScaleManager()
-        self._queued_heirarchies = []
+        self._queued_heirarchies = {}  # Hints waiting on a missing symbol
+        self._observed_symbols = set()  # Masses measured for scale
 
         self._paused = False
         self._system_changed = False
+        self._system_version = 0  # Bumped by every change in structure
         self._bounced_last_step = False
         self._last_settled = False
 
         self._energy_log = EnergyLog() if log else None
+        self._constraint_table = None
+        self._hull = None
+        self._state_version = 0
 
         self._post_state_change_fcn = None
         self._to_call_list = collections.deque()
+        self._batch = None
 
-        self._log = ({
-            'a': [],
-            'b': [],
-            'c': [],
-            'd': [],
-            'e': []
-        } if log else None)
+        self._profiler = (profiling.NULL_PROFILER
+                          if profiler is None else profiler)
+        self._pool = None
+        self._kernels = True  # Use compiled kernels (if they are available)
 
         self._state_derivative = None
         self._ode = RungeKutta45(self._stateDerivative)
-        # self._ode = ig.ode(self._stateDerivative).set_integrator(
-        #     'dopri5', atol=1e-5, rtol=1e-2)
 
         self._coem = None
 
-        self._log_file = (open(os.path.expanduser('~') +
-                               '/tmp/am.log', 'w') if log else None)
-
     def __getstate__(self):
         """Gets the pickle friendly state of the object"""
         obj_dict = self.__dict__.copy()
         obj_dict.pop('_post_state_change_fcn', None)
         obj_dict.pop('_ode', None)
         obj_dict.pop('_to_call_list', None)
-        obj_dict.pop('_log_file', None)
+        obj_dict.pop('_profiler', None)
+        obj_dict.pop('_pool', None)
+        obj_dict.pop('_kernels', None)
+        obj_dict.pop('_constraint_table', None)
+        obj_dict.pop('_hull', None)
+        obj_dict.pop('_state', None)
+        obj_dict.pop('_mass_symbols', None)
         return obj_dict
 
-    def _placeMass(self, mass):
-        """Places a mass at its best position according to the constraints"""
-        # Get a list of placement suggestions from the added constraints
+    def __setstate__(self, state):
+        """Restores state, recreating anything that wasn't pickled
+
+        Transient attributes of a live layout (e.g. its profiler & post state
+        change function) are kept, so a layout can also adopt the state of
+        another layout.
+        """
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_post_state_change_fcn', None)
+        self.__dict__.setdefault('_to_call_list', collections.deque())
+        self.__dict__.setdefault('_profiler', profiling.NULL_PROFILER)
+        self.__dict__.setdefault('_pool', None)
+        self.__dict__.setdefault('_kernels', True)
+        self.__dict__.setdefault('_energy_log', None)
+        self.__dict__.setdefault('_coem', None)
+        self.__dict__.setdefault('_batch', None)
+        self.__dict__.setdefault('_state_version', 0)
+        self.__dict__.setdefault('_system_version', 0)
+        self.__dict__.setdefault('_symbols', SymbolTable())
+        if '_ode' not in self.__dict__:
+            self._ode = RungeKutta45(self._stateDerivative)
+        self._constraint_table = None
+        self._hull = None
+
+        # Rebuild anything derived from the masses & constraints (the shared
+        # state & scale grabbers aren't pickled, & the integrator has no
+        # state yet)
+        masses = self._masses
+        self._masses = []
+        self._mass_symbols = []
+        self._state = np.zeros((0, 3, 2))
+        for m in masses:
+            self._attachMass(m)
+
+        # Hints queued by older layouts are keyed by name (not symbol)
+        queued = self._queued_heirarchies
+        self._queued_heirarchies = {}
+        for k, hs in queued.items():
+            self._queued_heirarchies[self.internName(k)] = [
+                tuple(self.internName(x) for x in h) for h in hs
+            ]
+        for c in self._constraints:
+            if type(c) == ConstraintDistance:
+                c.setScaleGrabber(self._scale_manager.scaleUnit)
+
+        # Older layouts re-measured every observation for each label, so
+        # everything observed so far has already been measured
+        if '_observed_symbols' not in self.__dict__:
+            self._observed_symbols = set(
+                m._symbol for m in self._masses if m.fixed)
+            self._observed_symbols.update(
+                m._symbol for m in _labelPlaces(self._constraints))
+        self._system_changed = True
+
+    def _appendMass(self, mass):
+        """Appends a mass to the layout, updating any cached structures"""
+        self._attachMass(mass)
+        self._constraint_table = None
+        if (self._hull is not None and
+                self._hull.state_version == self._state_version):
+            self._hull.add(mass.pos)
+        else:
+            self._hull = None
+
+    def _attachMass(self, mass):
+        """Appends a mass, moving its state into the shared state array"""
+        n = len(self._masses)
+        if n == len(self._state):
+            # Grow the shared array, re-pointing every mass at its new row
+            state = np.zeros((max(16, 2 * n), 3, 2))
+            state[:n] = self._state[:n]
+            self._state = state
+            for i, m in enumerate(self._masses):
+                m._state = state[i]
+        self._state[n] = mass._state
+        mass._state = self._state[n]
+        mass._index = n
+        self._masses.append(mass)
+        symbol = self.internMass(mass)
+        if symbol >= len(self._mass_symbols):
+            self._mass_symbols.extend([None] *
+                                      (symbol + 1 - len(self._mass_symbols)))
+        if self._mass_symbols[symbol] is None:
+            self._mass_symbols[symbol] = mass
+
+    def _detachMasses(self, masses):
+        """Removes all masses, giving each of masses its own state again"""
+        for m in masses:
+            m._state = np.array(m._state)
+            m._index = -1
+        self._masses = []
+        self._mass_symbols = []
+        self._state = np.zeros((0, 3, 2))
+        self._constraint_table = None
+        self._hull = None
+
+    def _applyHierarchy(self, m_child, m_parent):
+        """Makes m_parent the parent of m_child, raising ancestors' levels"""
+        # Sanity check to make sure that we can proceed
+        if m_child._parent is not None:
+            raise ValueError(
+                ("Trying to add a parent (%s - %d) to a child (%s - %d) "
+                 "that already has a parent (%s). "
+                 "Operation not supported.") %
+                (m_parent.name, m_parent._level, m_child.name, m_child._level,
+                 m_child._parent.name))
+
+        # Look up the tree from the child, ensuring that all parents have a
+        # level greater than their child
+        self._constraint_table = None
+        m_child._parent = m_parent
+        m = m_child
+        while m._parent is not None:
+            if m._parent._level <= m._level:
+                m._parent._level = m._level + 1
+            m = m._parent
+        self.markSystemChanged()
+
+    def _constraintTable(self):
+        """Returns the constraint table, rebuilding it if it is stale"""
+        if (self._constraint_table is None or
+                self._constraint_table.scale_version !=
+                self._scale_manager._version):
+            self._constraint_table = _ConstraintTable(
+                self._masses, self._constraints, self._scale_manager._version)
+        return self._constraint_table
+
+    def _constraintsByMass(self, masses):
+        """Returns the constraints each of masses is in (in one scan)"""
+        cs = {m: [] for m in masses}
+        for c in self._constraints:
+            for m in set(c.masses()):
+                if m in cs:
+                    cs[m].append(c)
+        return cs
+
+    def _hullCache(self):
+        """Returns the hull cache, rebuilding it if masses have moved"""
+        if (self._hull is not None and
+                self._hull.state_version == self._state_version):
+            return self._hull
+        ps = np.stack([m.pos for m in self._masses])
+        if self._hull is not None and self._hull.isValid(ps):
+            self._hull.refresh(ps, self._state_version)
+        else:
+            self._hull = _HullCache(ps, self._state_version)
+        return self._hull
+
+    def _hasMass(self, mass):
+        """Returns if a mass is in the layout (without a list search)"""
+        return (0 <= mass._index < len(self._masses) and
+                self._masses[mass._index] is mass)
+
+    def _observeMasses(self, places):
+        """Re-measures the scale observations of every observed pair of masses
+
+        A mass is observed if it is fixed, or if its place was observed
+        through a label. Places observed for the first time (places is a dict
+        of place to the position its label implies) are measured at that
+        position, with every other mass measured where it currently is. The
+        observations of each pair of masses replace any earlier ones.
+        """
+        n = len(self._masses)
+        pos = np.copy(self._state[:n, 0])
+        for m, p in places.items():
+            if m._symbol not in self._observed_symbols and self._hasMass(m):
+                pos[m._index] = p
+        self._observed_symbols.update(m._symbol for m in self._masses
+                                      if m.fixed)
+        self._observed_symbols.update(m._symbol for m in places)
+
+        # Measure every distance constraint with both masses observed, in one
+        # pass (observations of the distance between a label & place are
+        # skipped, as the system is incapable of assuming this distance, it
+        # just gives it some arbitrary value)
+        table = self._constraintTable()
+        observed = np.array(
+            [m._symbol in self._observed_symbols for m in self._masses])
+        levels = np.array([m._level for m in self._masses])
+        a, b = table.dist_a, table.dist_b
+        measured = np.flatnonzero(observed[a] & observed[b] &
+                                  (levels[a] != MASS_LEVEL_LABEL) &
+                                  (levels[b] != MASS_LEVEL_LABEL))
+        ab = pos[a[measured]] - pos[b[measured]]
+        ds = np.hypot(ab[:, 0], ab[:, 1])
+
+        # Replace the observations of every pair (dropping any pairs that
+        # are no longer measured)
+        observations = {k: [] for k in self._scale_manager._observations}
+        for i, d in zip(measured, ds):
+            m_a, m_b = self._masses[a[i]], self._masses[b[i]]
+            observations.setdefault(
+                tuple(sorted((m_a._symbol, m_b._symbol))),
+                []).append(((m_a._level, m_b._level), d,
+                            table.dist_stiffness[i]))
+        self._scale_manager.updateObservations(observations)
+
+    def _placeMass(self, mass, constraints=None):
+        """Places a mass at its best position according to the constraints
+
+        Only constraints in constraints (all constraints if None) are used to
+        suggest a placement.
+        """
         # Get a list of the constraints that can suggest where to place the
         # mass (must have the mass, and all other masses must already be in the
         # network)
         cs_complete = [
-            c for c in self._constraints
-            if set(c.masses()).issubset(self._masses + [mass])
+            c for c in (self._constraints if constraints is None else
+                        constraints)
+            if all(m is mass or self._hasMass(m) for m in c.masses())
         ]
 
         # Get all placement suggestions from the influencing constraints
         ps_all = [c.placementSuggestion(mass) for c in cs_complete]
+        ps_all = np.array([(p[0]._symbol, p[0]._index) + tuple(p[1:])
+                           for p in ps_all
+                           if p is not None],
+                          dtype=PLACEMENT_DTYPE)
 
         # Handle the case where we have 0 placement suggestions
         SCALED_UNIT = 1  # TODO DO THIS PROPERLY!
-        if not ps_all:
+        if not ps_all.size:
             # Get the placement
             if not self._masses:
                 # Nothing else is in the layout, just place at origin
@@ -618,13 +1356,13 @@ class SpatialLayout(object):
             else:
                 # Place a distance of 1 x unit distance outside of the convex
                 # hull, in the direction formed from the center of mass to the
-                # nearest hull vertice
-                mps = np.stack([m.pos for m in self._masses])
-                ch = sp.ConvexHull(mps)
-                com = np.mean(mps, 0)
-                distances = sp.distance.cdist(mps[ch.vertices, :], [com],
-                                              'sqeuclidean')
-                closest_hull_point = mps[ch.vertices[distances.argmin()], :]
+                # nearest hull vertice (the hull is cached, so placing many
+                # unconstrained masses in a row doesn't rebuild it each time)
+                hull = self._hullCache()
+                com = hull.centroid
+                hps = hull.positions[hull.vertices]
+                distances = np.sum(np.square(hps - com), 1)
+                closest_hull_point = hps[distances.argmin()]
                 placement = com + tools.uv(closest_hull_point - com) * (
                     distances.min()**0.5 + SCALED_UNIT)
 
@@ -632,99 +1370,148 @@ class SpatialLayout(object):
             self._safePlacement(mass, placement)
             return
 
-        # Go through the suggestions, merging all suggestions that are relative
-        # to the same mass (m_key) into one placement suggestion so that the
-        # extra information can be used to make a smarter placement suggestion
-        F_MASS = lambda x: x['mass'].name  # noqa
-        ps_all = [p for p in ps_all if p]
-        ps_merged = []
-        for m_key, g in itertools.groupby(sorted(ps_all, key=F_MASS), F_MASS):
-            g = list(g)
-            rs = np.array([list(p['r']) for p in g if 'r' in p])
-            ths = np.array([list(p['th']) for p in g if 'th' in p])
-            merged = {'mass': g[0]['mass']}
-            if rs.size > 0:
-                merged['r'] = (np.sum(np.prod(rs, 1)) / np.sum(rs[:, 1]),
-                               np.sum(rs[:, 1]))
-            if ths.size > 0:
-                mean_vector = np.sum(
-                    np.array([np.cos(ths[:, 0]),
-                              np.sin(ths[:, 0])]) * ths[:, 1], 1)
-                merged['th'] = (np.arctan2(mean_vector[1],
-                                           mean_vector[0]), np.sum(ths[:, 1]))
-            ps_merged.append(merged)
-
-        # Go through each of the merged placement suggestions, sorting them so
-        # that the strongest suggestions are applied first. The suggestions are
-        # converted to xy positions, and then merged through a weighted mean
-        # TODO sort doesn't yet use "total weights" as a final key...
-        ps_merged = sorted(ps_merged,
-                           key=lambda x: ('r' in x and 'th' in x, 'th' in x))
+        # Merge all suggestions that are relative to the same mass into one
+        # placement suggestion so that the extra information can be used to
+        # make a smarter placement suggestion
+        ps_merged = _mergePlacementSuggestions(ps_all)
+        refs = self._state[ps_merged['index'], 0]
+        rs, ths = ps_merged['r'], ps_merged['th']
+        has_r, has_th = ~np.isnan(rs), ~np.isnan(ths)
+        both = has_r & has_th
+
+        # Go through each of the merged suggestions that only have one of r &
+        # th (these depend on the placement so far, so are applied in order).
+        # The suggestions are converted to xy positions, and then merged
+        # through a weighted mean
         placement = np.zeros((2))
         weight = 0
-        for p in ps_merged:
-            # Turn the placement suggestion into a weighted xy position
-            if 'r' in p and 'th' in p:
-                # Suggested is simply r,th from reference position
-                suggested = p['mass'].pos + np.array([
-                    p['r'][0] * np.cos(p['th'][0]),
-                    p['r'][0] * np.sin(p['th'][0])
-                ])
-                w = p['r'][1] + p['th'][1]  # Not sure if should div 2...
-            elif 'th' in p:
+        for i in np.flatnonzero(~both):
+            ref = refs[i]
+            if has_th[i]:
                 # Suggested is on line at angle theta from reference, with
                 # distance along line always guaranteed to be greater than
                 # 1 (suggesting close to reference is bad for system
                 # stability, & 1 is also fallback if no current placement)
-                uv = np.array([np.cos(p['th'][0]), np.sin(p['th'][0])])
-                r = np.dot(placement - p['mass'].pos, uv)
-                suggested = p['mass'].pos + (1 if r < 1 or weight == 0 else
-                                             r) * uv
-                w = p['th'][1]
-            elif 'r' in p:
+                uv = np.array([np.cos(ths[i]), np.sin(ths[i])])
+                r = np.dot(placement - ref, uv)
+                suggested = ref + (1 if r < 1 or weight == 0 else r) * uv
+                w = ps_merged['th_weight'][i]
+            else:
                 # Suggested is a distance r from the reference, in the
                 # direction of the suggested placement (direction falls
                 # back to a very rough "spread around circle" attempt which
                 # only bases the spread on number of masses in the layout)
                 th = _spreadAroundCircle(len(self._masses))
                 uv = np.array([np.cos(th), np.sin(th)]) if weight == 0 else (
-                    (placement - p['mass'].pos) /
-                    la.norm(placement - p['mass'].pos))
-                suggested = p['mass'].pos + p['r'][0] * uv
-                w = p['r'][1]
+                    (placement - ref) / np.linalg.norm(placement - ref))
+                suggested = ref + rs[i] * uv
+                w = ps_merged['r_weight'][i]
 
             # Incorporate the weighted xy position into the weighted mean
             placement = (placement * weight + suggested * w) / (weight + w)
             weight += w
 
+        # Suggestions with both r & th are simply r,th from the reference
+        # position (independent of the placement so far), so they all get
+        # incorporated into the weighted mean at once
+        if np.any(both):
+            suggested = refs[both] + rs[both, np.newaxis] * np.stack(
+                (np.cos(ths[both]), np.sin(ths[both])), 1)
+            ws = ps_merged['r_weight'][both] + ps_merged['th_weight'][both]
+            placement = (placement * weight + np.dot(ws, suggested)) / (
+                weight + np.sum(ws))
+
         # FINALLY, place the mass and add it into the network
         self._safePlacement(mass, placement)
 
+    def _integrateInPool(self, y):
+        """Integrates a step, with large independent parts done in the pool
+
+        Returns None (without integrating) if the layout has fewer than two
+        parts big enough to be worth shipping to another process.
+        """
+        table = self._constraintTable()
+        big = [
+            rows for rows in table.components()
+            if np.count_nonzero(table.moving[rows]) >= PARALLEL_COMPONENT_SIZE
+        ]
+        if len(big) < 2:
+            return None
+
+        # Only compact arrays are shipped (the rest of the layout is done
+        # here while the pool works)
+        y = y.reshape(-1, 2, 2)
+        jobs = [(table.moving[rows],
+                 self._pool.apply_async(
+                     _integrateComponent,
+                     (table.subset(rows), y[rows], self._coem)))
+                for rows in big]
+        rest = np.ones(len(y), dtype=bool)
+        for rows, (moving, _) in zip(big, jobs):
+            rest[rows[moving]] = False
+        rest = np.flatnonzero(rest)
+        y_next = np.empty_like(y)
+        y_next[rest] = _integrateComponent(table.subset(rest), y[rest],
+                                           self._coem)
+        for rows, (moving, job) in zip(big, jobs):
+            y_next[rows[moving]] = job.get()[moving]
+        return y_next.reshape(-1)
+
+    def _kernelForces(self):
+        """Returns everything the compiled kernels compute forces from"""
+        t = self._constraintTable()
+        return (FRICTION_COEFFICIENT, EXPANSION_COEFFICIENT,
+                np.zeros(0) if self._coem is None else np.asarray(
+                    self._coem, dtype=float), t.mass, t.moving, t.friction,
+                t.expanding, t.dist_a, t.dist_b, t.dist_length,
+                t.dist_stiffness, t.global_a, t.global_b, t.global_length,
+                t.global_stiffness, t.local_a, t.local_b, t.local_c,
+                t.local_length, t.local_stiffness)
+
+    def _kernelsEnabled(self):
+        """Returns if steps are done with the compiled kernels"""
+        return self._kernels and kernels.AVAILABLE
+
     def _pullState(self):
         """Pulls the current state matrix of the system"""
-        return np.concatenate(
-            [np.concatenate((m.pos, m.vel)) for m in self._masses])
+        return self._state[:len(self._masses), 0:2].reshape(-1)
 
     def _pushState(self, y):
         """Pushes state matrix into system (obeying any safety conditions)"""
         # TODO safety conditions
-        for i, m in enumerate(self._masses):
-            m.pos = y[(i * 4):(i * 4 + 2)]
-            m.vel = y[(i * 4 + 2):(i * 4 + 4)]
+        self._state_version += 1
+        n = len(self._masses)
+        self._state[:n, 0:2] = y.reshape(n, 2, 2)
 
     def _pushStateSafely(self, y_a, y_b):
         """Obeys safety criteria (using old state) while pushing new state"""
         self._pushState(y_a)
+        self._state_version += 1
         y_delta = y_b - y_a
         self._bounced_last_step = False
-        for i, m in enumerate(self._masses):
-            m.vel = y_b[(i * 4 + 2):(i * 4 + 4)]
+        n = len(self._masses)
+        self._state[:n, 1] = y_b.reshape(n, 2, 2)[:, 1]
+
+        if self._kernelsEnabled():
+            bounces = kernels.stepSafely(self._state[:n, 0],
+                                         self._state[:n, 1],
+                                         y_delta.reshape(n, 2, 2)[:, 0],
+                                         SAFE_DISTANCE)
+            self._bounced_last_step = bounces > 0
+            self._profiler.count('bounces', bounces)
+            return
 
         for i, m in enumerate(self._masses):
             self._stepSafely(m, y_delta[(i * 4):(i * 4 + 2)])
 
     def _refreshForces(self):
         """Refreshes the force value for each mass in the system"""
+        if self._kernelsEnabled():
+            n = len(self._masses)
+            kernels.accelerations(self._state[:n, 0], self._state[:n, 1],
+                                  self._kernelForces(), self._state[:n, 2])
+            return
+
         for m in self._masses:
             m.acc[:] = 0
             m.applyFriction()
@@ -740,8 +1527,8 @@ class SpatialLayout(object):
         sd2 = SAFE_DISTANCE**2
         it_count = 0  # Used to increase "push distance" to avoid getting stuck
         while not safe:
-            dists = sp.distance.cdist(np.stack([m.pos for m in self._masses]),
-                                      [placement], 'sqeuclidean')
+            dists = np.sum(np.square(
+                np.stack([m.pos for m in self._masses]) - placement), 1)
             if dists.min() > sd2:
                 safe = True
             else:
@@ -753,34 +1540,71 @@ class SpatialLayout(object):
 
         # Place the mass at its safe placement and add it to the system
         mass.pos = placement
-        self._masses.append(mass)
+        self._appendMass(mass)
+
+    def _placementOrder(self, masses, cs):
+        """Orders new masses so each is placed with the most suggestions
+
+        cs maps each of the masses to the constraints it is in.
+        """
+        # Fixed masses need no placement, so they go first. Then greedily
+        # pick the mass with the most constraints whose other masses have
+        # all been placed (ties are broken by order of arrival)
+        order = [m for m in masses if m.fixed]
+        unplaced = [m for m in masses if not m.fixed]
+        pending = set(unplaced)
+        scores = {
+            m: sum(
+                all(x is m or x not in pending
+                    for x in c.masses())
+                for c in cs[m])
+            for m in unplaced
+        }
+        while unplaced:
+            m_best = max(unplaced, key=lambda m: scores[m])
+            unplaced.remove(m_best)
+            pending.discard(m_best)
+            order.append(m_best)
+            for c in cs[m_best]:
+                ms = c.masses()
+                for m in ms:
+                    if m in pending and all(x is m or x not in pending
+                                            for x in ms):
+                        scores[m] += 1
+        return order
 
     def _stateDerivative(self, t, y):
         """Computes the derivative of the current state"""
+        self._profiler.count('derivatives')
         self._pushState(y)
         self._refreshForces()
-        return np.concatenate(
-            [np.concatenate((m.vel, m.acc)) for m in self._masses])
+        return self._state[:len(self._masses), 1:3].reshape(-1)
 
     def _stepSafely(self, mass, step):
         """Steps mass position, while staying a safe distance from others"""
         # Note: we don't handle stepping over a mass and its exclusion zone
         # (mainly because it doesn't matter in terms of integrator stability)
+        if not step.any():
+            # Not moving can't cause a clash (& there is no direction to
+            # bounce in if the mass already overlaps another)
+            return
         m_unsafe = []
-        m_desired = Mass("desired")
+        ps = self._state[:len(self._masses), 0]
         while m_unsafe is not None:
             # Find any clashes (note the 0.99 scaling factor is to stop
             # floating point error causing the mass to get "stuck" when
             # bouncing away from the collision)
-            m_desired.pos = mass.pos + step
-            m_unsafe = next((m for m in self._masses if m != mass and
-                             _distance(m_desired, m) < SAFE_DISTANCE * 0.99),
-                            None)
+            desired = mass.pos + step
+            d = desired - ps
+            clashes = np.flatnonzero(
+                (d[:, 0]**2 + d[:, 1]**2)**0.5 < SAFE_DISTANCE * 0.99)
+            clashes = clashes[clashes != mass._index]
+            m_unsafe = self._masses[clashes[0]] if len(clashes) else None
 
             # Take a safe "chunk" out of the desired step if we have a clash
             if m_unsafe is not None:
                 # Get some metrics for the collision
-                intersect = _firstCircleIntersect(mass.pos, m_desired.pos,
+                intersect = _firstCircleIntersect(mass.pos, desired,
                                                   m_unsafe.pos, SAFE_DISTANCE)
                 bounce_direction_m = _reflectedDirection(mass.vel,
                                                          intersect,
@@ -801,26 +1625,31 @@ class SpatialLayout(object):
                 mass.pos = intersect
                 step = bounced_position - mass.pos
                 self._bounced_last_step = True
+                self._profiler.count('bounces')
 
         # We now have a safe remaining step, apply it
         mass.pos += step
 
     def addConstraints(self, cs, place=True):
-        for c in cs:
-            self.addConstraint(c, place=place)
-
-        # Update the observed distance if we have a label batch of constraints
-        # Note: this heavily relies on the adder calling this methods rather
-        # than singular addConstraint. This is a BAD solution, but will have to
-        # do for now...
-        if any(c._source == Constraint.SOURCE_LABEL for c in cs):
-            self._scale_manager.setObservations(self.getObservedDistances())
+        """Adds a list of constraints as a single batch (see batch())"""
+        with self.batch(place=place):
+            for c in cs:
+                self.addConstraint(c, place=place)
+
+            # Update the observed distances if we have a label batch of
+            # constraints
+            # Note: this heavily relies on the adder calling this methods
+            # rather than singular addConstraint. This is a BAD solution, but
+            # will have to do for now...
+            self._batch.observed.update(_labelPositions(cs))
 
     def addConstraint(self, c, place=True):
         """Adds a constraint (and any new masses to the layout)"""
         # Force only one mass in the system with a specified name
         for i, m in enumerate(c.masses()):
-            m_found = self.getMass(m.name)
+            m_found = self.getMassBySymbol(self.internMass(m))
+            if m_found is None and self._batch is not None:
+                m_found = self._batch.symbols.get(m._symbol, None)
             if m_found is not None:
                 if i == 0:
                     c._mass_a = m_found
@@ -831,6 +1660,7 @@ class SpatialLayout(object):
 
         # Add in the constraint, attaching to scale manager if appropraite
         self._constraints.append(c)
+        self._constraint_table = None
         if type(c) == ConstraintDistance:
             c.setScaleGrabber(self._scale_manager.scaleUnit)
 
@@ -843,64 +1673,30 @@ class SpatialLayout(object):
 
     def addHierarchy(self, h):
         """Adds hints about hierarchy to the spatial layout"""
-        # Look for the two masses, queueing and bailing if both don't already
-        # exist in the layout
-        m_child = self.getMass(h[0])
-        m_parent = self.getMass(h[1])
-        if m_child is None or m_parent is None:
-            self._queued_heirarchies.append(h)
+        # Hints are resolved in one go when a batch is committed
+        h = (self.internName(h[0]), self.internName(h[1]))
+        if self._batch is not None:
+            self._batch.hierarchy.append(h)
             return
-
-        # Sanity check to make sure that we can proceed
-        if m_child._parent is not None:
-            raise ValueError(
-                ("Trying to add a parent (%s - %d) to a child (%s - %d) "
-                 "that already has a parent (%s). "
-                 "Operation not supported.") %
-                (m_parent.name, m_parent._level, m_child.name, m_child._level,
-                 m_child.m_parent.name))
-
-        # Look up the tree from the child, ensuring that all parents have a
-        # level greater than their child
-        m_child._parent = m_parent
-        m = m_child
-        while m._parent is not None:
-            if m._parent._level <= m._level:
-                m._parent._level = m._level + 1
-            m = m._parent
-
-        # # Attempt to add a hierarchy constraint if it is valid to do so
-        # if m_parent._parent is not None:
-        #     # Look for an existing matching hierarchical constraint
-        #     m_parent_of_parent = m_parent._parent
-        #     existing_constraint = next(
-        #         (c for c in self._constraints
-        #          if sorted([m_child, m_parent, m_parent_of_parent]) == sorted(
-        #              c.masses())), None)
-
-        #     # Add new hierarchical constraint if an existing one wasn't found
-        #     if existing_constraint is None:
-        #         c = ConstraintAngleLocal(m_child, m_parent, m_parent_of_parent,
-        #                                  np.pi, STIFF_S)
-        #         self.addConstraint(c)
-        #         print("\tAdded: %s" % (c))
+        self._resolveHierarchy(h)
 
     def addMass(self, m, place=True):
         """Adds a mass to the layout (only if it is new)"""
-        if m not in self._masses:
+        if self._batch is not None:
+            if not self._hasMass(m):
+                self._batch.addMass(m)
+                self.markSystemChanged()
+        elif not self._hasMass(m):
             # First try and add any queued level information to the mass
-            self._masses.append(m)
-            hs = self._queued_heirarchies
-            self._queued_heirarchies = []
-            for h in hs:
-                self.addHierarchy(h)
-            self._masses.pop()
+            symbol = self.internMass(m)
+            for h in self._queued_heirarchies.pop(symbol, []):
+                self._resolveHierarchy(h, {symbol: m})
 
             # Then perform the placement of the mass
             if place and not m.fixed:
                 self._placeMass(m)
             else:
-                self._masses.append(m)
+                self._appendMass(m)
 
             # if m.name:
             #     print("\tAdded: %s" % (m.name))
@@ -910,94 +1706,81 @@ class SpatialLayout(object):
             # Lastly, mark that the system state has been changed
             self.markSystemChanged()
 
+    @contextlib.contextmanager
+    def batch(self, place=True):
+        """Context manager for adding many constraints & masses at once
+
+        While in a batch, mass placement, hierarchy resolution, scale
+        observation updates, & state change notifications are deferred. They
+        are performed once when the outermost batch exits, with new masses
+        placed in the order that gives each the most placement suggestions.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        self._batch = _Batch(place=place)
+        try:
+            yield self._batch
+        finally:
+            b = self._batch
+            self._batch = None
+            self._commitBatch(b)
+
     def callInStep(self, fn, *args):
         """Adds a request to call a function with args in the next step"""
         self._to_call_list.append((fn, args))
 
+    def _commitBatch(self, b):
+        """Performs all of the work deferred by a batch"""
+        # Resolve hierarchy hints with the new masses available (so levels
+        # are correct before any placement happens)
+        for symbol in b.symbols:
+            for h in self._queued_heirarchies.pop(symbol, []):
+                self._resolveHierarchy(h, b.symbols)
+        for h in b.hierarchy:
+            self._resolveHierarchy(h, b.symbols)
+
+        # Place the new masses (each only consults its own constraints)
+        cs = self._constraintsByMass(b.masses)
+        for m in self._placementOrder(b.masses, cs):
+            if b.place and not m.fixed:
+                self._placeMass(m, cs[m])
+            else:
+                self._appendMass(m)
+
+        # Update scale observations, & notify of the change
+        if b.observed:
+            self._observeMasses(b.observed)
+        if b.state_changed:
+            self.markStateChanged()
+
     def executeWaitingCalls(self):
-        """Executes all calls waiting in the queue"""
-        while self._to_call_list:
-            to_call = self._to_call_list.popleft()
-            to_call[0](*to_call[1])
+        """Executes all calls waiting in the queue (as a single batch)"""
+        if not self._to_call_list:
+            return
+        with self.batch():
+            while self._to_call_list:
+                to_call = self._to_call_list.popleft()
+                to_call[0](*to_call[1])
+
+    def energy(self):
+        """Returns the kinetic & potential energy held in the layout"""
+        if not self._masses:
+            return 0, 0
+        table = self._constraintTable()
+        n = len(self._masses)
+        return (table.kineticEnergy(self._state[:n, 1]),
+                table.potentialEnergy(self._state[:n, 0]))
 
     def getMass(self, name):
         """Returns a mass with the requested name if it exists"""
-        return next((m for m in self._masses if m.name == name), None)
-
-    def getObservedDistances(self):
-        """Returns a list of observed distances (used with scale manager)"""
-        # Start with the list of fixed masses (a fixed mass by definition is an
-        # observed location in the environment)
-        observed_masses = {m.name: m.pos for m in self._masses if m.fixed}
-
-        # Get the list of label observations (through their constraints)
-        label_dist_constraints = [
-            c for c in self._constraints
-            if c._source == Constraint.SOURCE_LABEL and
-            type(c) == ConstraintDistance
-        ]
-        label_ang_constraints = [
-            c for c in self._constraints
-            if c._source == Constraint.SOURCE_LABEL and
-            type(c) == ConstraintAngleGlobal
-        ]
-        # print("OBSERVED DISTANCE LIST:")
-        # print("\tHave following label constraints:")
-        # for c in label_dist_constraints + label_ang_constraints:
-        #     print("\t\t%s" % (c))
-
-        # Add the location suggested by each label to the list of observed
-        # masses (observing the label 'observes' the place at some assumed
-        # relative position)
-        for dist_c in label_dist_constraints:
-            # Find the corresponding angular constraint
-            mass_label = (dist_c._mass_a
-                          if not dist_c._mass_a.fixed else dist_c._mass_b)
-            mass_fixed = (dist_c._mass_a
-                          if mass_label is dist_c._mass_b else dist_c._mass_b)
-            ang_c = next(
-                (c for c in label_ang_constraints if mass_label in c.masses()),
-                None)
-            if ang_c is None:
-                raise ValueError(
-                    "Angular constraint for observation of %s not found" %
-                    (mass_label.name))
-
-            # Determine the position suggested by the label observation
-            th = _angleWrap(ang_c._natural_length +
-                            (0 if mass_label == ang_c._mass_a else np.pi))
-            pos = mass_fixed.pos + dist_c._natural_length * np.array(
-                [np.cos(th), np.sin(th)])
-
-            # Add the observed label to the list
-            observed_masses[mass_label.name] = pos
-
-        # print("\tObserved masses:")
-        # for m in observed_masses:
-        #     print("\t\t%s" % (m))
-
-        # Get the list of distance constraints with both labels observed
-        observed_constraints = [
-            c for c in self._constraints
-            if type(c) == ConstraintDistance and c._mass_a.name in
-            observed_masses and c._mass_b.name in observed_masses
-        ]
-
-        # print("\tObserved distance constraints:")
-        # for c in observed_constraints:
-        #     print("\t\t%s - %s" % (c._mass_a.name, c._mass_b.name))
+        symbol = self._symbols.get(name, None)
+        return None if symbol is None else self.getMassBySymbol(symbol)
 
-        # Calculate the observed distance for each constraint
-        observations = []  # a list of ((levels tuple), distance, stiffness)
-        for c in observed_constraints:
-            d = c._mass_a.pos - c._mass_b.pos
-            observations.append(((c._mass_a._level, c._mass_b._level),
-                                 (d[0]**2 + d[1]**2)**0.5, c._stiffness))
-
-        # Filter out all observations of the distance between a label and place
-        # (it makes no sense because the system is incapable of assuming this
-        # distance it just gives it some arbitrary value)
-        return [o for o in observations if MASS_LEVEL_LABEL not in o[0]]
+    def getMassBySymbol(self, symbol):
+        """Returns a mass with the requested symbol ID if it exists"""
+        return (self._mass_symbols[symbol]
+                if 0 <= symbol < len(self._mass_symbols) else None)
 
     def initialiseState(self):
         """Initialises the state to best match provided constraints"""
@@ -1034,8 +1817,20 @@ class SpatialLayout(object):
         # Now place all of the masses in order (using the constraints to inform
         # placement)
         self._constraints = cs
+        self._detachMasses(ms)
+        cs = self._constraintsByMass(ms)
         for m in ms:
-            self._placeMass(m)
+            self._placeMass(m, cs[m])
+
+    def internMass(self, mass):
+        """Gives a mass the symbol ID (& canonical string) of its name"""
+        mass._symbol = self._symbols.intern(mass.name)
+        mass.name = self._symbols.name(mass._symbol)
+        return mass._symbol
+
+    def internName(self, name):
+        """Returns the symbol ID for a name (symbol IDs are passed through)"""
+        return name if isinstance(name, int) else self._symbols.intern(name)
 
     def isObserved(self, name):
         m = self.getMass(name)
@@ -1082,9 +1877,13 @@ class SpatialLayout(object):
 
     def markStateChanged(self):
         """Explicit declaration of a change of system state"""
+        if self._batch is not None:
+            self._batch.state_changed = True
+            return
         self.logEnergy()
         if self._post_state_change_fcn is not None:
-            self._post_state_change_fcn(self)
+            with self._profiler.timer('publish'):
+                self._post_state_change_fcn(self)
 
     def markSystemChanged(self, reset_history=False):
         """Explicit declaration of a change in system structure"""
@@ -1097,18 +1896,24 @@ class SpatialLayout(object):
 
         # Record system change & mark state change (system change changes state)
         self._system_changed = True
+        self._system_version += 1
         self.markStateChanged()
 
+    def setProcessPool(self, pool):
+        """Sets a process pool for integrating independent parts (or None)
+
+        The pool is owned by the caller (the layout never closes it).
+        """
+        self._pool = pool
+
     def step(self):
         """Performs a single iteration of the spatial layout optimisation"""
         # Execute any waiting functions before we start the step
-        self.executeWaitingCalls()
+        with self._profiler.timer('calls'):
+            self.executeWaitingCalls()
 
         # Return from here until new / modified SSI unpauses the network
         if self._paused:
-            if self._log is not None:
-                self._log_file.write("UNPAUSED!\n")
-                self._log_file.flush()
             time.sleep(PAUSED_SLEEP_CYCLE)
             return
 
@@ -1122,35 +1927,54 @@ class SpatialLayout(object):
             self._ode.set_initial_value(self._pullState(), self._ode.t)
             self._system_changed = False
 
-        # Perform a step with the ODE integrator
-        ta = time.time()
-        state = np.copy(self._ode.y)
-        state_next = self._ode.integrate(self._ode.t + INTEGRATION_DT)
-        if self._log is not None:
-            self._log['a'].append(self._ode.t)
-            self._log['b'].append(time.time() - ta)
-            self._log_file.write("INT\n")
-            self._log_file.flush()
+        # Perform a step with the ODE integrator (or the pool, if the layout
+        # has large enough independent parts, or the compiled kernels)
+        self._profiler.count('steps')
+        with self._profiler.timer('integrate'):
+            state = np.copy(self._ode.y)
+            state_next = (None if self._pool is None else
+                          self._integrateInPool(state))
+            if state_next is None and self._kernelsEnabled():
+                state_next = kernels.integrate(
+                    state.reshape(-1, 2, 2), INTEGRATION_DT,
+                    self._kernelForces()).reshape(-1)
+            if state_next is None:
+                state_next = self._ode.integrate(self._ode.t +
+                                                 INTEGRATION_DT)
+            else:
+                self._ode.set_initial_value(state_next,
+                                            self._ode.t + INTEGRATION_DT)
 
         # Safely apply the suggested new state
-        ta = time.time()
-        # self._pushState(state_next)
-        self._pushStateSafely(state, state_next)
-        if self._log is not None:
-            self._log['c'].append(time.time() - ta)
-            self._log_file.write("STEPPED\n")
-            self._log_file.flush()
+        with self._profiler.timer('collision'):
+            self._pushStateSafely(state, state_next)
 
         # Record the true state derivative and mark system state change
-        ta = time.time()
-        self._refreshForces()
-        self._state_derivative = np.concatenate(
-            [np.concatenate((m.vel, m.acc)) for m in self._masses])
+        with self._profiler.timer('forces'):
+            self._refreshForces()
+            self._state_derivative = self._state[:len(self._masses),
+                                                 1:3].reshape(-1)
         self.markStateChanged()
-        if self._log is not None:
-            self._log['d'].append(time.time() - ta)
-            self._log_file.write("DONE\n")
-            self._log_file.flush()
+        self._profiler.tick()
+
+    def _resolveHierarchy(self, h, extra_masses={}):
+        """Applies a (child, parent) symbol hint (queued if a mass is missing)
+
+        Masses in extra_masses (by symbol) are treated as if they were already
+        in the layout.
+        """
+        m_child = self.getMassBySymbol(h[0])
+        if m_child is None:
+            m_child = extra_masses.get(h[0], None)
+        m_parent = self.getMassBySymbol(h[1])
+        if m_parent is None:
+            m_parent = extra_masses.get(h[1], None)
+
+        if m_child is None or m_parent is None:
+            missing = h[0] if m_child is None else h[1]
+            self._queued_heirarchies.setdefault(missing, []).append(h)
+        else:
+            self._applyHierarchy(m_child, m_parent)
 
     def resetEnergyLog(self):
         """Resets the energy log"""
@@ -1164,6 +1988,7 @@ class SpatialLayout(object):
             m.pos[1] = (random.random() - 0.5) * window_size
             m.vel = np.zeros_like(m.vel)
             m.acc = np.zeros_like(m.acc)
+        self._state_version += 1
 
         # Mark that the system state has been changed
         self.markSystemChanged(reset_history=True)
@@ -1186,21 +2011,38 @@ class SpatialLayout(object):
         # ]
 
         # Update the constraints (keeping the previous pause status)
-        self._constraints = constraints_keep
-        paused = self._paused
-        self.addConstraints(cs)
-        self._paused = paused
+        with self.batch():
+            self._constraints = constraints_keep
+            self._constraint_table = None
+            paused = self._paused
+            self.addConstraints(cs)
+            self._paused = paused
+
+            # Mark that the system state has been changed
+            self.markStateChanged()
 
-        # Mark that the system state has been changed
-        self.markStateChanged()
+    def useKernels(self, enabled=True):
+        """Sets if compiled kernels are used, returning if they will be
+
+        Kernels are only used if Numba is installed (the NumPy implementation
+        is used otherwise). Results match within floating point tolerance.
+        """
+        self._kernels = enabled
+        return self._kernelsEnabled()
 
 
 def _angle(mass_a, mass_b, mass_c=None):
     """Compute the angle formed by mass a, relative to b (and optionally c) """
-    v_ab = mass_a.pos - mass_b.pos
+    return _anglePositions(mass_a.pos, mass_b.pos,
+                           None if mass_c is None else mass_c.pos)
+
+
+def _anglePositions(pos_a, pos_b, pos_c=None):
+    """Compute the angle formed by pos a, relative to b (and optionally c) """
+    v_ab = pos_a - pos_b
     ret = np.arctan2(v_ab[1], v_ab[0])
-    if mass_c is not None:
-        v_cb = mass_c.pos - mass_b.pos
+    if pos_c is not None:
+        v_cb = pos_c - pos_b
         ret -= np.arctan2(v_cb[1], v_cb[0])
 
     return _angleWrap(ret)
@@ -1215,6 +2057,24 @@ def _angleWrap(angle):
     return ret - np.pi
 
 
+def _angleWrapArray(angles):
+    """Returns an array of angles, each in the range of [-PI,+PI)"""
+    return np.mod(angles + np.pi, 2 * np.pi) - np.pi
+
+
+def _slotNames(cls):
+    """Returns the names of all slots declared by a class & its bases"""
+    return [n for c in cls.__mro__ for n in c.__dict__.get('__slots__', ())]
+
+
+def _convexHull(points):
+    """Returns indices of the convex hull vertices of an (n x 2) point array"""
+    # scipy.spatial is only needed once a layout has 3 or more masses, so it
+    # isn't imported until then (keeps importing the module cheap)
+    import scipy.spatial as sp
+    return sp.ConvexHull(points).vertices
+
+
 def _distance(mass_a, mass_b):
     """Computes the distance between two masses"""
     ab = mass_a.pos - mass_b.pos
@@ -1254,6 +2114,115 @@ def _firstCircleIntersect(line_a, line_b, circle_center, circle_r):
             (d2[0]**2 + d2[1]**2)**0.5 else intersect_2)
 
 
+def _integrateComponent(table, y, coem):
+    """Integrates a step of (n x 2 x 2) states, with forces from a table
+
+    Module level, so it can be the target of a process pool.
+    """
+    def f(y):
+        d = np.empty_like(y)
+        d[:, 0] = y[:, 1]
+        d[:, 1] = table.accelerations(y[:, 0], y[:, 1], coem)
+        return d
+
+    k1 = f(y)
+    k2 = f(y + INTEGRATION_DT * 0.5 * k1)
+    k3 = f(y + INTEGRATION_DT * 0.5 * k2)
+    k4 = f(y + INTEGRATION_DT * k3)
+    return y + (1. / 6.) * (k1 + 2 * k2 + 2 * k3 + k4) * INTEGRATION_DT
+
+
+def _labelPlaces(constraints):
+    """Returns the places observed by the label distance constraints"""
+    return [
+        c._mass_b if c._mass_a.fixed else c._mass_a
+        for c in constraints
+        if c._source == Constraint.SOURCE_LABEL and
+        type(c) == ConstraintDistance
+    ]
+
+
+def _labelPositions(constraints):
+    """Returns the position each label's constraints put its place at"""
+    angles = {}
+    for c in constraints:
+        if (c._source == Constraint.SOURCE_LABEL and
+                type(c) == ConstraintAngleGlobal):
+            angles[c._mass_b if c._mass_a.fixed else c._mass_a] = c
+    positions = {}
+    for c in constraints:
+        if (c._source != Constraint.SOURCE_LABEL or
+                type(c) != ConstraintDistance):
+            continue
+        m_fixed, m = ((c._mass_a, c._mass_b) if c._mass_a.fixed else
+                      (c._mass_b, c._mass_a))
+        ang_c = angles.get(m, None)
+        if ang_c is None:
+            raise ValueError(
+                "Angular constraint for observation of %s not found" %
+                (m.name))
+        th = _angleWrap(ang_c._natural_length +
+                        (0 if m is ang_c._mass_a else np.pi))
+        positions[m] = m_fixed.pos + c._natural_length * np.array(
+            [np.cos(th), np.sin(th)])
+    return positions
+
+
+def _localAnglePlacement(pos_a, pos_c, angle):
+    """Returns (r, th) from a, placing b so angle a-b-c is the desired angle
+
+    The distance r from a is (1 - |angle| / 2PI) * |ac|, & th comes from
+    solving the triangle abc (law of sines) in closed form.
+    """
+    ac = pos_c - pos_a
+    d = (ac[0]**2 + ac[1]**2)**0.5
+    beta = min(np.absolute(angle), np.pi)
+    r = (1 - beta / (2 * np.pi)) * d
+    gamma = np.arcsin(min(1.0, (1 - beta / (2 * np.pi)) * np.sin(beta)))
+    return r, _angleWrap(
+        np.arctan2(ac[1], ac[0]) - np.sign(angle) * (np.pi - beta - gamma))
+
+
+def _mergePlacementSuggestions(ps):
+    """Merges an array of suggestions into one per reference mass
+
+    Distances are merged with a weighted mean, & angles with a weighted
+    circular mean. The merged suggestions are ordered so r only suggestions
+    come first, then th only suggestions, then those with both.
+    """
+    symbols, first, group = np.unique(ps['symbol'],
+                                      return_index=True,
+                                      return_inverse=True)
+    n = len(symbols)
+    has_r = ~np.isnan(ps['r'])
+    has_th = ~np.isnan(ps['th'])
+    w_r = np.where(has_r, ps['r_weight'], 0)
+    w_th = np.where(has_th, ps['th_weight'], 0)
+
+    merged = np.empty(n, dtype=PLACEMENT_DTYPE)
+    merged['symbol'] = symbols
+    merged['index'] = ps['index'][first]
+    merged['r_weight'] = np.bincount(group, w_r, n)
+    merged['th_weight'] = np.bincount(group, w_th, n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged['r'] = np.where(
+            np.bincount(group, has_r, n) > 0,
+            np.bincount(group,
+                        np.where(has_r, ps['r'], 0) * w_r, n) /
+            merged['r_weight'], np.nan)
+    ths = np.where(has_th, ps['th'], 0)
+    merged['th'] = np.where(
+        np.bincount(group, has_th, n) > 0,
+        np.arctan2(np.bincount(group,
+                               np.sin(ths) * w_th, n),
+                   np.bincount(group,
+                               np.cos(ths) * w_th, n)), np.nan)
+
+    m_r = ~np.isnan(merged['r'])
+    m_th = ~np.isnan(merged['th'])
+    return merged[np.argsort(2 * (m_r & m_th) + m_th, kind='mergesort')]
+
+
 def _reflectedDirection(velocity, reflect_point, reflect_origin, outside=True):
     """Gets the direction of reflection from a given point"""
     # Here we do reflection based on input velocity direction relative to the
@@ -1306,3 +2275,28 @@ def _uv(mass_a, mass_b):
 
 def _orthog(vector):
     return np.array([-vector[1], vector[0]])
+
+
+def _orthogArray(vectors):
+    """Returns the orthogonal of each of an (... x 2) array of vectors"""
+    return np.stack((-vectors[..., 1], vectors[..., 0]), -1)
+
+
+def _scatterAdd(index, values, n):
+    """Sums (... x k x 2) values into (... x n x 2) rows given by index"""
+    lead = values.shape[:-2]
+    b = int(np.prod(lead))
+    rows = (np.arange(b)[:, np.newaxis] * n + index).ravel()
+    return np.bincount((2 * rows[:, np.newaxis] + [0, 1]).ravel(),
+                       weights=values.ravel(),
+                       minlength=2 * b * n).reshape(lead + (n, 2))
+
+
+def _uvArray(vectors):
+    """Returns the unit vector of each of an (... x 2) array of vectors
+
+    Zero vectors give [1, 0], matching _uv().
+    """
+    norms = np.hypot(vectors[..., 0], vectors[..., 1])[..., np.newaxis]
+    return np.where(norms > 0, vectors / np.where(norms > 0, norms, 1),
+                    [1, 0])
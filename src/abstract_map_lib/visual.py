@@ -2,18 +2,22 @@ from __future__ import absolute_import
 import abc
 from enum import Enum
 import itertools
+import mmap
 import multiprocessing as mp
 import numpy as np
-import operator
 import os
+import pickle
 import sys
+import tempfile
 import threading
 import time
 import warnings
 
 import pyqtgraph as pg
+import pyqtgraph.exporters
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 
+import abstract_map_lib.occupancy as occupancy
 import abstract_map_lib.spatial_layout as sl
 import abstract_map_lib.tools as tools
 
@@ -63,10 +67,27 @@ _SL_NODES_FIXED_PEN = pg.mkPen(_C3)
 _SL_NODES_FIXED_BRUSH = pg.mkBrush(_C3)
 _SL_GROWTH_FACTOR = 2
 
+# Labels are only drawn when zoomed in to at least _SL_LABEL_MIN_PPM pixels per
+# metre, with the threshold dropping by _SL_LABEL_LOD_GROWTH for each level up
+# the hierarchy (so only the biggest places stay labelled when zoomed out)
+_SL_LABEL_MIN_PPM = 8
+_SL_LABEL_LOD_GROWTH = 2
+
 # Random settings
 _OVERLAY_WIDTH = 1000
 _OVERLAY_HEIGHT = 1000
 
+# Size (bytes) of the shared memory ring AsyncController ships arrays through,
+# where the ring's file is created (if the directory exists), & how long
+# (seconds) to wait for the render process to map it before it is unlinked
+SHARED_RING_SIZE = 2**26
+_SHARED_RING_DIR = '/dev/shm'
+_SHARED_RING_OPEN_TIMEOUT = 30
+
+# Size (pixels) of offscreen windows, & the name of each rendered frame file
+OFFSCREEN_SIZE = (1280, 720)
+FRAME_FILENAME = 'frame_%06d.png'
+
 # pyplotgraph global configuration settings
 pg.setConfigOptions(antialias=True, imageAxisOrder='row-major')
 
@@ -113,6 +134,7 @@ class WindowType(Enum):
     """Enum for representing a window type request"""
     DEFAULT = 0
     IMMERSIVE = 1
+    OFFSCREEN = 2  # Immersive, but never shown (for rendering to images)
 
 
 class Visualiser(object):
@@ -123,6 +145,8 @@ class Visualiser(object):
         self._win_type = window_type
         self._dark = dark
         self._layer_items = {}  # Dict of items for each visual "layer"
+        self._labelled = {}  # Spatial layout last drawn on each layer
+        self._updated_type = None  # Type of the object last given to update()
 
         self._overlay_items = []  # List of items for an overlay over the graph
 
@@ -145,6 +169,22 @@ class Visualiser(object):
             self._plt.setAspectLocked(True, 1)
             self._plt.hideAxis('left')
             self._plt.hideAxis('bottom')
+        elif self._win_type == WindowType.OFFSCREEN:
+            pg.setConfigOptions(
+                foreground='d',
+                background=(_DARK_COLOUR if self._dark else _LIGHT_COLOUR))
+            pg.mkQApp()
+            self._win = pg.PlotWidget()
+            self._win.resize(*OFFSCREEN_SIZE)
+
+            # "Shown" without ever reaching the screen, so the plot gets laid
+            # out at the size of the window
+            self._win.setAttribute(QtCore.Qt.WA_DontShowOnScreen)
+            self._win.show()
+            self._plt = self._win.getPlotItem()
+            self._plt.setAspectLocked(True, 1)
+            self._plt.hideAxis('left')
+            self._plt.hideAxis('bottom')
         else:  # DEFAULT
             pg.setConfigOptions(foreground='k', background='w')
             self._win = pg.plot(title="Abstact Map Visualisation")
@@ -166,14 +206,22 @@ class Visualiser(object):
         limit = 30
         self._win.setRange(xRange=[-limit, limit], yRange=[-limit, limit])
 
+        # Labels are culled by the view, so they change whenever it does
+        self._plt.getViewBox().sigRangeChanged.connect(self._cbRangeChanged)
+
+    def _cbRangeChanged(self, *args):
+        """Callback to redo the labels of layouts when the view changes"""
+        for layer, layout in self._labelled.items():
+            items = self._layer_items.get(layer, [])
+            if items:
+                Visualiser._setLayer(self._drawLabels(layout, items), layer)
+
     def _drawEnergyLog(self, energy_log, layer=0, existing=[]):
         """Draws the energy log of a spatial layout"""
         self._clearLayer(layer)
 
         self._plt.plot(energy_log.t,
-                       list(
-                           map(operator.add, energy_log.kinetic,
-                               energy_log.potential)),
+                       energy_log.kinetic + energy_log.potential,
                        pen=_EL_TOTAL_PEN)
         self._plt.plot(energy_log.t, energy_log.kinetic, pen=_EL_KINETIC_PEN)
         self._plt.plot(energy_log.t,
@@ -200,6 +248,8 @@ class Visualiser(object):
             fn = self._drawGoal
         elif type(obj) is MapPrimitive:
             fn = self._drawOccupancyGrid
+        elif type(obj) is occupancy.OccupancyPyramid:
+            fn = self._drawOccupancyPyramid
         elif type(obj) is PathPrimitive:
             fn = self._drawPath
         elif type(obj) is PosePrimitive:
@@ -240,6 +290,59 @@ class Visualiser(object):
         Visualiser._setLayer(items, layer)
         return items
 
+    def _drawOccupancyPyramid(self, pyramid, layer=0, existing=[]):
+        """Draws the pyramid level matching the zoom, as tiles of images
+
+        Only tiles that changed since the last draw are uploaded again,
+        unless the zoom calls for a different level (or the map was rebuilt).
+        """
+        items = existing
+        if not items:
+            # 0 is a dict of image items for each tile, 1 is the (level,
+            # version) of the pyramid currently drawn
+            items.extend([{}, None])
+        if not pyramid.levels:
+            return items
+        k = pyramid.levelForScale(
+            1.0 / max(self._plt.getViewBox().viewPixelSize()[0], 1e-9))
+        dirty = pyramid.takeDirty()
+        data = pyramid.levels[k]
+        t = pyramid.tileSize()
+        if items[1] != (k, pyramid.version):
+            tiles = [(ty, tx)
+                     for ty in range(0, (data.shape[0] - 1) // t + 1)
+                     for tx in range(0, (data.shape[1] - 1) // t + 1)]
+            for tile in set(items[0]) - set(tiles):
+                items[0][tile].hide()
+            items[1] = (k, pyramid.version)
+        else:
+            tiles = [d[1:] for d in dirty if d[0] == k]
+
+        # Upload the tiles (the fixed levels keep colours the same in every
+        # tile, rather than scaling each tile to its own range)
+        info = pyramid.info
+        cell = info.resolution * 2**k
+        new_items = []
+        for ty, tx in tiles:
+            image = data[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+            item = items[0].get((ty, tx), None)
+            if item is None:
+                item = pg.ImageItem(image=image,
+                                    lut=_OCC_LOOKUP_TABLE,
+                                    levels=(-1, 100))
+                self._plt.addItem(item)
+                items[0][(ty, tx)] = item
+                new_items.append(item)
+            else:
+                item.setImage(image=image, autoLevels=False)
+                item.show()
+            item.setRect(
+                QtCore.QRectF(info.origin_x + tx * t * cell,
+                              info.origin_y + ty * t * cell,
+                              image.shape[1] * cell, image.shape[0] * cell))
+        Visualiser._setLayer(new_items, layer)
+        return items
+
     def _drawPath(self, path, layer=0, existing=[]):
         """Draws a path assuming the coordinate frame matches the plot"""
         items = existing
@@ -281,25 +384,26 @@ class Visualiser(object):
         # Get a starting list of existing items
         items = existing
         if not items:
-            # 0 is series of lines for each constraint, 1 is a dict of mass
-            # plots for each level, 2 is all labels
-            items.extend([[], {}, {}])
-
-        # Update the constraints (adding if we are missing one)
-        it = iter(items[0])
-        for c in layout._constraints:
-            ps = np.concatenate([m.pos for m in c.masses()])
-            constraint_plot = next(it, None)
-            if constraint_plot is None:
-                constraint_plot = self._plt.plot(ps[::2],
-                                                 ps[1::2],
-                                                 pen=_SL_LINES_PEN)
-                items[0].append(constraint_plot)
-            else:
-                constraint_plot.setData(ps[::2], ps[1::2])
+            # 0 is a single item with a line segment for each constraint, 1
+            # is a dict of mass plots for each level, 2 is all labels, & 3 is
+            # the set of labels currently shown
+            items.extend([None, {}, {}, set()])
+        new_items = []
+
+        # Update the constraints (segments are pairs of vertices, indexed out
+        # of the mass positions all at once)
+        ps = layout._constraintTable().segments(
+            layout._state[:len(layout._masses), 0])
+        if items[0] is None:
+            items[0] = self._plt.plot(ps[:, 0],
+                                      ps[:, 1],
+                                      pen=_SL_LINES_PEN,
+                                      connect='pairs')
+            new_items.append(items[0])
+        else:
+            items[0].setData(ps[:, 0], ps[:, 1])
 
         # Update the masses by level (adding a level if needed...)
-        label_parents = {}
         for level, g in itertools.groupby(
                 sorted(layout._masses, key=lambda x: x._level),
                 lambda x: x._level):
@@ -324,33 +428,56 @@ class Visualiser(object):
                                             symbolPen=s_pen,
                                             symbolBrush=s_brush)
                 items[1][level] = level_plot
+                new_items.append(level_plot)
             else:
                 level_plot.setData(ps[::2], ps[1::2])
 
-            # Save the data to help in labelling
-            for i, m in enumerate(ms):
-                label_parents[m.name] = (level_plot, i)
+        new_items.extend(self._drawLabels(layout, items))
+        self._labelled[layer] = layout
+
+        # Add a title if appropriate
+        if layout._energy_log is not None and len(layout._energy_log):
+            self._plt.setTitle("t = %f" % (layout._energy_log.t[-1]))
+
+        # Finish up (only new items need to be put in the layer)
+        Visualiser._setLayer(new_items, layer)
+        return items
 
-        # Update all of the mass labels
-        for m in layout._masses:
-            label_item = items[2].get(m.name, None)
+    def _drawLabels(self, layout, items):
+        """Updates the mass labels of a drawn layout, returning new items
+
+        Labels are keyed by symbol (not name), & only the labels that are in
+        view & legible at the current zoom are touched.
+        """
+        new_items = []
+        ps = layout._state[:len(layout._masses), 0]
+        (x_min, x_max), (y_min, y_max) = self._plt.viewRange()
+        ppm = 1.0 / max(self._plt.getViewBox().viewPixelSize()[0], 1e-9)
+        levels = np.maximum([m._level for m in layout._masses], 0)
+        visible = ((ps[:, 0] >= x_min) & (ps[:, 0] <= x_max) &
+                   (ps[:, 1] >= y_min) & (ps[:, 1] <= y_max) &
+                   (ppm * _SL_LABEL_LOD_GROWTH**levels >= _SL_LABEL_MIN_PPM))
+        shown = set()
+        for m, p in zip(itertools.compress(layout._masses, visible),
+                        ps[visible]):
+            label_item = items[2].get(m._symbol, None)
             if label_item is None:
                 label_item = pg.TextItem(
                     text=m.name,
                     color=(_LIGHT_COLOUR if self._dark else _DARK_COLOUR),
                     anchor=(0.5, 0))
-                label_item.setParentItem(pg.CurvePoint(*label_parents[m.name]))
-                items[2][m.name] = label_item
-            else:
-                label_item.setParentItem(pg.CurvePoint(*label_parents[m.name]))
-
-        # Add a title if appropriate
-        if layout._energy_log is not None and layout._energy_log.t:
-            self._plt.setTitle("t = %f" % (layout._energy_log.t[-1]))
-
-        # Finish up
-        Visualiser._setLayer(tools.flatten(items), layer)
-        return items
+                self._plt.addItem(label_item)
+                items[2][m._symbol] = label_item
+                new_items.append(label_item)
+            elif m._symbol not in items[3]:
+                label_item.show()
+            label_item.setPos(p[0], p[1])
+            shown.add(m._symbol)
+        for symbol in items[3] - shown:
+            if symbol in items[2]:
+                items[2][symbol].hide()
+        items[3] = shown
+        return new_items
 
     def _existingLayerItems(self, layer):
         """Attempts to get any existing layer items"""
@@ -383,6 +510,7 @@ class Visualiser(object):
         """Clears the entire window"""
         self._plt.clear()
         self._layer_items = {}
+        self._labelled = {}
 
     def close(self):
         """Closes the visualiser"""
@@ -395,6 +523,10 @@ class Visualiser(object):
         self._layer_items[layer] = self._drawFnFromType(obj)(
             obj, layer=layer, existing=self._layer_items.get(layer, []))
 
+    def saveImage(self, filename):
+        """Saves the current contents of the plot to an image file"""
+        pg.exporters.ImageExporter(self._plt).export(filename)
+
     def show(self):
         """Blunt tool to force showing of any updates"""
         QtGui.QGuiApplication.processEvents()
@@ -406,6 +538,18 @@ class Visualiser(object):
         else:
             self._overlay_items[0].hide()
 
+    def update(self, obj):
+        """Redraws an object, reusing the items drawn for the last object
+
+        The window is only cleared if the last object was of another type (or
+        its drawing method doesn't keep its items).
+        """
+        if type(obj) is not self._updated_type or not self._layer_items.get(0):
+            self.clear()
+            self._updated_type = type(obj)
+        self.draw(obj)
+        self.show()
+
     def visualise(self, obj):
         """Immediately visualises an object"""
         self.clear()
@@ -413,6 +557,131 @@ class Visualiser(object):
         self.show()
 
 
+# Offscreen visualiser (& fixed view range) of a frame rendering worker
+_render_visualiser = None
+_render_range = None
+
+
+def _renderInit(size, x_range, y_range, dark):
+    """Process pool initialiser, giving a worker an offscreen visualiser"""
+    global _render_visualiser, _render_range
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    _render_visualiser = Visualiser(window_type=WindowType.OFFSCREEN,
+                                    dark=dark)
+    _render_visualiser._win.resize(*size)
+    _render_range = None if x_range is None else (x_range, y_range)
+
+
+def _renderFrame(args):
+    """Process pool target, rendering a single frame to an image file"""
+    filename, obj = args
+    if isinstance(obj, bytes):
+        obj = pickle.loads(obj)
+    obj = getattr(obj, '_spatial_layout', obj)  # Abstract maps draw layouts
+    v = _render_visualiser
+    v.clear()
+    if _render_range is not None:
+        v._plt.setRange(xRange=_render_range[0],
+                        yRange=_render_range[1],
+                        padding=0)
+    v.draw(obj)
+    if _render_range is None:
+        # Without a fixed range, each frame is fit to everything drawn in it
+        v._plt.autoRange()
+    v.show()
+    v.saveImage(filename)
+    return filename
+
+
+def renderFrames(frames,
+                 directory,
+                 processes=None,
+                 size=OFFSCREEN_SIZE,
+                 x_range=None,
+                 y_range=None,
+                 dark=False):
+    """Renders frames to numbered image files, in parallel across processes
+
+    Frames are drawable objects (or abstract maps), or the pickled bytes of
+    one (which only get unpickled by the worker rendering the frame). Every
+    worker draws with its own offscreen visualiser. Files are numbered in
+    the order the frames are given, & the list of filenames is returned.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pool = mp.Pool(processes,
+                   initializer=_renderInit,
+                   initargs=(size, x_range, y_range, dark))
+    try:
+        filenames = pool.map(
+            _renderFrame,
+            [(os.path.join(directory, FRAME_FILENAME % i), f)
+             for i, f in enumerate(frames)],
+            chunksize=1)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return filenames
+
+
+class _SharedRing(object):
+    """Ring buffer of arrays, in a memory mapped file shared by processes
+
+    The first 8 bytes hold the total number of bytes ever written, so a
+    reader can tell if the array it was pointed at has since been overwritten
+    (arrays are never split across the end of the ring).
+    """
+    _HEADER = 8
+
+    def __init__(self, path, size=None):
+        """Opens the ring at path (creating it if a size is given)"""
+        if size is not None:
+            with open(path, 'wb') as f:
+                f.truncate(_SharedRing._HEADER + size)
+        self.path = path
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._written = np.frombuffer(self._mmap, np.uint64, 1)
+        self._data = np.frombuffer(self._mmap,
+                                   np.uint8,
+                                   offset=_SharedRing._HEADER)
+        self.size = len(self._data)
+
+    def close(self):
+        """Closes the ring (the views must go before the map can close)"""
+        self._written = None
+        self._data = None
+        self._mmap.close()
+        self._file.close()
+
+    def read(self, start, dtype, shape):
+        """Copies an array out of the ring (None if it was overwritten)"""
+        o = start % self.size
+        n = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        a = np.array(self._data[o:o + n]).view(dtype).reshape(shape)
+        return None if int(self._written[0]) > start + self.size else a
+
+    def write(self, array):
+        """Writes an array to the ring, returning where it starts (or None)"""
+        a = np.ascontiguousarray(array)
+        if a.nbytes > self.size:
+            return None
+        start = int(self._written[0])
+        o = start % self.size
+        if o + a.nbytes > self.size:
+            start += self.size - o
+            o = 0
+
+        # Claim the bytes before writing them, so a reader of whatever was
+        # there before knows it is being overwritten
+        self._written[0] = start + a.nbytes
+        self._data[o:o + a.nbytes] = a.reshape(-1).view(np.uint8)
+        return start
+
+
 class _Updater(object):
     """Manages the update cycle of a visualiser object"""
 
@@ -468,7 +737,7 @@ class BasicController(_Controller):
         """Constructor which attaches to a specified visualiser"""
         super(BasicController, self).__init__()
         self._visualiser = visualiser
-        self._updater = _Updater(visualiser.visualise, rate)
+        self._updater = _Updater(visualiser.update, rate)
         self._visualiser._win.keyPressEvent = (
             lambda ev: self.processKey(ev.key()))
 
@@ -489,13 +758,19 @@ class BasicController(_Controller):
 class AsyncController(_Controller):
     """Class for interfacing with a visualiser on another thread"""
 
-    def __init__(self, pipe, rate=10):
-        """Constructor for attaching the controller to a specified pipe"""
+    def __init__(self, pipe, rate=10, ring=None):
+        """Constructor for attaching the controller to a specified pipe
+
+        If a shared ring is provided, arrays are shipped through it (with
+        only a small control message over the pipe).
+        """
         super(AsyncController, self).__init__()
         self._pipe = pipe
         self._pipe_thread = threading.Thread(target=self._pipe_monitor)
-        self._updater = _Updater(self._pipe.send, rate)
+        self._ring = ring
+        self._updater = _Updater(self._send, rate)
         self._is_closed = False
+        self._sent_layout = None  # Layout (& system version) last pickled
 
         self._pipe_thread.start()
 
@@ -506,25 +781,96 @@ class AsyncController(_Controller):
                 recv_obj = self._pipe.recv()
                 self.processKey(recv_obj)
 
+    def _send(self, obj):
+        """Sends an object, shipping its arrays through the ring if possible"""
+        # A layout is only pickled when its structure has changed, otherwise
+        # only the positions of its masses need to be sent
+        if self._ring is not None and type(obj) is sl.SpatialLayout:
+            key = (id(obj), obj._system_version)
+            if key == self._sent_layout:
+                n = len(obj._masses)
+                start = self._ring.write(obj._state[:n, 0])
+                if start is not None:
+                    self._pipe.send(
+                        ('positions', start, n, None
+                         if obj._energy_log is None else
+                         obj._energy_log.latest()))
+                    return
+            self._sent_layout = key
+            self._pipe.send(obj)
+            return
+
+        # Anything else replaces the layout at the other end (so the next
+        # layout has to be pickled in full again)
+        self._sent_layout = None
+        if self._ring is not None and type(obj) is MapPrimitive:
+            start = self._ring.write(obj.data)
+            if start is not None:
+                self._pipe.send(('map', start, obj.data.dtype.str,
+                                 obj.data.shape, obj.resolution,
+                                 obj.top_left_pose))
+                return
+        self._pipe.send(obj)
+
+    @staticmethod
+    def _unpack(msg, latest_object, ring):
+        """Returns the object to draw after a control message is received
+
+        Positions are written into the latest layout (if they match it), &
+        frames that were overwritten in the ring before being read are
+        dropped (leaving the latest object unchanged).
+        """
+        if msg[0] == 'positions':
+            _, start, n, sample = msg
+            if (type(latest_object) is not sl.SpatialLayout or
+                    len(latest_object._masses) != n):
+                return latest_object
+            ps = ring.read(start, float, (n, 2))
+            if ps is not None:
+                latest_object._state[:n, 0] = ps
+                if (sample is not None and
+                        latest_object._energy_log is not None):
+                    latest_object._energy_log.logSample(*sample)
+            return latest_object
+        elif msg[0] == 'map':
+            _, start, dtype, shape, resolution, top_left_pose = msg
+            data = ring.read(start, dtype, shape)
+            return (latest_object if data is None else
+                    MapPrimitive(data, resolution, top_left_pose))
+        return latest_object
+
     @staticmethod
-    def _target(pipe, window_type=WindowType.DEFAULT, rate=10):
+    def _target(pipe,
+                window_type=WindowType.DEFAULT,
+                rate=10,
+                ring_path=None):
         """The target of async requests, where an async visualiser is run"""
+        # Map the ring first, & confirm so its file can be unlinked
+        ring = None
+        if ring_path is not None:
+            ring = _SharedRing(ring_path)
+            pipe.send('ring')
+
         # Create a visualiser and an updater to control the visualiser (we
         # want to be discarding updates that we don't have time to visualise)
         v = Visualiser(window_type=window_type)
         v._win.keyPressEvent = lambda ev: pipe.send(ev.key())
 
-        updater = _Updater(v.visualise, rate)
+        updater = _Updater(v.update, rate)
 
-        # Run the main loop, polling for new data over the pipe, and using the
-        # updater to control updating of the visualiser
+        # Run the main loop, waiting (up to a frame) for new data over the
+        # pipe, and using the updater to control updating of the visualiser
         quit = False
         latest_object = None
         while not quit:
             # Get any waiting data on the pipe
-            if pipe.poll():
+            v.show()
+            if pipe.poll(1.0 / rate):
                 recv_obj = pipe.recv()
-                if recv_obj == "close":
+                if isinstance(recv_obj, tuple):
+                    latest_object = AsyncController._unpack(
+                        recv_obj, latest_object, ring)
+                elif recv_obj == "close":
                     quit = True
                 elif (isinstance(recv_obj, basestring) and
                       recv_obj.startswith("range")):
@@ -539,22 +885,40 @@ class AsyncController(_Controller):
                 updater.update(latest_object)
 
         # We are here because we are quitting, close the visualiser
+        if ring is not None:
+            ring.close()
         v.close()
 
     def close(self):
         """Closes the visualiser"""
         self._pipe.send("close")
         self._is_closed = True
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
 
     @staticmethod
     def create(window_type=WindowType.DEFAULT, rate=10):
         """Function for creating an async controller from basic info"""
         pipe_target, pipe_controller = mp.Pipe(duplex=True)
-        controller = AsyncController(pipe_controller)
+        fd, ring_path = tempfile.mkstemp(
+            prefix='abstract_map_visual_',
+            dir=(_SHARED_RING_DIR
+                 if os.path.isdir(_SHARED_RING_DIR) else None))
+        os.close(fd)
+        ring = _SharedRing(ring_path, SHARED_RING_SIZE)
         p = mp.Process(target=AsyncController._target,
-                       args=(pipe_target, window_type, rate))
+                       args=(pipe_target, window_type, rate, ring_path))
         p.start()
-        return controller
+
+        # The ring's file is unlinked once both processes have it mapped, so
+        # it is never left behind (even if a process crashes)
+        try:
+            if pipe_controller.poll(_SHARED_RING_OPEN_TIMEOUT):
+                pipe_controller.recv()
+        finally:
+            os.remove(ring_path)
+        return AsyncController(pipe_controller, rate=rate, ring=ring)
 
     def setRange(self, x_range, y_range):
         """Sets the x and y range for the attached visualiser"""
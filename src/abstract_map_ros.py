@@ -1,11 +1,14 @@
 from __future__ import absolute_import
 import cPickle as pickle
-import cv2
 import math
+import multiprocessing as mp
 import numpy as np
+import os
+import rospkg
 import rospy
 import time
 import tf
+import threading
 
 import actionlib_msgs.msg as actionlib_msgs
 import std_msgs.msg as std_msgs
@@ -14,7 +17,12 @@ import nav_msgs.msg as nav_msgs
 
 import abstract_map.msg as abstract_map_msgs
 import abstract_map_lib.abstract_map as am
-import abstract_map_lib.tools as tools
+import abstract_map_lib.checkpoint as checkpoint
+import abstract_map_lib.ensemble as ensemble
+import abstract_map_lib.hierarchy as hierarchy_lib
+import abstract_map_lib.occupancy as occupancy
+import abstract_map_lib.profiling as profiling
+import abstract_map_lib.ros_tools as ros_tools
 import abstract_map_lib.spatial_layout as sl
 
 
@@ -37,24 +45,80 @@ class AbstractMapNode(object):
         # self._publish_rate = rospy.Rate(rospy.get_param("~publish_rate", 10))
         self._goal = rospy.get_param("~goal", "")
         self._goal_complete = False
+
+        # Size of the layout ensemble used to estimate the goal's location &
+        # uncertainty (0 uses the layout's location of the goal directly), &
+        # the longest it gets to settle (it is settled off the step thread)
+        self._goal_ensemble_size = rospy.get_param("~goal_ensemble_size", 0)
+        self._goal_ensemble_time = rospy.get_param(
+            "~goal_ensemble_time", ensemble.ENSEMBLE_MAX_TIME)
+        self._goal_request = 0  # Bumped whenever the settled state changes
         self._last_goal_status = None
         start_pose = rospy.wait_for_message("/odom",
                                             nav_msgs.Odometry).pose.pose
         x = start_pose.position.x
         y = start_pose.position.y
-        th = tools.quaternionMsgToYaw(start_pose.orientation)
+        th = ros_tools.quaternionMsgToYaw(start_pose.orientation)
 
         # Used to ensure we only publish on a change in settled state
         self._last_settled = None
 
+        # Directory for caching initialised hierarchy layouts ('' disables)
+        self._hierarchy_cache_dir = rospy.get_param(
+            "~hierarchy_cache_dir",
+            os.path.join(rospkg.get_ros_home(), 'abstract_map'))
+
+        # Periodic checkpoints of the abstract map ('' disables)
+        self._checkpoint_dir = rospy.get_param("~checkpoint_dir", "")
+        self._checkpoint_period = rospy.get_param("~checkpoint_period", 30.0)
+        self._checkpoint_time = time.time()
+        self._checkpoint_version = None
+
+        # Configure profiling of the spatial layout (disabled by default)
+        self._profiler = profiling.profilerFromConfig(
+            rospy.get_param("~profile", ""),
+            period=rospy.get_param("~profile_period", 10.0))
+
         # Initialise an Abstract Map with information that already exists
-        self._abstract_map = am.AbstractMap(self._goal, x, y, th, log=False)
+        self._abstract_map = am.AbstractMap(self._goal,
+                                            x,
+                                            y,
+                                            th,
+                                            log=False,
+                                            profiler=self._profiler)
+
+        # Independent parts of large layouts can be integrated by a pool of
+        # processes (0 integrates everything in this process)
+        processes = rospy.get_param("~layout_processes", 0)
+        self._pool = mp.Pool(processes) if processes > 0 else None
+        self._abstract_map._spatial_layout.setProcessPool(self._pool)
+
+        # Step the layout with compiled kernels (falls back to NumPy if Numba
+        # isn't installed)
+        kernels = rospy.get_param("~layout_kernels", True)
+        if (not self._abstract_map._spatial_layout.useKernels(kernels) and
+                kernels):
+            rospy.loginfo("Numba is not installed, so the spatial layout "
+                          "will be stepped without compiled kernels")
         rospy.loginfo(
             "Starting Abstract Map @ (%f, %f) facing %f deg, with the goal: %s"
             % (x, y, th * 180. / math.pi,
                "None" if not self._goal else self._goal))
         self._ssi_store = _SsiCache()
 
+        # Track the centre of explored mass from the latest map (raw messages
+        # are parsed in place, and only changed regions are recomputed)
+        self._explored_mass = occupancy.ExploredMass()
+        self._coem_pending = False
+        self._sub_map = rospy.Subscriber('/map',
+                                         rospy.AnyMsg,
+                                         self.cbMap,
+                                         queue_size=1)
+        self._sub_map_updates = rospy.Subscriber('/map_updates',
+                                                 rospy.AnyMsg,
+                                                 self.cbMapUpdate,
+                                                 queue_size=10)
+
         # Configure the ROS side
         self._sub_vel = rospy.Subscriber('cmd_vel_suggested',
                                          geometry_msgs.Twist, self.cbVelocity)
@@ -85,29 +149,20 @@ class AbstractMapNode(object):
             self._abstract_map._spatial_layout._post_state_change_fcn = (
                 self.publish)
 
-        # Pull in a hierarchy if one is found
-        self.pullInHierarchy()
+        # Resume from a checkpoint if available, otherwise pull in a
+        # hierarchy if one is found
+        if not self.resumeFromCheckpoint():
+            self.pullInHierarchy()
 
     def _update_coem(self):
-        """Extracts and stores a new explored center of mass in the map"""
-        # Get the latest occupancy grid map
-        latest_map = rospy.wait_for_message("/map", nav_msgs.OccupancyGrid)
-
-        # Build an opencv binary image, with 1 corresponding to space that has
-        # been marked as free
-        map_data = np.array(latest_map.data,
-                            dtype=np.int8).reshape(latest_map.info.width,
-                                                   latest_map.info.height)
-        free_space_map = ((map_data >= 0) & (map_data <= 50)).astype(np.uint8)
-
-        # Use "image moments" to compute the centre of mass
-        # TODO should probably incorporate orientation in coordinate calc...
-        ms = cv2.moments(free_space_map, True)
-        centre = np.array([ms['m10'], ms['m01']]) / ms['m00']
-        centre_coordinates = np.array([
-            latest_map.info.origin.position.x,
-            latest_map.info.origin.position.y
-        ]) + latest_map.info.resolution * centre
+        """Stores the latest explored center of mass in the map"""
+        # Use the centre maintained from the map subscription (deferring the
+        # update until a map arrives if we haven't received one yet)
+        centre_coordinates = self._explored_mass.centre
+        if centre_coordinates is None:
+            self._coem_pending = True
+            return
+        self._coem_pending = False
 
         # Update "centre of explored mass" in the abstract map
         # TODO remove debug
@@ -115,8 +170,43 @@ class AbstractMapNode(object):
         self._debug_coem.publish(
             geometry_msgs.PoseStamped(
                 header=std_msgs.Header(stamp=rospy.Time.now(), frame_id='map'),
-                pose=tools.xythToPoseMsg(centre_coordinates[0],
-                                         centre_coordinates[1], 0)))
+                pose=ros_tools.xythToPoseMsg(centre_coordinates[0],
+                                             centre_coordinates[1], 0)))
+
+    def _estimateGoal(self, goal_ensemble, request):
+        """Settles a goal ensemble, then publishes its estimate of the goal
+
+        Run in its own thread. Nothing is published if the layout's settled
+        state changed in the meantime, & the layout's location of the goal
+        is published instead if the ensemble doesn't settle in time.
+        """
+        goal_ensemble.settle(max_time=self._goal_ensemble_time)
+        estimate = goal_ensemble.estimate(self._goal)
+        if request != self._goal_request:
+            return
+        if estimate.settled:
+            rospy.loginfo("Goal %s estimated @ (%f, %f), with std. dev. %f" %
+                          (self._goal, estimate.mean[0], estimate.mean[1],
+                           math.sqrt(np.trace(estimate.covariance))))
+            self._publishGoal(estimate.mean)
+        else:
+            rospy.logwarn("Goal ensemble didn't settle in %fs, using the "
+                          "layout's location of %s" %
+                          (self._goal_ensemble_time, self._goal))
+            self._publishGoal(
+                self._abstract_map.getToponymLocation(self._goal))
+
+    def _publishGoal(self, goal_pos):
+        """Publishes a goal location (if one was found)"""
+        if goal_pos is not None:
+            self._pub_goal.publish(
+                geometry_msgs.PoseStamped(
+                    header=std_msgs.Header(stamp=rospy.Time.now(),
+                                           frame_id='map'),
+                    pose=geometry_msgs.Pose(
+                        position=geometry_msgs.Vector3(
+                            goal_pos[0], goal_pos[1], 0),
+                        orientation=ros_tools.yawToQuaternionMsg(0))))
 
     def cbGoalStatus(self, msg):
         # TODO make this much less brittle...
@@ -132,6 +222,18 @@ class AbstractMapNode(object):
 
         self._last_goal_status = current_status
 
+    def cbMap(self, msg):
+        """Callback to update the explored mass from a raw map message"""
+        self._explored_mass.updateMap(
+            *occupancy.occupancyGridFromBuffer(msg._buff))
+        if self._coem_pending:
+            self._update_coem()
+
+    def cbMapUpdate(self, msg):
+        """Callback to update the explored mass from a raw map update"""
+        self._explored_mass.updateRegion(
+            *occupancy.occupancyGridUpdateFromBuffer(msg._buff))
+
     def cbSymbolicSpatialInformation(self, msg):
         """Callback to process any new symbolic spatial information received"""
         assert isinstance(msg, abstract_map_msgs.SymbolicSpatialInformation)
@@ -175,6 +277,7 @@ class AbstractMapNode(object):
         settled = self._abstract_map._spatial_layout.isSettled()
         if settled == self._last_settled:
             return
+        self._goal_request += 1
 
         # Update the paused status
         if settled:
@@ -190,19 +293,20 @@ class AbstractMapNode(object):
             self._goal_complete = True
             rospy.loginfo("MISSION ACCOMPLISHED! %s was found." % (self._goal))
         elif settled and self._pub_goal is not None:
-            # Get the suggested pose for the goal from the abstract map
-            goal_pos = self._abstract_map.getToponymLocation(self._goal)
-
-            # Send the message (only if we found a suggested pose for the goal)
-            if goal_pos is not None:
-                self._pub_goal.publish(
-                    geometry_msgs.PoseStamped(
-                        header=std_msgs.Header(stamp=rospy.Time.now(),
-                                               frame_id='map'),
-                        pose=geometry_msgs.Pose(
-                            position=geometry_msgs.Vector3(
-                                goal_pos[0], goal_pos[1], 0),
-                            orientation=tools.yawToQuaternionMsg(0))))
+            # Publish the suggested pose for the goal from the abstract map
+            # (an ensemble is copied here, but settled in its own thread so
+            # the layout isn't held up)
+            goal_ensemble = (None if self._goal_ensemble_size <= 0 else
+                             self._abstract_map.getToponymEnsemble(
+                                 self._goal, size=self._goal_ensemble_size))
+            if goal_ensemble is None:
+                self._publishGoal(
+                    self._abstract_map.getToponymLocation(self._goal))
+            else:
+                t = threading.Thread(target=self._estimateGoal,
+                                     args=(goal_ensemble, self._goal_request))
+                t.daemon = True
+                t.start()
 
         # Update the last_settled state
         self._last_settled = settled
@@ -211,39 +315,74 @@ class AbstractMapNode(object):
             self._debug_lock = True
             self._debug_lock = False
 
+    def writeCheckpoint(self, force=False):
+        """Writes a checkpoint if one is due, & the layout has changed"""
+        layout = self._abstract_map._spatial_layout
+        if not self._checkpoint_dir or (
+                not force and
+                time.time() - self._checkpoint_time < self._checkpoint_period):
+            return
+        self._checkpoint_time = time.time()
+        if layout._state_version == self._checkpoint_version:
+            return
+        try:
+            checkpoint.writeCheckpoint(self._checkpoint_dir, layout,
+                                       self._ssi_store.items())
+            self._checkpoint_version = layout._state_version
+        except (IOError, OSError) as e:
+            rospy.logwarn("Failed to write checkpoint: %s" % (e))
+
     def pullInHierarchy(self):
         """Attempts to pull a published hierarchy into the Abstract Map"""
         hierarchy_topic = rospy.get_param('hierarchy_topic', '/hierarchy')
         if next((t for t in rospy.get_published_topics()
                  if t[0] == hierarchy_topic), None) is not None:
             # Reconstruct the hierarchy
-            hierarchy = pickle.loads(
-                rospy.wait_for_message('/hierarchy',
-                                       std_msgs.String,
-                                       timeout=1.0).data)
-
-            # Add the associated symbolic spatial information strings
-            for h in hierarchy:
-                if h[1] is not None:
-                    ssi = "%s is in %s" % (h[0], h[1])
-                    self._abstract_map.addSymbolicSpatialInformation(
-                        ssi, None, immediate=True)
-                    rospy.loginfo("Added symbolic spatial information: %s" %
-                                  (ssi))
-
-            # Because we pulled in an entire hierarchy, we should finish by
-            # initialising the state of the entire network (this allows us to
-            # layout the network WITH correct mass levels, whereas the adding
-            # done above is not able to guarantee this...)
-            self._abstract_map._spatial_layout.initialiseState()
+            hierarchy = hierarchy_lib.Hierarchy.fromTuples(
+                pickle.loads(
+                    rospy.wait_for_message('/hierarchy',
+                                           std_msgs.String,
+                                           timeout=1.0).data))
+
+            # Add the hierarchy to the abstract map (the initialised layout is
+            # cached, so the same hierarchy is only laid out once)
+            cached = self._abstract_map.addHierarchy(
+                hierarchy,
+                cache_dir=self._hierarchy_cache_dir or None)
+            rospy.loginfo("Added hierarchy of %d places%s" %
+                          (len(hierarchy),
+                           " (from cache)" if cached else ""))
             self._update_coem()
         else:
             rospy.logwarn("Hierarchy not available; continuing without")
 
+    def resumeFromCheckpoint(self):
+        """Attempts to resume from the latest checkpoint (returns success)"""
+        if not self._checkpoint_dir:
+            return False
+        c = checkpoint.readCheckpoint(self._checkpoint_dir)
+        if c is None:
+            return False
+        layout = self._abstract_map._spatial_layout
+        layout.__setstate__(c.layout_state)
+        layout.markSystemChanged()
+        self._ssi_store.restore(c.ssi_items)
+        self._checkpoint_version = layout._state_version
+        self._update_coem()
+        rospy.loginfo("Resumed from checkpoint with %d masses & %d SSI (%.1fs "
+                      "old)" % (len(layout._masses), len(c.ssi_items),
+                                time.time() - c.time))
+        return True
+
     def spin(self):
         """Blocking function where the Abstract Map operates"""
         while not rospy.is_shutdown():
             self._abstract_map._spatial_layout.step()
+            self.writeCheckpoint()
+        self.writeCheckpoint(force=True)
+        self._profiler.close()
+        if self._pool is not None:
+            self._pool.terminate()
         rospy.logerr("Exiting spin...")
 
 
@@ -265,22 +404,35 @@ class _SsiCache(object):
                 ssi.tag_id, ssi.ssi, ssi.location)
             return True
 
+    def items(self):
+        """Returns the cache as a list of (tag_id, ssi, poses) tuples"""
+        return [(i.tag_id, i.ssi, np.array(i.poses).reshape(-1, 4))
+                for i in list(self._store.values())]
+
+    def restore(self, items):
+        """Restores the cache from a list of (tag_id, ssi, poses) tuples"""
+        self._store = {}
+        for tag_id, ssi, poses in items:
+            item = _SsiCache._SsiCacheItem(tag_id, ssi)
+            item.poses = [list(p) for p in poses]
+            self._store[tag_id] = item
+
     class _SsiCacheItem(object):
         """Item representing a distinct piece of symbolic spatial information"""
 
-        def __init__(self, tag_id, ssi, pose):
-            """Construct a cache item from identifying data (i.e. no pose)"""
-            assert isinstance(pose, geometry_msgs.Pose)
+        def __init__(self, tag_id, ssi, pose=None):
+            """Construct a cache item from identifying data (& first pose)"""
             self.tag_id = tag_id
             self.ssi = ssi
 
             self.poses = []
-            self.addRosPose(pose)
+            if pose is not None:
+                self.addRosPose(pose)
 
         def addRosPose(self, ros_pose):
             """Adds a pose from a ROS message"""
             assert isinstance(ros_pose, geometry_msgs.Pose)
-            x, y, th = tools.poseMsgToXYTh(ros_pose)
+            x, y, th = ros_tools.poseMsgToXYTh(ros_pose)
             self.poses.append([x, y, math.cos(th), math.sin(th)])
 
         def meanPose(self):
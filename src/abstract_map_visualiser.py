@@ -1,18 +1,24 @@
+import collections
 import cPickle as pickle
-import numpy as np
 import rospy
 import tf2_geometry_msgs
 import tf2_ros
+import traceback
 
 import geometry_msgs.msg as geometry_msgs
 import nav_msgs.msg as nav_msgs
 import std_msgs.msg as std_msgs
 
+import abstract_map_lib.occupancy as occupancy
 import abstract_map_lib.visual as visual
-import abstract_map_lib.tools as tools
+import abstract_map_lib.ros_tools as ros_tools
 
 _SAVE_ABSTRACT_MAP_ON_EXIT = True
 
+# Receive buffer for abstract map messages (must fit a whole message, or rospy
+# queues stale messages in the socket no matter what the queue size is)
+_ABSTRACT_MAP_BUFF_SIZE = 2**24
+
 
 class VisualiserNode:
     """ROS node for integrating ROS topics with Abstract Map visualisation"""
@@ -25,34 +31,37 @@ class VisualiserNode:
             window_type=visual.WindowType.IMMERSIVE, dark=dark)
         self._rate = rospy.get_param("rate", 10)
 
-        # Declare all msg data objects
+        # Latest raw message received on each topic (newer messages replace
+        # older ones, & they are only decoded when it is time to draw)
+        self._latest = {}
         self._abstract_map = None
-        self._goal = None
-        self._map = None
-        self._plan = None
-        self._pose = None
 
-        self._is_abstract_map_new = None
-        self._is_goal_new = None
-        self._is_map_new = None
-        self._is_plan_new = None
-        self._is_pose_new = None
+        # Occupancy grids are parsed straight out of the raw messages (map
+        # updates are all needed, so they are queued rather than replaced)
+        self._occupancy = occupancy.OccupancyPyramid()
+        self._map_updates = collections.deque()
 
         # Configure all of the necessary ROS subscriptions
         self._tf_buffer = tf2_ros.Buffer()
         self._tf_listener = tf2_ros.TransformListener(self._tf_buffer)
-        self._sub_abstract_map = rospy.Subscriber('abstract_map',
-                                                  std_msgs.String,
-                                                  self.cbAbstractMap,
-                                                  queue_size=100)
+        self._sub_abstract_map = rospy.Subscriber(
+            'abstract_map',
+            std_msgs.String,
+            self.cbAbstractMap,
+            queue_size=1,
+            buff_size=_ABSTRACT_MAP_BUFF_SIZE)
         self._sub_goal = rospy.Subscriber('/move_base_simple/goal',
                                           geometry_msgs.PoseStamped,
                                           self.cbGoal,
                                           queue_size=1)
         self._sub_map = rospy.Subscriber('map',
-                                         nav_msgs.OccupancyGrid,
+                                         rospy.AnyMsg,
                                          self.cbMap,
                                          queue_size=1)
+        self._sub_map_updates = rospy.Subscriber('map_updates',
+                                                 rospy.AnyMsg,
+                                                 self.cbMapUpdate,
+                                                 queue_size=10)
         self._sub_plan = rospy.Subscriber('/move_base/GlobalPlanner/plan',
                                           nav_msgs.Path,
                                           self.cbPlan,
@@ -62,48 +71,57 @@ class VisualiserNode:
                                           self.cbPose,
                                           queue_size=1)
 
+    def _poseFromOdom(self, msg):
+        """Transforms an odometry message to a pose in the map (None if not)"""
+        try:
+            # Needed because:
+            # - stage with multiple robots stupidly prepends frames with slash
+            # - tf2 is too moronic to handle frames starting with a slash...
+            msg.header.frame_id = msg.header.frame_id.strip("/")
+
+            # Never wait on tf in the draw loop (the pose is skipped until
+            # the transform is available)
+            if not self._tf_buffer.can_transform(
+                    "map", msg.header.frame_id, msg.header.stamp,
+                    VisualiserNode._ZERO_DURATION):
+                return None
+            transformed_pose = self._tf_buffer.transform(
+                geometry_msgs.PoseStamped(header=msg.header,
+                                          pose=msg.pose.pose), "map",
+                VisualiserNode._ZERO_DURATION)
+            return visual.PosePrimitive(
+                *ros_tools.poseMsgToXYTh(transformed_pose.pose))
+        except Exception as e:
+            return None
+
+    def _takeLatest(self, topic):
+        """Takes the latest undrawn message from a topic (None if none)"""
+        return self._latest.pop(topic, None)
+
     def cbAbstractMap(self, msg):
         """Callback to handle visualising Abstract Map updates"""
-        self._abstract_map = pickle.loads(msg.data)
-        self._is_abstract_map_new = True
+        self._latest['abstract_map'] = msg
 
     def cbGoal(self, msg):
-        self._goal = visual.GoalPrimitive(*(
-            tools.poseMsgToXYTh(msg.pose)[0:2]))
-        self._is_goal_new = True
+        self._latest['goal'] = msg
 
     def cbMap(self, msg):
         """Callback to handle visualising occapancy grid map updates"""
-        self._map = visual.MapPrimitive(
-            np.asarray(msg.data).reshape((msg.info.width, msg.info.height)),
-            msg.info.resolution,
-            visual.PosePrimitive(*tools.poseMsgToXYTh(msg.info.origin)))
-        self._is_map_new = True
+        # A complete map supersedes any partial updates waiting to be drawn
+        self._map_updates.clear()
+        self._latest['map'] = msg
+
+    def cbMapUpdate(self, msg):
+        """Callback to handle visualising partial occupancy grid updates"""
+        self._map_updates.append(msg)
 
     def cbPlan(self, msg):
         """Callback to handle visualising plan updates"""
-        self._plan = visual.PathPrimitive(
-            [p.pose.position.x for p in msg.poses],
-            [p.pose.position.y for p in msg.poses])
-        self._is_plan_new = True
+        self._latest['plan'] = msg
 
     def cbPose(self, msg):
         """Callback to handle visualising pose updates"""
-        try:
-            # Needed because:
-            # - stage with multiple robots stupidly prepends frames with slash
-            # - tf2 is too moronic to handle frames starting with a slash...
-            msg.header.frame_id = msg.header.frame_id.strip("/")
-
-            transformed_pose = self._tf_buffer.transform(
-                geometry_msgs.PoseStamped(header=msg.header,
-                                          pose=msg.pose.pose), "map",
-                rospy.Duration(1.0))
-            self._pose = visual.PosePrimitive(
-                *tools.poseMsgToXYTh(transformed_pose.pose))
-            self._is_pose_new = True
-        except Exception as e:
-            return
+        self._latest['pose'] = msg
 
     def spin(self):
         """Blocking function to spin the visualiser at the configured rate"""
@@ -116,9 +134,12 @@ class VisualiserNode:
                     self._visualiser.show()
                 r.sleep()
 
-                # Perform all drawing
-                if self._is_abstract_map_new:
+                # Perform all drawing (only the newest message on each topic
+                # gets decoded, any older messages were dropped unseen)
+                msg = self._takeLatest('abstract_map')
+                if msg is not None:
                     # t = time.time()
+                    self._abstract_map = pickle.loads(msg.data)
                     self._visualiser.draw(self._abstract_map._spatial_layout,
                                           3)
                     self._visualiser.toggleOverlay(
@@ -126,29 +147,50 @@ class VisualiserNode:
                         isSettled())
                     # rospy.loginfo(
                     #     "Draw Abstract Map took: %fs" % (time.time() - t))
-                    self._is_abstract_map_new = False
-                if self._is_goal_new:
-                    self._visualiser.draw(self._goal, 4)
-                    self._is_goal_new = False
-                if self._is_map_new:
+                msg = self._takeLatest('goal')
+                if msg is not None:
+                    self._visualiser.draw(
+                        visual.GoalPrimitive(
+                            *(ros_tools.poseMsgToXYTh(msg.pose)[0:2])), 4)
+                msg = self._takeLatest('map')
+                if msg is not None:
+                    self._occupancy.updateMap(
+                        *occupancy.occupancyGridFromBuffer(msg._buff))
+                while self._map_updates:
+                    if (not self._occupancy.updateRegion(
+                            *occupancy.occupancyGridUpdateFromBuffer(
+                                self._map_updates.popleft()._buff)) and
+                            self._occupancy.levels):
+                        rospy.logwarn("Skipped a map update that doesn't fit "
+                                      "the current map")
+                if self._occupancy.levels:
                     # t = time.time()
-                    self._visualiser.draw(self._map, 0)
+                    # (drawn every loop, as zooming can change the level)
+                    self._visualiser.draw(self._occupancy, 0)
                     # rospy.loginfo(
                     #     "Draw Occupancy Grid took: %fs" % (time.time() - t))
-                    self._is_map_new = False
-                if self._is_plan_new:
+                msg = self._takeLatest('plan')
+                if msg is not None:
                     # t = time.time()
-                    self._visualiser.draw(self._plan, 1)
+                    self._visualiser.draw(
+                        visual.PathPrimitive(
+                            [p.pose.position.x for p in msg.poses],
+                            [p.pose.position.y for p in msg.poses]), 1)
                     # rospy.loginfo("Draw Plan took: %fs" % (time.time() - t))
-                    self._is_plan_new = False
-                if self._is_pose_new:
+                msg = self._takeLatest('pose')
+                pose = None if msg is None else self._poseFromOdom(msg)
+                if pose is not None:
                     # t = time.time()
-                    self._visualiser.draw(self._pose, 2)
-                    # rospy.loginfo("Draw Robot Pose took: %fs" % (time.time() - t))
-                    self._is_pose_new = False
+                    self._visualiser.draw(pose, 2)
+                    # rospy.loginfo(
+                    #     "Draw Robot Pose took: %fs" % (time.time() - t))
         except Exception:
-            pass
+            rospy.logerr("Visualiser stopped drawing after an error:\n%s" %
+                         (traceback.format_exc()))
         finally:
+            msg = self._takeLatest('abstract_map')
+            if msg is not None:
+                self._abstract_map = pickle.loads(msg.data)
             if _SAVE_ABSTRACT_MAP_ON_EXIT and self._abstract_map is not None:
                 print("Saving abstract map on shutdown...")
                 pickle.dump(self._abstract_map, open('am.pickle', 'wb'))